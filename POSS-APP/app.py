@@ -1,33 +1,45 @@
-from flask import Flask, request, jsonify, session, render_template, send_file
-from models.article import Article, Category
+from flask import Flask, request, jsonify, session, render_template, send_file, Response, stream_with_context
+from models.article import Article, Category, ArticleClassification
 from models.user import User
 from sqlalchemy import text
-from models.sale import Sale, SaleItem, Turno, SuspendedSale, Devolucion
+from models.sale import Sale, SaleItem, Turno, SuspendedSale, Devolucion, TurnoResumen
 from models.inventory_loss import InventoryLoss
-from models.physical_inventory import PhysicalInventory
+from models.physical_inventory import PhysicalInventory, PhysicalInventorySession, PhysicalInventoryArchive
 from models.discount import Discount, Promotion, SaleDiscount
 from models.history import ProductHistory, PhysicalCountHistory
+from models.rollup import SalesDailyRollup, SalesHourlyRollup, ArticleDailyRollup, ShrinkageMonthlyRollup, ROLLUP_DEVOLUCION
+from models.stock_movement import StockMovement, StockSnapshot, StockAlert, TIPOS_MOVIMIENTO, TIPOS_ALERTA
+from models.local_time import BUSINESS_TZ, LOCAL_DATE_MODELS, local_date_hour, local_to_utc, now_local, to_local_time, with_local_date
 from models import db
 from flask_cors import CORS
 from functools import wraps
 import os
 import mimetypes
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta
 import uuid
-import pytz
-from sqlalchemy import create_engine, func, case
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, func, case, insert, or_, and_, inspect, update, bindparam, select, delete, literal, exists, union_all
+from sqlalchemy.orm import sessionmaker, selectinload, joinedload, aliased
 import json
+import click
 from werkzeug.utils import secure_filename
 import openpyxl
 import time
 from openpyxl.styles import Font, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
 from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.pagesizes import letter, landscape
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, PageBreak
+from reportlab.platypus import BaseDocTemplate, PageTemplate, Frame
 from reportlab.lib.styles import getSampleStyleSheet
 import io
+import base64
+import numpy as np
+import tempfile
+import hashlib
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuración para upload de archivos
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads')
@@ -76,13 +88,127 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 db.init_app(app)
 
-# Asegurar que el import incluya Devolucion
-with app.app_context():
-    try:
-        db.create_all()  # Esto creará solo las tablas/columnas faltantes
-        print("Base de datos actualizada")
-    except Exception as e:
-        print(f"Error actualizando BD: {e}")
+def upgrade_schema():
+    """Aplica en una base existente lo que create_all no agrega: columnas e índices
+    nuevos sobre tablas ya creadas. Las columnas nuevas se agregan como NULL."""
+    inspector = inspect(db.engine)
+    agregadas = set()
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existentes = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existentes:
+                    tipo = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {tipo}'))
+                    agregadas.add((table.name, column.name))
+                    print(f"🛠️ Columna agregada: {table.name}.{column.name}")
+    
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    
+    if any(columna == 'fecha_local' for _, columna in agregadas):
+        backfill_local_dates()
+    
+    sin_cabeceras = db.session.query(PhysicalInventorySession.id).first() is None and \
+        db.session.query(PhysicalInventory.id).first() is not None
+    if sin_cabeceras or any(tabla == PhysicalInventorySession.__tablename__ for tabla, _ in agregadas):
+        backfill_session_summaries()
+    
+    # Rollups nuevos sobre una base con historia: se calculan desde las tablas de origen
+    if db.session.query(SalesDailyRollup.id).first() is None and db.session.query(Sale.id).first() is not None:
+        diarios, por_hora = rebuild_sales_rollups()
+        db.session.commit()
+        print(f"📊 Rollups de ventas: {diarios} filas diarias, {por_hora} filas por hora")
+    if db.session.query(ArticleDailyRollup.id).first() is None and db.session.query(SaleItem.id).first() is not None:
+        por_articulo = rebuild_article_rollups()
+        db.session.commit()
+        print(f"📊 Rollup por artículo: {por_articulo} filas")
+    sin_mermas = db.session.query(InventoryLoss.id).first() is None and \
+        db.session.query(PhysicalCountHistory.id).first() is None
+    if db.session.query(ShrinkageMonthlyRollup.id).first() is None and not sin_mermas:
+        mermas = rebuild_shrinkage_rollups()
+        db.session.commit()
+        print(f"📊 Rollup mensual de mermas: {mermas} filas")
+    
+    # Foto inicial del stock: punto de partida del ledger para los artículos que ya existían
+    if db.session.query(StockSnapshot.id).first() is None and db.session.query(Article.id).first() is not None:
+        resumen = take_stock_snapshot()
+        db.session.commit()
+        print(f"📸 Foto inicial de stock: {resumen['articulos']} artículos")
+
+def backfill_local_dates(batch_size=1000):
+    """Completa fecha_local/hora_local de las filas que aún no las tienen"""
+    for model, columna, stored_utc in LOCAL_DATE_MODELS:
+        origen = getattr(model, columna)
+        actualizar = update(model.__table__)\
+            .where(model.__table__.c.id == bindparam('row_id'))\
+            .values(fecha_local=bindparam('fecha'), hora_local=bindparam('hora'))
+        total = 0
+        ultimo_id = 0
+        while True:
+            # Se avanza por id para no volver a leer filas sin origen (quedan en NULL)
+            filas = db.session.query(model.id, origen)\
+                              .filter(model.fecha_local.is_(None), model.id > ultimo_id)\
+                              .order_by(model.id).limit(batch_size).all()
+            if not filas:
+                break
+            valores = []
+            for row_id, fecha in filas:
+                fecha_local, hora_local = local_date_hour(fecha, stored_utc)
+                valores.append({'row_id': row_id, 'fecha': fecha_local, 'hora': hora_local})
+            db.session.execute(actualizar, valores)
+            db.session.commit()
+            total += len(filas)
+            ultimo_id = filas[-1][0]
+        if total:
+            print(f"🕒 {model.__tablename__}: fecha local calculada para {total} filas")
+
+def session_summary_values():
+    """Contadores de physical_inventory_sessions como subconsultas correlacionadas sobre el detalle y el archivo"""
+    cabecera = PhysicalInventorySession.__table__
+    
+    def contar(condicion):
+        return sum(
+            select(func.count()).where(tabla.c.conteo_session_id == cabecera.c.id, condicion(tabla)).scalar_subquery()
+            for tabla in (PhysicalInventory.__table__, PhysicalInventoryArchive.__table__)
+        )
+    
+    return {
+        'contados': contar(lambda tabla: tabla.c.estado == 'contado'),
+        'ajustados': contar(lambda tabla: tabla.c.estado == 'ajustado'),
+        'con_diferencias': contar(lambda tabla: func.abs(tabla.c.diferencia) > 0.01)
+    }
+
+def backfill_session_summaries():
+    """Crea la cabecera de las sesiones de conteo que no la tienen y completa los contadores vacíos"""
+    detalle = PhysicalInventory.__table__
+    cabecera = PhysicalInventorySession.__table__
+    with db.engine.begin() as connection:
+        creadas = connection.execute(insert(cabecera).from_select(
+            ['id', 'modo', 'total_productos', 'fecha_inicio', 'usuario_conteo'],
+            select(
+                detalle.c.conteo_session_id,
+                literal('completo'),
+                func.count(),
+                func.min(detalle.c.fecha_conteo),
+                func.min(detalle.c.usuario_conteo)
+            ).where(
+                ~exists().where(cabecera.c.id == detalle.c.conteo_session_id)
+            ).group_by(detalle.c.conteo_session_id),
+            include_defaults=False  # Contadores en NULL para calcularlos abajo
+        )).rowcount
+        completadas = connection.execute(
+            update(cabecera).where(cabecera.c.contados.is_(None))
+                            .values(compactada=False, filas_archivadas=0, **session_summary_values())
+        ).rowcount
+    if creadas or completadas:
+        print(f"🗂️ Sesiones de conteo: {creadas} cabeceras creadas, {completadas} resúmenes calculados")
+
+# Carpeta privada para archivos temporales de exportación (fuera de static/)
+EXPORT_TMP_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'exports')
+os.makedirs(EXPORT_TMP_FOLDER, exist_ok=True)
+EXPORT_SPOOL_MAX_SIZE = 8 * 1024 * 1024  # 8MB en memoria antes de pasar a disco
 
 # Definir el decorador login_required
 def login_required(f):
@@ -138,15 +264,125 @@ def get_or_create_active_turno(user_id):
     turno_activo = Turno.query.filter_by(user_id=user_id, activo=True).first()
     if not turno_activo:
         # Crear nuevo turno con la zona horaria de Chile
-        chile_tz = pytz.timezone('America/Santiago')
         turno_activo = Turno(
             user_id=user_id,
-            fecha_inicio=datetime.now(chile_tz)
+            fecha_inicio=datetime.now(BUSINESS_TZ)
         )
         db.session.add(turno_activo)
         db.session.flush()
     return turno_activo
 
+def local_date_filter(query, column, inicio=None, fin=None):
+    """Filtra por la columna fecha_local con el rango [inicio, fin) de parse_date_range"""
+    if inicio:
+        query = query.filter(column >= inicio.date())
+    if fin:
+        query = query.filter(column < fin.date())
+    return query
+
+def parse_date_range(fecha_inicio, fecha_fin):
+    """Convierte los filtros 'YYYY-MM-DD' en un rango [inicio, fin) incluyendo todo el día final"""
+    inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d') if fecha_inicio else None
+    fin = datetime.strptime(fecha_fin, '%Y-%m-%d') + timedelta(days=1) if fecha_fin else None
+    return inicio, fin
+
+# Paginación keyset: en vez de OFFSET se continúa desde la última fila vista,
+# ordenando por (fecha, id) descendente, así cada página cuesta lo mismo
+KEYSET_DEFAULT_LIMIT = 50
+KEYSET_MAX_LIMIT = 500
+
+def encode_cursor(fecha, row_id):
+    """Cursor opaco con la fecha e id de la última fila entregada"""
+    payload = json.dumps([fecha.isoformat() if fecha else None, row_id])
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        fecha, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (datetime.fromisoformat(fecha) if fecha else None), int(row_id)
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+def keyset_args(default_limit=KEYSET_DEFAULT_LIMIT):
+    """Lee 'cursor' y 'limit' de la query string (un cursor vacío pide la primera página)"""
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', default_limit, type=int)
+    return cursor, max(1, min(limit, KEYSET_MAX_LIMIT))
+
+def keyset_paginate(query, fecha_col, id_col, cursor=None, limit=KEYSET_DEFAULT_LIMIT, key=None):
+    """Devuelve (filas, next_cursor) de la página que sigue a `cursor`.
+
+    `key` extrae (fecha, id) de una fila cuando la consulta no devuelve el modelo directamente.
+    """
+    if cursor:
+        fecha, last_id = decode_cursor(cursor)
+        query = query.filter(or_(fecha_col < fecha, and_(fecha_col == fecha, id_col < last_id)))
+    rows = query.order_by(fecha_col.desc(), id_col.desc()).limit(limit + 1).all()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        fecha, last_id = key(last) if key else (getattr(last, fecha_col.key), getattr(last, id_col.key))
+        next_cursor = encode_cursor(fecha, last_id)
+    return rows, next_cursor
+
+def keyset_page(query, fecha_col, id_col, default_limit=KEYSET_DEFAULT_LIMIT, key=None):
+    """Página keyset según los parámetros de la request.
+
+    Devuelve (filas, meta) con next_cursor/has_more; con count=1 agrega el total
+    del filtro, cacheado por COUNT_CACHE_TTL para no contar en cada página.
+    """
+    cursor, limit = keyset_args(default_limit)
+    rows, next_cursor = keyset_paginate(query, fecha_col, id_col, cursor, limit, key)
+    meta = {'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+    if request.args.get('count', '').lower() in ('1', 'true'):
+        meta['total'] = cached_count(query)
+    return rows, meta
+
+# Caché en memoria con expiración, para valores caros de recalcular
+app_cache = {}
+app_cache_lock = threading.Lock()
+COUNT_CACHE_TTL = 60  # segundos
+
+def cache_get(key):
+    with app_cache_lock:
+        entry = app_cache.get(key)
+    if entry and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+def cache_set(key, value, ttl):
+    with app_cache_lock:
+        app_cache[key] = (time.monotonic() + ttl, value)
+    return value
+
+def cache_invalidate(prefix):
+    with app_cache_lock:
+        for key in [key for key in app_cache if key.startswith(prefix)]:
+            del app_cache[key]
+
+def cached_count(query):
+    """Total de filas del filtro actual; la clave es la ruta y los filtros, sin los parámetros de paginación"""
+    filtros = sorted((k, v) for k, v in request.args.items(multi=True)
+                     if k not in ('cursor', 'limit', 'count', 'page', 'per_page', 'formato'))
+    key = f"count:{request.path}:{session.get('user_id')}:{filtros}"
+    total = cache_get(key)
+    if total is None:
+        total = cache_set(key, query.order_by(None).count(), COUNT_CACHE_TTL)
+    return total
+
+def ndjson_response(rows):
+    """Respuesta NDJSON: un objeto JSON por línea, enviado a medida que se genera"""
+    def generate():
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False, default=str) + '\n'
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def wants_ndjson():
+    return request.args.get('formato') == 'ndjson' or \
+           request.accept_mimetypes.best == 'application/x-ndjson'
+
 # Funciones para historial de auditoría
 def log_product_change(article_id, user_id, action, description, old_values=None, new_values=None):
     """Registra un cambio en el historial de productos"""
@@ -349,8 +585,7 @@ def logout_user():
         if 'user_id' in session:
             turno_activo = Turno.query.filter_by(user_id=session['user_id'], activo=True).first()
             if turno_activo:
-                turno_activo.fecha_cierre = datetime.utcnow()
-                turno_activo.activo = False
+                finalize_turno(turno_activo)
                 db.session.commit()
         
         session.pop('user_id', None)
@@ -452,14 +687,22 @@ def uploaded_file(filename):
 def get_articles():
     try:
         category_id = request.args.get('category_id')
+        # Filtros por clasificación, aceptan varias clases separadas por coma (ej: clase_abc=A,B)
+        clase_abc = request.args.get('clase_abc')
+        clase_xyz = request.args.get('clase_xyz')
         
+        query = db.session.query(Article, ArticleClassification)\
+                          .outerjoin(ArticleClassification, ArticleClassification.article_id == Article.id)\
+                          .filter(Article.activo == True)
         if category_id:
-            articles = Article.query.filter_by(category_id=category_id, activo=True).all()
-        else:
-            articles = Article.query.filter_by(activo=True).all()
+            query = query.filter(Article.category_id == category_id)
+        if clase_abc:
+            query = query.filter(ArticleClassification.clase_abc.in_(clase_abc.upper().split(',')))
+        if clase_xyz:
+            query = query.filter(ArticleClassification.clase_xyz.in_(clase_xyz.upper().split(',')))
         
         articles_data = []
-        for article in articles:
+        for article, clasificacion in query.all():
             # Obtener nombre de categoría
             category_name = "Sin categoría"
             if article.category_id:
@@ -485,7 +728,9 @@ def get_articles():
                 'unit_type': getattr(article, 'unit_type', 'unidades'),
                 'peso_unitario': getattr(article, 'peso_unitario', None),
                 'margen_ganancia': getattr(article, 'margen_ganancia', 0),
-                'precio_costo': article.get_precio_costo() if hasattr(article, 'get_precio_costo') else article.precio
+                'precio_costo': article.get_precio_costo() if hasattr(article, 'get_precio_costo') else article.precio,
+                'clase_abc': clasificacion.clase_abc if clasificacion else None,
+                'clase_xyz': clasificacion.clase_xyz if clasificacion else None
             }
             articles_data.append(article_data)
         
@@ -544,77 +789,108 @@ def get_low_rotation_articles():
         print(f"Error al obtener productos con baja rotación: {str(e)}")
         return jsonify({'error': 'Error al obtener productos con baja rotación'}), 500
 
+STOCK_REPORT_PAGINA_DEFAULT = 100
+STOCK_REPORT_CACHE_TTL = 10 * 60  # respaldo; el resumen se invalida con cada escritura de stock o pérdidas
+
+def invalidate_stock_report():
+    cache_invalidate('stock-report:')
+
+def stock_report_summary():
+    """Resumen global del reporte de stock: un agregado sobre artículos y otro sobre pérdidas, cacheados"""
+    resumen = cache_get('stock-report:summary')
+    if resumen is not None:
+        return resumen
+    
+    articulos = db.session.query(
+        func.count(Article.id),
+        func.coalesce(func.sum(case((Article.stock <= Article.stock_minimo, 1), else_=0)), 0),
+        func.coalesce(func.sum(case((Article.stock == 0, 1), else_=0)), 0)
+    ).filter(Article.activo == True).one()
+    perdidas = db.session.query(
+        func.coalesce(func.sum(case((InventoryLoss.tipo_perdida == 'vencido', InventoryLoss.cantidad_perdida), else_=0)), 0),
+        func.coalesce(func.sum(case((InventoryLoss.tipo_perdida == 'dañado', InventoryLoss.cantidad_perdida), else_=0)), 0),
+        func.coalesce(func.sum(InventoryLoss.cantidad_perdida), 0)
+    ).one()
+    
+    return cache_set('stock-report:summary', {
+        'total_articles': articulos[0],
+        'low_stock_count': articulos[1],
+        'out_of_stock': articulos[2],
+        'global_losses': {
+            'vencido': perdidas[0],
+            'dañado': perdidas[1],
+            'total': perdidas[2]
+        }
+    }, STOCK_REPORT_CACHE_TTL)
+
 @app.route('/articles/stock-report', methods=['GET'])
 @login_required
 def get_stock_report():
-    """Obtiene un reporte detallado de stock incluyendo pérdidas"""
+    """Obtiene un reporte detallado de stock incluyendo pérdidas.
+
+    Con page/per_page la lista de stock bajo se pagina; sin ellos se devuelve completa.
+    """
     try:
-        # Obtener productos con stock bajo
-        low_stock_articles = Article.query.filter(
+        resumen = stock_report_summary()
+        
+        # Productos con stock bajo (la página pedida, si se pagina)
+        bajo_stock = select(
+            Article.id, Article.title, Article.stock, Article.stock_minimo, Article.unit_type,
+            Category.name.label('category_name')
+        ).outerjoin(Category, Article.category_id == Category.id).where(
             Article.stock <= Article.stock_minimo,
             Article.activo == True
-        ).all()
-        
-        stock_data = []
-        for article in low_stock_articles:
-            # Calcular pérdidas totales para este artículo
-            total_losses = db.session.query(func.sum(InventoryLoss.cantidad_perdida)).filter(
-                InventoryLoss.article_id == article.id
-            ).scalar() or 0
-            
-            # Calcular pérdidas por tipo
-            losses_by_type = db.session.query(
-                InventoryLoss.tipo_perdida,
-                func.sum(InventoryLoss.cantidad_perdida)
-            ).filter(
-                InventoryLoss.article_id == article.id
-            ).group_by(InventoryLoss.tipo_perdida).all()
-            
-            losses_detail = {loss_type: amount for loss_type, amount in losses_by_type}
-            
-            category_name = article.category.name if article.category else 'Sin categoría'
-            
-            stock_data.append({
-                'id': article.id,
-                'title': article.title,
-                'stock_actual': article.stock,
-                'stock_minimo': article.stock_minimo,
-                'unit_type': getattr(article, 'unit_type', 'unidades'),
-                'category_name': category_name,
-                'total_losses': total_losses,
-                'losses_detail': {
-                    'vencido': losses_detail.get('vencido', 0),
-                    'dañado': losses_detail.get('dañado', 0)
-                },
-                'stock_status': 'critico' if article.stock == 0 else 'bajo'
-            })
-        
-        # Estadísticas globales
-        total_articles = Article.query.filter(Article.activo == True).count()
-        low_stock_count = len(stock_data)
-        out_of_stock = Article.query.filter(Article.stock == 0, Article.activo == True).count()
+        ).order_by(Article.id)
+        
+        respuesta = {}
+        if 'page' in request.args or 'per_page' in request.args:
+            page = max(request.args.get('page', 1, type=int), 1)
+            per_page = min(max(request.args.get('per_page', STOCK_REPORT_PAGINA_DEFAULT, type=int), 1), KEYSET_MAX_LIMIT)
+            bajo_stock = bajo_stock.limit(per_page).offset((page - 1) * per_page)
+            respuesta['pagination'] = {
+                'page': page,
+                'pages': -(-resumen['low_stock_count'] // per_page),
+                'per_page': per_page,
+                'total': resumen['low_stock_count']
+            }
+        bajo_stock = bajo_stock.subquery()
         
-        # Total de pérdidas globales
-        global_losses = db.session.query(
+        # Pérdidas por artículo y tipo, solo de los artículos del conjunto, en la misma consulta
+        perdidas = select(
+            InventoryLoss.article_id,
             InventoryLoss.tipo_perdida,
-            func.sum(InventoryLoss.cantidad_perdida)
-        ).group_by(InventoryLoss.tipo_perdida).all()
+            func.sum(InventoryLoss.cantidad_perdida).label('cantidad')
+        ).where(
+            InventoryLoss.article_id.in_(select(bajo_stock.c.id))
+        ).group_by(InventoryLoss.article_id, InventoryLoss.tipo_perdida).subquery()
+        
+        filas = db.session.execute(
+            select(bajo_stock, perdidas.c.tipo_perdida, perdidas.c.cantidad)
+            .outerjoin(perdidas, perdidas.c.article_id == bajo_stock.c.id)
+            .order_by(bajo_stock.c.id)
+        ).all()
         
-        global_losses_dict = {loss_type: amount for loss_type, amount in global_losses}
+        stock_data = []
+        for fila in filas:
+            if not stock_data or stock_data[-1]['id'] != fila.id:
+                stock_data.append({
+                    'id': fila.id,
+                    'title': fila.title,
+                    'stock_actual': fila.stock,
+                    'stock_minimo': fila.stock_minimo,
+                    'unit_type': fila.unit_type or 'unidades',
+                    'category_name': fila.category_name or 'Sin categoría',
+                    'total_losses': 0,
+                    'losses_detail': {'vencido': 0, 'dañado': 0},
+                    'stock_status': 'critico' if fila.stock == 0 else 'bajo'
+                })
+            if fila.tipo_perdida is not None:
+                stock_data[-1]['total_losses'] += fila.cantidad
+                stock_data[-1]['losses_detail'][fila.tipo_perdida] = fila.cantidad
         
-        return jsonify({
-            'low_stock_articles': stock_data,
-            'summary': {
-                'total_articles': total_articles,
-                'low_stock_count': low_stock_count,
-                'out_of_stock': out_of_stock,
-                'global_losses': {
-                    'vencido': global_losses_dict.get('vencido', 0),
-                    'dañado': global_losses_dict.get('dañado', 0),
-                    'total': sum(global_losses_dict.values())
-                }
-            }
-        })
+        respuesta['low_stock_articles'] = stock_data
+        respuesta['summary'] = resumen
+        return jsonify(respuesta)
         
     except Exception as e:
         print(f"Error al obtener reporte de stock: {str(e)}")
@@ -681,7 +957,10 @@ def create_article():
         )
 
         db.session.add(new_article)
+        db.session.flush()
+        record_stock_movements([stock_movement(new_article, 'alta', new_article.stock or 0)], session['user_id'])
         db.session.commit()
+        invalidate_stock_report()
         
         # Registrar en historial
         product_data = {
@@ -759,9 +1038,12 @@ def update_article(id):
         article.content = data['content']
     if 'image_url' in data:
         article.image_url = data['image_url']
+    movimientos = []
     if 'stock' in data and int(float(data['stock'])) != article.stock:
         changes_made.append(f"Stock: {article.stock} → {int(float(data['stock']))}")
+        stock_anterior = article.stock or 0
         article.stock = int(float(data['stock']))
+        movimientos.append(stock_movement(article, 'edicion', article.stock - stock_anterior))
     if 'codigo_barra' in data:
         article.codigo_barra = data['codigo_barra']
     if 'precio' in data and int(float(data['precio'])) != article.precio:
@@ -803,7 +1085,9 @@ def update_article(id):
         'category_id': article.category_id
     }
     
+    record_stock_movements(movimientos, session['user_id'])
     db.session.commit()
+    invalidate_stock_report()
     
     # Registrar en historial solo si hubo cambios
     if changes_made:
@@ -843,6 +1127,7 @@ def delete_article(id):
         # No eliminar, solo marcar como inactivo para mantener integridad referencial
         article.activo = False
         db.session.commit()
+        invalidate_stock_report()
         
         return jsonify({
             'message': f'Producto "{article.title}" marcado como inactivo correctamente'
@@ -1008,7 +1293,12 @@ def create_inventory_loss():
         article.stock -= cantidad_perdida
         
         db.session.add(loss)
+        db.session.flush()
+        record_loss_rollup(loss, article)
+        record_stock_movements([stock_movement(article, 'perdida', -cantidad_perdida, loss.id)], session['user_id'])
         db.session.commit()
+        invalidate_stock_report()
+        invalidate_report_cache('perdidas')
         
         return jsonify({
             'message': 'Pérdida registrada exitosamente',
@@ -1045,40 +1335,35 @@ def get_inventory_losses():
         if tipo_perdida:
             query = query.filter(InventoryLoss.tipo_perdida == tipo_perdida)
             
-        if fecha_desde:
-            fecha_desde_dt = datetime.strptime(fecha_desde, '%Y-%m-%d')
-            query = query.filter(InventoryLoss.fecha_registro >= fecha_desde_dt)
-            
-        if fecha_hasta:
-            fecha_hasta_dt = datetime.strptime(fecha_hasta, '%Y-%m-%d')
-            query = query.filter(InventoryLoss.fecha_registro <= fecha_hasta_dt)
-        
-        # Ordenar por fecha más reciente
-        query = query.order_by(InventoryLoss.fecha_registro.desc())
-        
-        # Paginar
-        losses_paginated = query.paginate(
-            page=page, 
-            per_page=per_page, 
-            error_out=False
-        )
-        
-        # Obtener totales por tipo para estadísticas
-        totals_query = InventoryLoss.query
-        if article_id:
-            totals_query = totals_query.filter(InventoryLoss.article_id == article_id)
-            
-        total_vencido = totals_query.filter(InventoryLoss.tipo_perdida == 'vencido').with_entities(func.sum(InventoryLoss.cantidad_perdida)).scalar() or 0
-        total_dañado = totals_query.filter(InventoryLoss.tipo_perdida == 'dañado').with_entities(func.sum(InventoryLoss.cantidad_perdida)).scalar() or 0
-        
-        return jsonify({
-            'losses': [loss.to_dict() for loss in losses_paginated.items],
-            'pagination': {
+        # Rango de días locales, incluyendo el día final completo
+        query = local_date_filter(query, InventoryLoss.fecha_local, *parse_date_range(fecha_desde, fecha_hasta))
+        
+        # Totales por tipo y cantidad de registros con los mismos filtros de la página, en una sola pasada
+        total_registros, total_vencido, total_dañado = query.with_entities(
+            func.count(InventoryLoss.id),
+            func.coalesce(func.sum(case((InventoryLoss.tipo_perdida == 'vencido', InventoryLoss.cantidad_perdida), else_=0)), 0),
+            func.coalesce(func.sum(case((InventoryLoss.tipo_perdida == 'dañado', InventoryLoss.cantidad_perdida), else_=0)), 0)
+        ).order_by(None).one()
+        
+        # El artículo viene en el mismo SELECT de la página, no por cada to_dict()
+        query = query.options(joinedload(InventoryLoss.article))
+        if 'cursor' in request.args:
+            losses, pagination = keyset_page(query, InventoryLoss.fecha_registro, InventoryLoss.id, per_page)
+        else:
+            # Ordenar por fecha más reciente y paginar; el total ya salió del agregado
+            page, per_page = max(page, 1), max(per_page, 1)
+            losses = query.order_by(InventoryLoss.fecha_registro.desc(), InventoryLoss.id.desc())\
+                          .limit(per_page).offset((page - 1) * per_page).all()
+            pagination = {
                 'page': page,
-                'pages': losses_paginated.pages,
+                'pages': -(-total_registros // per_page),
                 'per_page': per_page,
-                'total': losses_paginated.total
-            },
+                'total': total_registros
+            }
+        
+        return jsonify({
+            'losses': [loss.to_dict() for loss in losses],
+            'pagination': pagination,
             'totals': {
                 'vencido': total_vencido,
                 'dañado': total_dañado,
@@ -1086,6 +1371,8 @@ def get_inventory_losses():
             }
         })
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error al obtener pérdidas: {str(e)}")
         return jsonify({'error': 'Error al obtener pérdidas'}), 500
@@ -1100,8 +1387,12 @@ def delete_inventory_loss(loss_id):
         # Restaurar el stock
         article.stock += loss.cantidad_perdida
         
+        record_loss_rollup(loss, article, signo=-1)
+        record_stock_movements([stock_movement(article, 'perdida_anulada', loss.cantidad_perdida, loss.id)], session['user_id'])
         db.session.delete(loss)
         db.session.commit()
+        invalidate_stock_report()
+        invalidate_report_cache('perdidas')
         
         return jsonify({
             'message': 'Pérdida eliminada y stock restaurado',
@@ -1117,41 +1408,253 @@ def delete_inventory_loss(loss_id):
 # CONTEO FÍSICO DE INVENTARIO
 # =====================
 
+PHYSICAL_INVENTORY_MODOS = ('completo', 'diferido')
+
+# Columnas que se copian desde articles al crear las filas de conteo
+CONTEO_COLUMNAS = ['conteo_session_id', 'article_id', 'cantidad_sistema', 'estado', 'fecha_conteo', 'usuario_conteo']
+
+# Conteo cíclico: cada cuántos periodos se vuelve a contar un artículo según su clase ABC
+CICLO_PERIODO_DEFAULT = 30
+CICLO_MULTIPLICADOR_ABC = {'A': 1, 'B': 2, 'C': 4}
+
+def count_rows_select(session_id, usuario, fecha):
+    """SELECT sobre articles con la forma de CONTEO_COLUMNAS, para INSERT ... SELECT"""
+    return select(
+        literal(session_id),
+        Article.id,
+        func.coalesce(Article.stock, 0),
+        literal('pendiente'),
+        literal(fecha, db.DateTime),
+        literal(usuario)
+    )
+
+def scope_int(valor, campo, minimo):
+    """Entero del alcance de un conteo; lanza ValueError con un mensaje para el cliente"""
+    try:
+        numero = int(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f'{campo} debe ser un número entero')
+    if numero < minimo:
+        raise ValueError(f'{campo} debe ser mayor o igual a {minimo}')
+    return numero
+
+def scope_list(valor):
+    """Acepta una lista o un texto separado por comas"""
+    if isinstance(valor, str):
+        return [parte.strip() for parte in valor.split(',') if parte.strip()]
+    if isinstance(valor, (list, tuple)):
+        return list(valor)
+    return [valor]
+
+def parse_count_scope(alcance):
+    """Normaliza el alcance de una sesión de conteo. Devuelve {} para el catálogo completo.
+
+    Claves: category_ids, article_ids, clase_abc, bajo_stock, sin_contar_dias,
+    limite y ciclico (con periodo_dias y por_abc). Los filtros se combinan con AND.
+    """
+    if not alcance:
+        return {}
+    if not isinstance(alcance, dict):
+        raise ValueError('El alcance debe ser un objeto')
+    
+    normalizado = {}
+    for clave in ('category_ids', 'article_ids'):
+        if alcance.get(clave):
+            normalizado[clave] = [scope_int(valor, clave, 1) for valor in scope_list(alcance[clave])]
+    if alcance.get('clase_abc'):
+        clases = [str(clase).upper() for clase in scope_list(alcance['clase_abc'])]
+        if any(clase not in CICLO_MULTIPLICADOR_ABC for clase in clases):
+            raise ValueError('clase_abc debe contener solo A, B o C')
+        normalizado['clase_abc'] = clases
+    if alcance.get('bajo_stock'):
+        normalizado['bajo_stock'] = True
+    if alcance.get('sin_contar_dias') is not None:
+        normalizado['sin_contar_dias'] = scope_int(alcance['sin_contar_dias'], 'sin_contar_dias', 1)
+    if alcance.get('limite') is not None:
+        normalizado['limite'] = scope_int(alcance['limite'], 'limite', 1)
+    if alcance.get('ciclico'):
+        normalizado['ciclico'] = True
+        normalizado['periodo_dias'] = scope_int(alcance.get('periodo_dias', CICLO_PERIODO_DEFAULT), 'periodo_dias', 1)
+        normalizado['por_abc'] = bool(alcance.get('por_abc', True))
+    return normalizado
+
+def last_count_subquery():
+    """Fecha del último conteo registrado de cada artículo (incluye las filas archivadas)"""
+    conteos = union_all(*[
+        select(modelo.article_id, modelo.fecha_conteo).where(modelo.estado.in_(['contado', 'ajustado']))
+        for modelo in (PhysicalInventory, PhysicalInventoryArchive)
+    ]).subquery()
+    return select(
+        conteos.c.article_id,
+        func.max(conteos.c.fecha_conteo).label('ultimo_conteo')
+    ).group_by(conteos.c.article_id).subquery()
+
+def cycle_due_condition(ultimo_conteo, periodo_dias, por_abc, ahora):
+    """Artículos a los que ya les toca conteo cíclico (nunca contados o con el ciclo vencido).
+
+    Los artículos sin clasificar se tratan como clase A.
+    """
+    if not por_abc:
+        return or_(ultimo_conteo.is_(None), ultimo_conteo <= ahora - timedelta(days=periodo_dias))
+    clase = func.coalesce(ArticleClassification.clase_abc, 'A')
+    return or_(ultimo_conteo.is_(None), *[
+        and_(clase == letra, ultimo_conteo <= ahora - timedelta(days=periodo_dias * multiplicador))
+        for letra, multiplicador in CICLO_MULTIPLICADOR_ABC.items()
+    ])
+
+def cycle_daily_quota(periodo_dias, por_abc):
+    """Artículos a contar por día para recorrer el catálogo activo en su ciclo"""
+    if not por_abc:
+        activos = db.session.query(func.count(Article.id)).filter(Article.activo == True).scalar()
+        return -(-activos // periodo_dias)
+    clase = func.coalesce(ArticleClassification.clase_abc, 'A')
+    por_clase = db.session.query(clase, func.count(Article.id)).outerjoin(
+        ArticleClassification, ArticleClassification.article_id == Article.id
+    ).filter(Article.activo == True).group_by(clase).all()
+    diaria = sum(cantidad / (periodo_dias * CICLO_MULTIPLICADOR_ABC.get(letra, 1)) for letra, cantidad in por_clase)
+    return int(np.ceil(diaria))
+
+def apply_count_scope(consulta, alcance, ahora, con_limite=True):
+    """Aplica el alcance normalizado a un SELECT sobre articles (solo artículos activos)"""
+    consulta = consulta.where(Article.activo == True)
+    if 'category_ids' in alcance:
+        consulta = consulta.where(Article.category_id.in_(alcance['category_ids']))
+    if 'article_ids' in alcance:
+        consulta = consulta.where(Article.id.in_(alcance['article_ids']))
+    if alcance.get('bajo_stock'):
+        consulta = consulta.where(Article.stock <= Article.stock_minimo)
+    
+    ciclico = alcance.get('ciclico', False)
+    if 'clase_abc' in alcance or (ciclico and alcance['por_abc']):
+        consulta = consulta.outerjoin(ArticleClassification, ArticleClassification.article_id == Article.id)
+    if 'clase_abc' in alcance:
+        consulta = consulta.where(ArticleClassification.clase_abc.in_(alcance['clase_abc']))
+    
+    if 'sin_contar_dias' in alcance or ciclico:
+        # Primero los nunca contados y luego los de conteo más antiguo
+        ultimos = last_count_subquery()
+        consulta = consulta.outerjoin(ultimos, ultimos.c.article_id == Article.id)
+        if 'sin_contar_dias' in alcance:
+            limite_fecha = ahora - timedelta(days=alcance['sin_contar_dias'])
+            consulta = consulta.where(or_(ultimos.c.ultimo_conteo.is_(None), ultimos.c.ultimo_conteo < limite_fecha))
+        if ciclico:
+            consulta = consulta.where(cycle_due_condition(ultimos.c.ultimo_conteo, alcance['periodo_dias'], alcance['por_abc'], ahora))
+        consulta = consulta.order_by(ultimos.c.ultimo_conteo.asc().nulls_first(), Article.id)
+    else:
+        consulta = consulta.order_by(Article.id)
+    
+    if con_limite:
+        limite = alcance.get('limite')
+        if limite is None and ciclico:
+            limite = cycle_daily_quota(alcance['periodo_dias'], alcance['por_abc'])
+        if limite is not None:
+            consulta = consulta.limit(limite)
+    return consulta
+
+def materialize_count_row(session_id, article_id, usuario):
+    """Crea la fila de conteo de un artículo en una sesión diferida con su stock actual.
+
+    Es un solo INSERT ... SELECT ... WHERE NOT EXISTS, así dos lecturas
+    simultáneas del mismo artículo no generan filas duplicadas.
+    """
+    ya_existe = exists().where(
+        PhysicalInventory.conteo_session_id == session_id,
+        PhysicalInventory.article_id == article_id
+    )
+    db.session.execute(
+        insert(PhysicalInventory.__table__).from_select(
+            CONTEO_COLUMNAS,
+            count_rows_select(session_id, usuario, datetime.utcnow()).where(Article.id == article_id, ~ya_existe)
+        )
+    )
+    return PhysicalInventory.query.filter_by(conteo_session_id=session_id, article_id=article_id).first()
+
+def register_count(conteo, cantidad_fisica, notas):
+    """Guarda la cantidad contada de una fila de conteo.
+
+    cantidad_sistema y fecha_conteo pasan a ser el stock y el momento del
+    conteo: el ajuste reaplica los movimientos posteriores a esa fecha.
+    """
+    conteo.cantidad_sistema = conteo.article.stock or 0
+    conteo.fecha_conteo = datetime.utcnow()
+    conteo.cantidad_fisica = float(cantidad_fisica)
+    conteo.calculate_difference()  # Calcula automáticamente la diferencia
+    conteo.estado = 'contado'
+    conteo.notas = notas
+
+def refresh_session_summary(session_id):
+    """Recalcula los contadores de la cabecera de la sesión tras registrar conteos o ajustes"""
+    db.session.flush()
+    db.session.execute(
+        update(PhysicalInventorySession.__table__)
+            .where(PhysicalInventorySession.__table__.c.id == session_id)
+            .values(**session_summary_values())
+    )
+
 @app.route('/physical-inventory/start', methods=['POST'])
 @login_required
 def start_physical_inventory():
-    """Inicia una nueva sesión de conteo físico"""
+    """Inicia una nueva sesión de conteo físico.
+
+    En modo 'completo' copia el stock de los artículos del alcance con un
+    solo INSERT ... SELECT; en modo 'diferido' (solo catálogo completo) crea
+    la cabecera y cada fila se crea al contar el artículo.
+    """
     try:
-        import uuid
+        data = request.get_json(silent=True) or {}
+        modo = 'diferido' if data.get('diferido') else data.get('modo', 'completo')
+        if modo not in PHYSICAL_INVENTORY_MODOS:
+            return jsonify({'error': f"Modo inválido. Use: {', '.join(PHYSICAL_INVENTORY_MODOS)}"}), 400
+        try:
+            alcance = parse_count_scope(data.get('alcance'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if alcance and modo == 'diferido':
+            return jsonify({'error': 'El modo diferido solo aplica al catálogo completo'}), 400
         
         # Generar ID único para la sesión de conteo
         session_id = str(uuid.uuid4())
-        
-        # Obtener todos los productos activos
-        products = Article.query.filter(Article.activo == True).all()
-        
-        if not products:
-            return jsonify({'error': 'No hay productos activos para contar'}), 400
-        
-        # Crear registros de conteo para todos los productos
-        conteos = []
-        for product in products:
-            conteo = PhysicalInventory(
-                conteo_session_id=session_id,
-                article_id=product.id,
-                cantidad_sistema=product.stock,
-                usuario_conteo=session.get('username', 'Desconocido'),
-                estado='pendiente'
+        usuario = session.get('username', 'Desconocido')
+        ahora = datetime.utcnow()
+        
+        if modo == 'completo':
+            resultado = db.session.execute(
+                insert(PhysicalInventory.__table__).from_select(
+                    CONTEO_COLUMNAS,
+                    apply_count_scope(count_rows_select(session_id, usuario, ahora), alcance, ahora)
+                )
             )
-            conteos.append(conteo)
-            db.session.add(conteo)
-        
+            total_productos = resultado.rowcount
+        else:
+            total_productos = db.session.query(func.count(Article.id)).filter(Article.activo == True).scalar()
+        
+        if not total_productos:
+            db.session.rollback()
+            mensaje = 'No hay productos en el alcance indicado' if alcance else 'No hay productos activos para contar'
+            return jsonify({'error': mensaje}), 400
+        
+        db.session.add(PhysicalInventorySession(
+            id=session_id,
+            modo=modo,
+            total_productos=total_productos,
+            fecha_inicio=ahora,
+            usuario_conteo=usuario,
+            user_id=session.get('user_id'),
+            alcance=json.dumps(alcance) if alcance else None,
+            contados=0,
+            ajustados=0,
+            con_diferencias=0,
+            compactada=False,
+            filas_archivadas=0
+        ))
         db.session.commit()
         
         return jsonify({
             'message': 'Sesión de conteo físico iniciada',
             'session_id': session_id,
-            'total_products': len(conteos)
+            'modo': modo,
+            'alcance': alcance or None,
+            'total_products': total_productos
         }), 201
         
     except Exception as e:
@@ -1159,33 +1662,116 @@ def start_physical_inventory():
         print(f"Error al iniciar conteo físico: {str(e)}")
         return jsonify({'error': 'Error al iniciar conteo físico'}), 500
 
+CONTEO_PAGINA_DEFAULT = 100
+
+def session_rows_query(session_id, cabecera):
+    """Consulta (PhysicalInventory, Article) de una sesión con el artículo en el mismo JOIN.
+
+    En sesiones diferidas parte de articles: los activos sin fila aparecen con
+    PhysicalInventory en None, más los ya contados aunque se hayan desactivado.
+    En sesiones compactadas solo quedan las filas con diferencia.
+    """
+    if cabecera is not None and cabecera.diferida and not cabecera.compactada:
+        return db.session.query(PhysicalInventory, Article).select_from(Article).outerjoin(
+            PhysicalInventory, and_(
+                PhysicalInventory.article_id == Article.id,
+                PhysicalInventory.conteo_session_id == session_id
+            )
+        ).filter(or_(Article.activo == True, PhysicalInventory.id.isnot(None)))
+    return db.session.query(PhysicalInventory, Article).join(
+        Article, Article.id == PhysicalInventory.article_id
+    ).filter(PhysicalInventory.conteo_session_id == session_id)
+
+def session_count_stats(query):
+    """Estadísticas de la sesión con una sola consulta agregada"""
+    fila = query.order_by(None).with_entities(
+        func.count(Article.id),
+        func.coalesce(func.sum(case((PhysicalInventory.estado == 'contado', 1), else_=0)), 0),
+        func.coalesce(func.sum(case((PhysicalInventory.estado == 'ajustado', 1), else_=0)), 0),
+        func.coalesce(func.sum(case((func.abs(PhysicalInventory.diferencia) > 0.01, 1), else_=0)), 0)
+    ).one()
+    total_productos, contados, ajustados, con_diferencias = fila
+    return {
+        'total_productos': total_productos,
+        'contados': contados,
+        'ajustados': ajustados,
+        'pendientes': total_productos - contados,
+        'con_diferencias': con_diferencias,
+        'progreso': round((contados / total_productos) * 100, 2) if total_productos > 0 else 0
+    }
+
+def header_count_stats(cabecera):
+    """Estadísticas desde los contadores de la cabecera (sesiones compactadas)"""
+    total_productos = cabecera.total_productos
+    contados = cabecera.contados or 0
+    return {
+        'total_productos': total_productos,
+        'contados': contados,
+        'ajustados': cabecera.ajustados or 0,
+        'pendientes': total_productos - contados,
+        'con_diferencias': cabecera.con_diferencias or 0,
+        'progreso': round((contados / total_productos) * 100, 2) if total_productos > 0 else 0
+    }
+
 @app.route('/physical-inventory/<session_id>', methods=['GET'])
 @login_required
 def get_physical_inventory_session(session_id):
-    """Obtiene todos los productos de una sesión de conteo"""
+    """Obtiene los productos de una sesión de conteo y sus estadísticas.
+
+    Filtros opcionales: pendientes=1, con_diferencias=1, category_id y estado.
+    Con page/per_page la lista se pagina; sin ellos se devuelve completa.
+    """
     try:
-        conteos = PhysicalInventory.query.filter(
-            PhysicalInventory.conteo_session_id == session_id
-        ).order_by(PhysicalInventory.article_id).all()
+        flush_scans(session_id)
+        cabecera = db.session.get(PhysicalInventorySession, session_id)
+        base = session_rows_query(session_id, cabecera)
         
-        if not conteos:
+        # Las estadísticas son de toda la sesión, sin los filtros de la lista
+        if cabecera is not None and cabecera.compactada:
+            estadisticas = header_count_stats(cabecera)
+        else:
+            estadisticas = session_count_stats(base)
+        if not estadisticas['total_productos']:
             return jsonify({'error': 'Sesión de conteo no encontrada'}), 404
         
-        # Calcular estadísticas
-        total_productos = len(conteos)
-        contados = len([c for c in conteos if c.estado == 'contado'])
-        con_diferencias = len([c for c in conteos if c.diferencia is not None and abs(c.diferencia) > 0.01])
-        
-        return jsonify({
-            'conteos': [conteo.to_dict() for conteo in conteos],
-            'estadisticas': {
-                'total_productos': total_productos,
-                'contados': contados,
-                'pendientes': total_productos - contados,
-                'con_diferencias': con_diferencias,
-                'progreso': round((contados / total_productos) * 100, 2) if total_productos > 0 else 0
+        query = base
+        if request.args.get('pendientes') in ('1', 'true'):
+            query = query.filter(or_(PhysicalInventory.id.is_(None), PhysicalInventory.estado == 'pendiente'))
+        if request.args.get('con_diferencias') in ('1', 'true'):
+            query = query.filter(func.abs(PhysicalInventory.diferencia) > 0.01)
+        category_id = request.args.get('category_id', type=int)
+        if category_id:
+            query = query.filter(Article.category_id == category_id)
+        estado = request.args.get('estado')
+        if estado == 'pendiente':
+            query = query.filter(or_(PhysicalInventory.id.is_(None), PhysicalInventory.estado == 'pendiente'))
+        elif estado:
+            query = query.filter(PhysicalInventory.estado == estado)
+        query = query.order_by(Article.id)
+        
+        respuesta = {'estadisticas': estadisticas}
+        if 'page' in request.args or 'per_page' in request.args:
+            page = max(request.args.get('page', 1, type=int), 1)
+            per_page = min(max(request.args.get('per_page', CONTEO_PAGINA_DEFAULT, type=int), 1), KEYSET_MAX_LIMIT)
+            total = query.order_by(None).with_entities(func.count(Article.id)).scalar()
+            filas = query.limit(per_page).offset((page - 1) * per_page).all()
+            respuesta['pagination'] = {
+                'page': page,
+                'pages': -(-total // per_page),
+                'per_page': per_page,
+                'total': total
             }
-        })
+        else:
+            filas = query.all()
+        
+        # conteo.article se resuelve desde el mapa de identidad: el artículo ya vino en el JOIN
+        fecha_pendiente = cabecera.fecha_inicio if cabecera is not None else None
+        respuesta['conteos'] = [
+            conteo.to_dict() if conteo is not None
+            else PhysicalInventory.pending_dict(session_id, article, fecha_pendiente)
+            for conteo, article in filas
+        ]
+        return jsonify(respuesta)
         
     except Exception as e:
         print(f"Error al obtener sesión de conteo: {str(e)}")
@@ -1206,10 +1792,44 @@ def update_physical_count(conteo_id):
         conteo = PhysicalInventory.query.get_or_404(conteo_id)
         
         # Actualizar los datos del conteo
-        conteo.cantidad_fisica = float(cantidad_fisica)
-        conteo.calculate_difference()  # Calcula automáticamente la diferencia
-        conteo.estado = 'contado'
-        conteo.notas = notas
+        register_count(conteo, cantidad_fisica, notas)
+        refresh_session_summary(conteo.conteo_session_id)
+        
+        db.session.commit()
+        
+        return jsonify({
+            'message': 'Conteo actualizado exitosamente',
+            'conteo': conteo.to_dict()
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al actualizar conteo: {str(e)}")
+        return jsonify({'error': 'Error al actualizar conteo'}), 500
+
+@app.route('/physical-inventory/<session_id>/articles/<int:article_id>', methods=['PUT'])
+@login_required
+def update_physical_count_by_article(session_id, article_id):
+    """Registra el conteo de un artículo dentro de una sesión; en sesiones diferidas crea la fila al primer conteo"""
+    try:
+        data = request.get_json()
+        cantidad_fisica = data.get('cantidad_fisica')
+        notas = data.get('notas', '')
+        
+        if cantidad_fisica is None or cantidad_fisica < 0:
+            return jsonify({'error': 'Cantidad física debe ser mayor o igual a 0'}), 400
+        
+        conteo = PhysicalInventory.query.filter_by(conteo_session_id=session_id, article_id=article_id).first()
+        if conteo is None:
+            cabecera = db.session.get(PhysicalInventorySession, session_id)
+            if cabecera is None or not cabecera.diferida:
+                return jsonify({'error': 'El artículo no pertenece a la sesión de conteo'}), 404
+            conteo = materialize_count_row(session_id, article_id, session.get('username', 'Desconocido'))
+            if conteo is None:
+                return jsonify({'error': 'Artículo no encontrado'}), 404
+        
+        register_count(conteo, cantidad_fisica, notas)
+        refresh_session_summary(session_id)
         
         db.session.commit()
         
@@ -1223,6 +1843,468 @@ def update_physical_count(conteo_id):
         print(f"Error al actualizar conteo: {str(e)}")
         return jsonify({'error': 'Error al actualizar conteo'}), 500
 
+CONTEO_LOTE_MAX = 5000  # Entradas por llamada a /physical-inventory/<session>/counts
+SCAN_VENTANA_SEGUNDOS = 0.5  # Las lecturas del escáner se agrupan en un commit por ventana
+
+def count_batch_entry(entrada):
+    """Valida una entrada del lote: (referencia, cantidad_fisica, incremento, notas) o None si es inválida"""
+    if not isinstance(entrada, dict):
+        return None
+    if entrada.get('conteo_id') is not None:
+        referencia = ('conteo_id', entrada['conteo_id'])
+    elif entrada.get('article_id') is not None:
+        referencia = ('article_id', entrada['article_id'])
+    elif entrada.get('codigo_barra'):
+        referencia = ('codigo_barra', str(entrada['codigo_barra']).strip())
+    else:
+        return None
+    try:
+        if referencia[0] != 'codigo_barra':
+            referencia = (referencia[0], int(referencia[1]))
+        cantidad = entrada.get('cantidad_fisica')
+        cantidad = float(cantidad) if cantidad is not None else None
+        incremento = float(entrada.get('incremento', 0 if cantidad is not None else 1))
+    except (TypeError, ValueError):
+        return None
+    if cantidad is not None and cantidad < 0:
+        return None
+    return referencia, cantidad, incremento, entrada.get('notas')
+
+def resolve_count_rows(session_id, referencias, usuario):
+    """Resuelve referencias a filas de conteo de la sesión: {(tipo, valor): (conteo_id, estado)}.
+
+    En sesiones diferidas crea de una vez, con INSERT ... SELECT, las filas de
+    los artículos referenciados que aún no tienen una.
+    """
+    conteo_ids = {valor for tipo, valor in referencias if tipo == 'conteo_id'}
+    article_ids = {valor for tipo, valor in referencias if tipo == 'article_id'}
+    codigos = {valor for tipo, valor in referencias if tipo == 'codigo_barra'}
+    
+    def buscar():
+        filas = {}
+        if conteo_ids:
+            for row_id, estado in db.session.query(PhysicalInventory.id, PhysicalInventory.estado).filter(
+                PhysicalInventory.conteo_session_id == session_id,
+                PhysicalInventory.id.in_(conteo_ids)
+            ):
+                filas[('conteo_id', row_id)] = (row_id, estado)
+        if article_ids or codigos:
+            for row_id, estado, article_id, codigo in db.session.query(
+                PhysicalInventory.id, PhysicalInventory.estado, Article.id, Article.codigo_barra
+            ).join(Article, Article.id == PhysicalInventory.article_id).filter(
+                PhysicalInventory.conteo_session_id == session_id,
+                or_(Article.id.in_(article_ids), Article.codigo_barra.in_(codigos))
+            ):
+                filas[('article_id', article_id)] = (row_id, estado)
+                if codigo:
+                    filas[('codigo_barra', codigo)] = (row_id, estado)
+        return filas
+    
+    filas = buscar()
+    faltantes = [(tipo, valor) for tipo, valor in referencias if tipo != 'conteo_id' and (tipo, valor) not in filas]
+    if faltantes:
+        cabecera = db.session.get(PhysicalInventorySession, session_id)
+        if cabecera is not None and cabecera.diferida:
+            ya_existe = exists().where(
+                PhysicalInventory.conteo_session_id == session_id,
+                PhysicalInventory.article_id == Article.id
+            )
+            db.session.execute(
+                insert(PhysicalInventory.__table__).from_select(
+                    CONTEO_COLUMNAS,
+                    count_rows_select(session_id, usuario, datetime.utcnow()).where(
+                        or_(
+                            Article.id.in_([valor for tipo, valor in faltantes if tipo == 'article_id']),
+                            Article.codigo_barra.in_([valor for tipo, valor in faltantes if tipo == 'codigo_barra'])
+                        ),
+                        ~ya_existe
+                    )
+                )
+            )
+            filas = buscar()
+    return filas
+
+def apply_count_batch(session_id, entradas, usuario):
+    """Aplica un lote de conteos con un solo UPDATE ejecutado por lotes (executemany).
+
+    Cada entrada referencia la fila por conteo_id, article_id o codigo_barra y
+    trae cantidad_fisica (fija el valor) y/o incremento (suma sobre lo contado,
+    una lectura del escáner = +1). Las entradas de una misma fila se combinan en
+    orden. Como en register_count, cantidad_sistema y fecha_conteo quedan en
+    el stock y el momento del lote; la diferencia se calcula en SQL contra
+    ese stock. Devuelve un estado por entrada:
+    'ok', 'invalido', 'no_encontrado' o 'ajustado' (la fila ya se ajustó).
+    """
+    validas = [count_batch_entry(entrada) for entrada in entradas]
+    filas = resolve_count_rows(session_id, {valida[0] for valida in validas if valida}, usuario)
+    
+    estados = []
+    cambios = {}  # conteo_id -> {'base', 'delta', 'nota'}
+    for valida in validas:
+        if valida is None:
+            estados.append({'estado': 'invalido'})
+            continue
+        referencia, cantidad, incremento, notas = valida
+        fila = filas.get(referencia)
+        if fila is None:
+            estados.append({'estado': 'no_encontrado', referencia[0]: referencia[1]})
+            continue
+        conteo_id, estado = fila
+        if estado == 'ajustado':
+            estados.append({'estado': 'ajustado', 'id': conteo_id})
+            continue
+        cambio = cambios.setdefault(conteo_id, {'conteo_id': conteo_id, 'base': None, 'delta': 0.0, 'nota': None})
+        if cantidad is not None:
+            cambio['base'] = cantidad
+            cambio['delta'] = 0.0
+        cambio['delta'] += incremento
+        if notas is not None:
+            cambio['nota'] = notas
+        estados.append({'estado': 'ok', 'id': conteo_id})
+    
+    if cambios:
+        tabla = PhysicalInventory.__table__
+        nueva = func.coalesce(bindparam('base', type_=db.Float), func.coalesce(tabla.c.cantidad_fisica, 0)) + bindparam('delta', type_=db.Float)
+        stock_actual = select(func.coalesce(Article.stock, 0)).where(Article.id == tabla.c.article_id).scalar_subquery()
+        db.session.execute(
+            update(tabla).where(tabla.c.id == bindparam('conteo_id')).values(
+                cantidad_fisica=nueva,
+                cantidad_sistema=stock_actual,
+                diferencia=nueva - stock_actual,
+                fecha_conteo=datetime.utcnow(),
+                estado='contado',
+                notas=func.coalesce(bindparam('nota', type_=db.Text), tabla.c.notas)
+            ),
+            list(cambios.values())
+        )
+        finales = {row_id: (cantidad, diferencia) for row_id, cantidad, diferencia in db.session.query(
+            PhysicalInventory.id, PhysicalInventory.cantidad_fisica, PhysicalInventory.diferencia
+        ).filter(PhysicalInventory.id.in_(list(cambios)))}
+        for estado in estados:
+            if estado['estado'] == 'ok':
+                estado['cantidad_fisica'], estado['diferencia'] = finales[estado['id']]
+        refresh_session_summary(session_id)
+    return estados
+
+@app.route('/physical-inventory/<session_id>/counts', methods=['POST'])
+@login_required
+def submit_physical_counts(session_id):
+    """Registra muchos conteos en una sola transacción (lectores de código de barras, carga masiva)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        entradas = data.get('conteos')
+        if not isinstance(entradas, list) or not entradas:
+            return jsonify({'error': 'Debe enviar una lista de conteos'}), 400
+        if len(entradas) > CONTEO_LOTE_MAX:
+            return jsonify({'error': f'Máximo {CONTEO_LOTE_MAX} conteos por lote'}), 400
+        
+        flush_scans(session_id)
+        resultados = apply_count_batch(session_id, entradas, session.get('username', 'Desconocido'))
+        db.session.commit()
+        
+        procesados = sum(1 for resultado in resultados if resultado['estado'] == 'ok')
+        return jsonify({
+            'message': f'{procesados} conteos registrados',
+            'procesados': procesados,
+            'errores': len(resultados) - procesados,
+            'resultados': resultados
+        })
+        
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al registrar lote de conteos: {str(e)}")
+        return jsonify({'error': 'Error al registrar lote de conteos'}), 500
+
+# Lecturas del escáner pendientes por sesión: {session_id: {'codigos': {codigo: incremento}, 'usuario', 'timer'}}
+scan_buffer = {}
+scan_rechazados = {}  # Códigos no encontrados en ventanas ya aplicadas, hasta informarlos
+scan_fallos = {}  # Ventanas que no se pudieron aplicar (reintentadas o descartadas), hasta informarlas
+SCAN_FALLOS_MAX = 20  # Fallos recientes que se conservan por sesión
+SCAN_INTENTOS_MAX = 3  # Intentos de aplicar una ventana antes de descartarla
+scan_lock = threading.Lock()
+
+def schedule_scans(session_id, usuario):
+    """Entrada pendiente de la sesión; si no existe la crea y programa su commit (llamar con scan_lock tomado)"""
+    pendiente = scan_buffer.get(session_id)
+    if pendiente is None:
+        temporizador = threading.Timer(SCAN_VENTANA_SEGUNDOS, flush_scans_job, args=(session_id,))
+        temporizador.daemon = True
+        pendiente = scan_buffer[session_id] = {'codigos': {}, 'usuario': usuario, 'timer': temporizador, 'intentos': 0}
+        temporizador.start()
+    return pendiente
+
+def queue_scan(session_id, codigo, cantidad, usuario):
+    """Acumula una lectura; la primera de una ventana programa el commit del grupo"""
+    with scan_lock:
+        pendiente = schedule_scans(session_id, usuario)
+        pendiente['codigos'][codigo] = pendiente['codigos'].get(codigo, 0) + cantidad
+        return sum(pendiente['codigos'].values())
+
+def requeue_scans(session_id, lote, error):
+    """Devuelve al buffer una ventana que no se pudo aplicar y deja registro del fallo.
+
+    Tras SCAN_INTENTOS_MAX intentos la ventana se descarta: sus lecturas quedan
+    en el fallo informado al cliente para que las reenvíe, y las lecturas
+    nuevas ya no esperan detrás de ella.
+    """
+    intentos = lote['intentos'] + 1
+    fallo = {
+        'error': str(error),
+        'lecturas': sum(lote['codigos'].values()),
+        'intentos': intentos,
+        'descartadas': None,
+        'fecha': datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    }
+    with scan_lock:
+        if intentos >= SCAN_INTENTOS_MAX:
+            fallo['descartadas'] = dict(lote['codigos'])
+        else:
+            pendiente = schedule_scans(session_id, lote['usuario'])
+            for codigo, cantidad in lote['codigos'].items():
+                pendiente['codigos'][codigo] = pendiente['codigos'].get(codigo, 0) + cantidad
+            pendiente['intentos'] = max(pendiente['intentos'], intentos)
+        fallos = scan_fallos.setdefault(session_id, [])
+        fallos.append(fallo)
+        del fallos[:-SCAN_FALLOS_MAX]
+
+def flush_scans(session_id):
+    """Aplica y confirma en una transacción las lecturas pendientes de la sesión.
+
+    Las lecturas salen del buffer solo si el commit funciona; si falla vuelven a
+    él (hasta SCAN_INTENTOS_MAX intentos) y el error se propaga.
+    """
+    with scan_lock:
+        pendiente = scan_buffer.pop(session_id, None)
+    if not pendiente:
+        return []
+    pendiente['timer'].cancel()
+    entradas = [{'codigo_barra': codigo, 'incremento': cantidad} for codigo, cantidad in pendiente['codigos'].items()]
+    try:
+        resultados = apply_count_batch(session_id, entradas, pendiente['usuario'])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        requeue_scans(session_id, pendiente, e)
+        raise
+    rechazados = [entrada['codigo_barra'] for entrada, resultado in zip(entradas, resultados) if resultado['estado'] != 'ok']
+    if rechazados:
+        with scan_lock:
+            scan_rechazados.setdefault(session_id, []).extend(rechazados)
+    return resultados
+
+def flush_scans_job(session_id):
+    with app.app_context():
+        try:
+            flush_scans(session_id)
+        except Exception as e:
+            print(f"❌ Error aplicando lecturas del escáner de la sesión {session_id}: {e}")
+        finally:
+            db.session.remove()
+
+@app.route('/physical-inventory/<session_id>/scan', methods=['POST'])
+@login_required
+def scan_physical_count(session_id):
+    """Suma una lectura del escáner (+cantidad, por defecto 1) al conteo del artículo.
+
+    Las lecturas se agrupan durante SCAN_VENTANA_SEGUNDOS y se aplican con un
+    solo commit; con inmediato=true se aplican en el momento y se devuelve el
+    resultado.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        codigo = str(data.get('codigo_barra') or '').strip()
+        try:
+            cantidad = float(data.get('cantidad', 1))
+        except (TypeError, ValueError):
+            cantidad = None
+        if not codigo or cantidad is None:
+            return jsonify({'error': 'Debe enviar codigo_barra y una cantidad numérica'}), 400
+        
+        sesion_existe = db.session.get(PhysicalInventorySession, session_id) is not None or \
+            db.session.query(PhysicalInventory.id).filter_by(conteo_session_id=session_id).first() is not None
+        if not sesion_existe:
+            return jsonify({'error': 'Sesión de conteo no encontrada'}), 404
+        
+        pendientes = queue_scan(session_id, codigo, cantidad, session.get('username', 'Desconocido'))
+        resultados = flush_scans(session_id) if data.get('inmediato') else None
+        with scan_lock:
+            rechazados = scan_rechazados.pop(session_id, [])
+            fallos = scan_fallos.pop(session_id, [])
+        
+        if resultados is not None:
+            return jsonify({'pendientes': 0, 'rechazados': rechazados, 'fallos': fallos, 'resultados': resultados})
+        
+        return jsonify({'pendientes': pendientes, 'rechazados': rechazados, 'fallos': fallos}), 202
+        
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al registrar lectura: {str(e)}")
+        return jsonify({'error': 'Error al registrar lectura'}), 500
+
+@app.route('/physical-inventory/cycle-plan', methods=['GET'])
+@login_required
+def get_cycle_count_plan():
+    """Plan de conteo cíclico: cuántos artículos contar por día y cuáles tocan hoy.
+
+    Con por_abc=1 (por defecto) los artículos A se cuentan cada periodo, los B
+    cada dos y los C cada cuatro; los sin clasificar se tratan como A.
+    """
+    try:
+        try:
+            alcance = parse_count_scope({
+                'ciclico': True,
+                'periodo_dias': request.args.get('periodo_dias', CICLO_PERIODO_DEFAULT),
+                'por_abc': request.args.get('por_abc', '1') not in ('0', 'false'),
+                'category_ids': request.args.get('category_ids')
+            })
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        ahora = datetime.utcnow()
+        cuota = cycle_daily_quota(alcance['periodo_dias'], alcance['por_abc'])
+        vencidos = db.session.execute(
+            select(func.count()).select_from(
+                apply_count_scope(select(Article.id), alcance, ahora, con_limite=False).subquery()
+            )
+        ).scalar()
+        ids_hoy = [row_id for (row_id,) in db.session.execute(
+            apply_count_scope(select(Article.id), dict(alcance, limite=cuota), ahora)
+        )] if cuota else []
+        
+        ultimos = last_count_subquery()
+        detalle = {row.id: row for row in db.session.query(
+            Article.id, Article.title, Article.stock, ArticleClassification.clase_abc, ultimos.c.ultimo_conteo
+        ).outerjoin(
+            ArticleClassification, ArticleClassification.article_id == Article.id
+        ).outerjoin(
+            ultimos, ultimos.c.article_id == Article.id
+        ).filter(Article.id.in_(ids_hoy)).all()} if ids_hoy else {}
+        
+        return jsonify({
+            'periodo_dias': alcance['periodo_dias'],
+            'por_abc': alcance['por_abc'],
+            'cuota_diaria': cuota,
+            'vencidos': vencidos,
+            'dias_para_ponerse_al_dia': -(-vencidos // cuota) if cuota else 0,
+            'alcance_sugerido': {'ciclico': True, 'periodo_dias': alcance['periodo_dias'], 'por_abc': alcance['por_abc']},
+            'articulos_hoy': [{
+                'article_id': row_id,
+                'article_title': detalle[row_id].title,
+                'stock': detalle[row_id].stock,
+                'clase_abc': detalle[row_id].clase_abc,
+                'ultimo_conteo': detalle[row_id].ultimo_conteo.strftime('%Y-%m-%d %H:%M:%S') if detalle[row_id].ultimo_conteo else None
+            } for row_id in ids_hoy]
+        })
+        
+    except Exception as e:
+        print(f"Error al calcular plan de conteo cíclico: {str(e)}")
+        return jsonify({'error': 'Error al calcular plan de conteo cíclico'}), 500
+
+def movements_since_count(condiciones_lote):
+    """Movimiento neto de stock de cada fila del lote registrado después de su fecha_conteo.
+
+    Suma el ledger (ventas, devoluciones, pérdidas y sus anulaciones, ediciones
+    y otros ajustes) en una consulta agrupada para todo el lote, por el índice
+    (article_id, fecha, id) de stock_movements. Devuelve {conteo_id: neto}.
+    """
+    tabla = PhysicalInventory.__table__
+    lote = select(tabla.c.id, tabla.c.article_id, tabla.c.fecha_conteo).where(*condiciones_lote).subquery()
+    consulta = select(lote.c.id, func.sum(StockMovement.cantidad)).select_from(lote)\
+        .join(StockMovement, and_(StockMovement.article_id == lote.c.article_id,
+                                  StockMovement.fecha > lote.c.fecha_conteo))\
+        .group_by(lote.c.id)
+    return {conteo_id: neto for conteo_id, neto in db.session.execute(consulta) if neto}
+
+def apply_count_adjustments(session_id, user_id, conteo_ids=None):
+    """Ajusta el stock de las filas contadas con diferencia de la sesión (o solo de conteo_ids).
+
+    El stock nuevo es lo contado más los movimientos registrados después del
+    conteo, así se puede contar con la tienda vendiendo. Trabaja por conjuntos
+    en la transacción del llamador: un UPDATE marca las filas como ajustadas
+    (y toma el bloqueo de escritura), un UPDATE ... FROM fija articles.stock y
+    un INSERT por lotes registra el historial. Las filas del lote se eligen
+    primero y cada paso las toma por id.
+    """
+    tabla = PhysicalInventory.__table__
+    ahora = datetime.utcnow()
+    condiciones = [
+        tabla.c.conteo_session_id == session_id,
+        tabla.c.estado == 'contado',
+        func.abs(tabla.c.diferencia) > 0.01
+    ]
+    if conteo_ids is not None:
+        condiciones.append(tabla.c.id.in_(conteo_ids))
+    ids_lote = [row_id for (row_id,) in db.session.execute(select(tabla.c.id).where(*condiciones))]
+    if not ids_lote:
+        return []
+    del_lote = [tabla.c.id.in_(ids_lote)]
+    db.session.execute(update(tabla).where(*del_lote).values(estado='ajustado', fecha_ajuste=ahora))
+    
+    # Con el bloqueo tomado no entran ventas nuevas entre el cálculo y el UPDATE
+    movimientos = movements_since_count(del_lote)
+    if movimientos:
+        db.session.execute(
+            update(tabla).where(tabla.c.id == bindparam('conteo_id')).values(movimientos_posteriores=bindparam('neto')),
+            [{'conteo_id': conteo_id, 'neto': neto} for conteo_id, neto in movimientos.items()]
+        )
+    
+    filas = db.session.query(
+        PhysicalInventory.article_id, PhysicalInventory.cantidad_fisica, PhysicalInventory.diferencia,
+        PhysicalInventory.movimientos_posteriores, PhysicalInventory.notas,
+        Article.title, Article.stock, Article.unit_type, Article.precio, Article.margen_ganancia
+    ).join(Article, Article.id == PhysicalInventory.article_id).filter(*del_lote).order_by(PhysicalInventory.article_id).all()
+    
+    db.session.execute(
+        update(Article.__table__).where(
+            Article.__table__.c.id == tabla.c.article_id, *del_lote
+        ).values(stock=tabla.c.cantidad_fisica + func.coalesce(tabla.c.movimientos_posteriores, 0))
+    )
+    
+    historial = []
+    movimientos = []
+    ajustes = []
+    for fila in filas:
+        stock_nuevo = fila.cantidad_fisica + (fila.movimientos_posteriores or 0)
+        observation = f"Ajuste por conteo físico - Sesión: {session_id}"
+        if fila.movimientos_posteriores:
+            observation += f" - Movimientos posteriores al conteo: {fila.movimientos_posteriores:+g}"
+        if fila.notas:
+            observation += f" - Obs: {fila.notas}"
+        historial.append({
+            'article_id': fila.article_id,
+            'user_id': user_id,
+            'old_stock': fila.stock,
+            'new_stock': stock_nuevo,
+            'difference': stock_nuevo - fila.stock,
+            'observation': observation,
+            'timestamp': ahora
+        })
+        movimientos.append({
+            'article_id': fila.article_id,
+            'tipo': 'ajuste_conteo',
+            'cantidad': stock_nuevo - fila.stock,
+            'stock_resultante': stock_nuevo,
+            'referencia': session_id
+        })
+        ajustes.append({
+            'article_id': fila.article_id,
+            'article_title': fila.title,
+            'stock_anterior': fila.stock,
+            'stock_nuevo': stock_nuevo,
+            'diferencia': fila.diferencia,
+            'movimientos_posteriores': fila.movimientos_posteriores or 0,
+            'unit_type': fila.unit_type or 'unidades'
+        })
+    db.session.execute(insert(PhysicalCountHistory), with_local_date(historial, ahora))
+    record_stock_movements(movimientos, user_id, ahora)
+    record_count_rollups(local_date_hour(ahora)[0].replace(day=1), [
+        (fila.article_id, registro['difference'], article_unit_cost(fila.precio, fila.margen_ganancia))
+        for fila, registro in zip(filas, historial)
+    ])
+    refresh_session_summary(session_id)
+    print(f"📊 Ajuste por conteo físico: {len(ajustes)} productos en la sesión {session_id}")
+    return ajustes
+
 @app.route('/physical-inventory/<session_id>/adjust', methods=['POST'])
 @login_required
 def apply_inventory_adjustments(session_id):
@@ -1232,59 +2314,27 @@ def apply_inventory_adjustments(session_id):
         adjust_all = data.get('adjust_all', False)  # Si True, ajusta todos; si False, solo los seleccionados
         selected_ids = data.get('selected_ids', [])  # IDs específicos a ajustar
         
-        # Obtener conteos de la sesión
-        query = PhysicalInventory.query.filter(
+        # Incluir las lecturas del escáner que aún están en la ventana
+        flush_scans(session_id)
+        
+        # Verificar que la sesión tiene conteos por ajustar
+        query = db.session.query(PhysicalInventory.id).filter(
             PhysicalInventory.conteo_session_id == session_id,
             PhysicalInventory.estado == 'contado'
         )
-        
+        conteo_ids = None
         if not adjust_all and selected_ids:
-            query = query.filter(PhysicalInventory.id.in_(selected_ids))
+            conteo_ids = selected_ids
+            query = query.filter(PhysicalInventory.id.in_(conteo_ids))
         
-        conteos_a_ajustar = query.all()
-        
-        if not conteos_a_ajustar:
+        if query.first() is None:
             return jsonify({'error': 'No hay conteos válidos para ajustar'}), 400
         
-        ajustes_realizados = []
-        
-        for conteo in conteos_a_ajustar:
-            # Verificar que hay una diferencia significativa
-            if conteo.diferencia is None or abs(conteo.diferencia) <= 0.01:
-                continue
-                
-            # Actualizar el stock del artículo
-            article = conteo.article
-            stock_anterior = article.stock
-            article.stock = conteo.cantidad_fisica
-            
-            # Registrar en historial de conteo físico
-            observation = f"Ajuste por conteo físico - Sesión: {session_id}"
-            if conteo.notas:
-                observation += f" - Obs: {conteo.notas}"
-            
-            log_physical_count(
-                article_id=article.id,
-                user_id=session['user_id'],
-                old_stock=stock_anterior,
-                new_stock=article.stock,
-                observation=observation
-            )
-            
-            # Marcar el conteo como ajustado
-            conteo.estado = 'ajustado'
-            conteo.fecha_ajuste = datetime.utcnow()
-            
-            ajustes_realizados.append({
-                'article_id': article.id,
-                'article_title': article.title,
-                'stock_anterior': stock_anterior,
-                'stock_nuevo': article.stock,
-                'diferencia': conteo.diferencia,
-                'unit_type': getattr(article, 'unit_type', 'unidades')
-            })
+        # Solo se ajustan las filas con una diferencia significativa
+        ajustes_realizados = apply_count_adjustments(session_id, session['user_id'], conteo_ids)
         
         db.session.commit()
+        invalidate_stock_report()
         
         return jsonify({
             'message': f'Ajustes aplicados exitosamente a {len(ajustes_realizados)} productos',
@@ -1299,32 +2349,24 @@ def apply_inventory_adjustments(session_id):
 @app.route('/physical-inventory/sessions', methods=['GET'])
 @login_required
 def get_inventory_sessions():
-    """Obtiene el historial de sesiones de conteo físico"""
-    try:
-        # Obtener sesiones únicas con información resumida
-        sessions_data = db.session.query(
-            PhysicalInventory.conteo_session_id,
-            func.min(PhysicalInventory.fecha_conteo).label('fecha_conteo'),
-            func.min(PhysicalInventory.usuario_conteo).label('usuario_conteo'),
-            func.count(PhysicalInventory.id).label('total_productos'),
-            func.sum(case((PhysicalInventory.estado == 'contado', 1), else_=0)).label('contados'),
-            func.sum(case((PhysicalInventory.estado == 'ajustado', 1), else_=0)).label('ajustados'),
-            func.sum(case((func.abs(PhysicalInventory.diferencia) > 0.01, 1), else_=0)).label('con_diferencias')
-        ).group_by(
-            PhysicalInventory.conteo_session_id
-        ).order_by(func.min(PhysicalInventory.fecha_conteo).desc()).all()
+    """Obtiene el historial de sesiones de conteo físico desde el resumen de cada sesión"""
+    try:
+        cabeceras = PhysicalInventorySession.query.order_by(PhysicalInventorySession.fecha_inicio.desc()).all()
         
         sessions = []
-        for session in sessions_data:
+        for cabecera in cabeceras:
+            contados = cabecera.contados or 0
             sessions.append({
-                'session_id': session.conteo_session_id,
-                'fecha_conteo': session.fecha_conteo.strftime('%Y-%m-%d %H:%M:%S'),
-                'usuario_conteo': session.usuario_conteo,
-                'total_productos': session.total_productos,
-                'contados': session.contados,
-                'ajustados': session.ajustados,
-                'con_diferencias': session.con_diferencias,
-                'estado': 'Completado' if session.contados == session.total_productos else 'En progreso'
+                'session_id': cabecera.id,
+                'fecha_conteo': cabecera.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
+                'usuario_conteo': cabecera.usuario_conteo,
+                'total_productos': cabecera.total_productos,
+                'contados': contados,
+                'ajustados': cabecera.ajustados or 0,
+                'con_diferencias': cabecera.con_diferencias or 0,
+                'modo': cabecera.modo,
+                'compactada': bool(cabecera.compactada),
+                'estado': 'Completado' if contados == cabecera.total_productos else 'En progreso'
             })
         
         return jsonify({'sessions': sessions})
@@ -1333,30 +2375,431 @@ def get_inventory_sessions():
         print(f"Error al obtener sesiones: {str(e)}")
         return jsonify({'error': 'Error al obtener historial de sesiones'}), 500
 
+PHYSICAL_INVENTORY_RETENCION_DIAS = 90
+
+def compact_count_sessions(dias=PHYSICAL_INVENTORY_RETENCION_DIAS):
+    """Compacta las sesiones de conteo iniciadas hace más de `dias` días.
+
+    Las filas sin diferencia (pendientes o contadas igual al sistema) pasan a
+    physical_inventory_archive y se borran del detalle, que queda solo con las
+    filas con diferencia. Los contadores de la cabecera siguen incluyendo las
+    filas archivadas. Una transacción corta por sesión.
+    """
+    backfill_session_summaries()
+    limite = datetime.utcnow() - timedelta(days=dias)
+    sesiones = [session_id for (session_id,) in db.session.query(PhysicalInventorySession.id).filter(
+        PhysicalInventorySession.fecha_inicio < limite,
+        or_(PhysicalInventorySession.compactada.is_(None), PhysicalInventorySession.compactada == False)
+    ).order_by(PhysicalInventorySession.fecha_inicio)]
+    
+    detalle = PhysicalInventory.__table__
+    archivo = PhysicalInventoryArchive.__table__
+    columnas = [columna.name for columna in detalle.columns if columna.name in archivo.c]
+    archivadas = 0
+    for session_id in sesiones:
+        ahora = datetime.utcnow()
+        sin_diferencia = [
+            detalle.c.conteo_session_id == session_id,
+            or_(detalle.c.diferencia.is_(None), func.abs(detalle.c.diferencia) <= 0.01)
+        ]
+        db.session.execute(insert(archivo).from_select(
+            columnas + ['archivado_en'],
+            select(*[detalle.c[columna] for columna in columnas], literal(ahora, db.DateTime)).where(*sin_diferencia)
+        ))
+        movidas = db.session.execute(delete(detalle).where(*sin_diferencia)).rowcount
+        db.session.execute(
+            update(PhysicalInventorySession.__table__)
+                .where(PhysicalInventorySession.__table__.c.id == session_id)
+                .values(compactada=True, fecha_compactacion=ahora, filas_archivadas=movidas, **session_summary_values())
+        )
+        db.session.commit()
+        archivadas += movidas
+    
+    return {'sesiones': len(sesiones), 'filas_archivadas': archivadas, 'retencion_dias': dias}
+
+@app.cli.command('compact-physical-inventory')
+@click.option('--dias', default=PHYSICAL_INVENTORY_RETENCION_DIAS, show_default=True, help='Antigüedad mínima de las sesiones a compactar')
+def compact_physical_inventory_command(dias):
+    """Archiva las filas sin diferencia de las sesiones de conteo antiguas"""
+    resumen = compact_count_sessions(dias)
+    print(f"✅ Sesiones compactadas: {resumen['sesiones']} ({resumen['filas_archivadas']} filas archivadas)")
+
+@app.route('/physical-inventory/compact', methods=['POST'])
+@admin_required
+def compact_physical_inventory():
+    """Compacta las sesiones de conteo más antiguas que la retención indicada"""
+    try:
+        data = request.get_json(silent=True) or {}
+        dias = int(data.get('dias', PHYSICAL_INVENTORY_RETENCION_DIAS))
+        if dias < 1:
+            return jsonify({'error': 'La retención debe ser de al menos 1 día'}), 400
+        resumen = compact_count_sessions(dias)
+        return jsonify({'message': 'Sesiones compactadas', 'resumen': resumen})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al compactar sesiones de conteo: {str(e)}")
+        return jsonify({'error': 'Error al compactar sesiones de conteo'}), 500
+
 # =====================
-# DESCUENTOS Y PROMOCIONES
+# LEDGER DE STOCK
 # =====================
 
-@app.route('/discounts', methods=['GET'])
-@login_required
-def get_discounts():
-    """Obtiene todos los descuentos disponibles"""
+STOCK_SNAPSHOT_RETENCION_DIAS = 90
+STOCK_LEDGER_TOLERANCIA = 0.001
+
+def stock_movement(article, tipo, cantidad, referencia=None):
+    """Fila del ledger para un cambio ya aplicado a article.stock"""
+    return {
+        'article_id': article.id,
+        'tipo': tipo,
+        'cantidad': cantidad,
+        'stock_resultante': article.stock,
+        'referencia': str(referencia) if referencia is not None else None
+    }
+
+def record_stock_movements(movimientos, user_id=None, fecha=None):
+    """Agrega los movimientos de una operación al ledger con un solo INSERT por lotes.
+
+    Va en la transacción de la operación, así el ledger y articles.stock se
+    confirman juntos.
+    """
+    if not movimientos:
+        return
+    fecha = fecha or datetime.utcnow()
+    db.session.execute(insert(StockMovement), with_local_date(
+        [dict(movimiento, user_id=user_id, fecha=fecha) for movimiento in movimientos], fecha
+    ))
+    record_stock_alerts(movimientos, fecha)
+
+def stock_threshold_crossing(anterior, nuevo, minimo):
+    """Tipo de alerta si el cambio de stock anterior -> nuevo cruza el mínimo o llega a cero, o None"""
+    if nuevo <= 0 < anterior:
+        return 'sin_stock'
+    if nuevo <= minimo < anterior:
+        return 'bajo_minimo'
+    if anterior <= minimo < nuevo:
+        return 'repuesto'
+    return None
+
+def record_stock_alerts(movimientos, fecha):
+    """Emite las alertas de los movimientos que cruzan el stock mínimo, en la misma transacción"""
+    ids = {movimiento['article_id'] for movimiento in movimientos}
+    minimos = dict(db.session.query(Article.id, Article.stock_minimo).filter(Article.id.in_(ids)))
+    alertas = []
+    for movimiento in movimientos:
+        minimo = minimos.get(movimiento['article_id'])
+        if minimo is None or movimiento['tipo'] == 'alta':
+            continue
+        nuevo = movimiento['stock_resultante']
+        anterior = nuevo - movimiento['cantidad']
+        tipo = stock_threshold_crossing(anterior, nuevo, minimo)
+        if tipo:
+            alertas.append({
+                'article_id': movimiento['article_id'],
+                'tipo': tipo,
+                'stock_anterior': anterior,
+                'stock': nuevo,
+                'stock_minimo': minimo,
+                'movimiento_tipo': movimiento['tipo'],
+                'referencia': movimiento['referencia'],
+                'fecha': fecha
+            })
+    if alertas:
+        db.session.execute(insert(StockAlert), alertas)
+
+def last_movement_subquery(columna):
+    """`columna` del último movimiento del artículo de la fila exterior (correlacionada, por el índice)"""
+    return select(columna).where(StockMovement.article_id == Article.id)\
+        .order_by(StockMovement.fecha.desc(), StockMovement.id.desc()).limit(1).scalar_subquery()
+
+def ledger_stock_at(article_id, momento):
+    """Stock de un artículo en `momento` (naive UTC) según el ledger.
+
+    Devuelve (stock, origen, movimiento_id). Cada caso es una búsqueda en el
+    índice (article_id, fecha, id): el último movimiento hasta el momento, o si
+    no hay, el stock previo al primero posterior. Sin movimientos devuelve None.
+    """
+    base = db.session.query(StockMovement.id, StockMovement.cantidad, StockMovement.stock_resultante)\
+                     .filter(StockMovement.article_id == article_id)
+    previo = base.filter(StockMovement.fecha <= momento)\
+                 .order_by(StockMovement.fecha.desc(), StockMovement.id.desc()).first()
+    if previo:
+        return previo.stock_resultante, 'movimiento', previo.id
+    siguiente = base.filter(StockMovement.fecha > momento)\
+                    .order_by(StockMovement.fecha, StockMovement.id).first()
+    if siguiente:
+        return siguiente.stock_resultante - siguiente.cantidad, 'antes_del_primer_movimiento', siguiente.id
+    return None, 'sin_movimientos', None
+
+def take_stock_snapshot(retencion_dias=STOCK_SNAPSHOT_RETENCION_DIAS):
+    """Guarda la foto del stock de todos los artículos (un INSERT ... SELECT) y borra las fotos vencidas.
+
+    Los artículos no se eliminan (solo se desactivan), así cada foto cubre el
+    catálogo completo y las anteriores a la retención ya no se necesitan.
+    """
+    ahora = datetime.utcnow()
+    tomadas = db.session.execute(insert(StockSnapshot).from_select(
+        ['article_id', 'stock', 'movimiento_id', 'fecha'],
+        select(
+            Article.id,
+            func.coalesce(Article.stock, 0),
+            last_movement_subquery(StockMovement.id),
+            literal(ahora, db.DateTime)
+        )
+    )).rowcount
+    borradas = db.session.execute(
+        delete(StockSnapshot).where(StockSnapshot.fecha < ahora - timedelta(days=retencion_dias))
+    ).rowcount
+    return {'articulos': tomadas, 'fotos_borradas': borradas, 'fecha': ahora.strftime('%Y-%m-%d %H:%M:%S')}
+
+def check_stock_ledger():
+    """Compara articles.stock con el ledger, artículo por artículo.
+
+    Hay descuadre si el stock del artículo no es el del último movimiento, o si
+    la última foto más los movimientos posteriores no llega a ese stock (falta
+    un movimiento). Todo sale de una consulta con subconsultas correlacionadas
+    por índice; la suma solo recorre los movimientos desde la última foto.
+    """
+    foto = aliased(StockSnapshot)
+    ultima_foto = select(foto.id).where(foto.article_id == Article.id)\
+        .order_by(foto.fecha.desc(), foto.id.desc()).limit(1).scalar_subquery()
+    posteriores = select(func.coalesce(func.sum(StockMovement.cantidad), 0)).where(
+        StockMovement.article_id == Article.id,
+        StockMovement.fecha >= StockSnapshot.fecha,
+        StockMovement.id > func.coalesce(StockSnapshot.movimiento_id, 0)
+    ).scalar_subquery()
+    filas = db.session.query(
+        Article.id, Article.title, Article.stock,
+        last_movement_subquery(StockMovement.stock_resultante).label('stock_ledger'),
+        StockSnapshot.stock.label('stock_foto'),
+        StockSnapshot.fecha.label('fecha_foto'),
+        posteriores.label('movimientos_desde_foto')
+    ).outerjoin(StockSnapshot, StockSnapshot.id == ultima_foto).order_by(Article.id).all()
+    
+    descuadres = []
+    sin_registro = 0
+    for fila in filas:
+        stock = fila.stock or 0
+        if fila.stock_ledger is None and fila.stock_foto is None:
+            sin_registro += 1
+            continue
+        problemas = []
+        if fila.stock_ledger is not None and abs(stock - fila.stock_ledger) > STOCK_LEDGER_TOLERANCIA:
+            problemas.append('stock_distinto_al_ledger')
+        esperado = None
+        if fila.stock_foto is not None:
+            esperado = fila.stock_foto + fila.movimientos_desde_foto
+            actual = fila.stock_ledger if fila.stock_ledger is not None else stock
+            if abs(actual - esperado) > STOCK_LEDGER_TOLERANCIA:
+                problemas.append('movimientos_faltantes')
+        if problemas:
+            descuadres.append({
+                'article_id': fila.id,
+                'title': fila.title,
+                'stock': stock,
+                'stock_ledger': fila.stock_ledger,
+                'stock_foto': fila.stock_foto,
+                'fecha_foto': fila.fecha_foto.strftime('%Y-%m-%d %H:%M:%S') if fila.fecha_foto else None,
+                'esperado_desde_foto': esperado,
+                'problemas': problemas
+            })
+    return {
+        'articulos_revisados': len(filas),
+        'sin_registro': sin_registro,
+        'descuadres': descuadres
+    }
+
+@app.cli.command('snapshot-stock')
+@click.option('--retencion-dias', default=STOCK_SNAPSHOT_RETENCION_DIAS, show_default=True, help='Días que se conservan las fotos anteriores')
+def snapshot_stock_command(retencion_dias):
+    """Guarda la foto periódica del stock de todos los artículos"""
+    resumen = take_stock_snapshot(retencion_dias)
+    db.session.commit()
+    print(f"✅ Foto de stock: {resumen['articulos']} artículos ({resumen['fotos_borradas']} fotos antiguas borradas)")
+
+@app.cli.command('check-stock-ledger')
+def check_stock_ledger_command():
+    """Verifica articles.stock contra el ledger de movimientos"""
+    resultado = check_stock_ledger()
+    for descuadre in resultado['descuadres']:
+        print(f"⚠️ {descuadre['article_id']} {descuadre['title']}: stock {descuadre['stock']}, "
+              f"ledger {descuadre['stock_ledger']}, desde la foto {descuadre['esperado_desde_foto']} "
+              f"({', '.join(descuadre['problemas'])})")
+    print(f"✅ Artículos revisados: {resultado['articulos_revisados']}, descuadres: {len(resultado['descuadres'])}, "
+          f"sin registro en el ledger: {resultado['sin_registro']}")
+
+@app.route('/stock-ledger/movements', methods=['GET'])
+@permission_required('can_manage_products')
+def get_stock_movements():
+    """Movimientos de stock de un rango (días locales), opcionalmente de un artículo y tipo, con paginación keyset"""
     try:
-        discounts = Discount.query.order_by(Discount.created_at.desc()).all()
+        query = StockMovement.query
+        article_id = request.args.get('article_id', type=int)
+        if article_id:
+            query = query.filter(StockMovement.article_id == article_id)
+        tipo = request.args.get('tipo')
+        if tipo:
+            if tipo not in TIPOS_MOVIMIENTO:
+                return jsonify({'error': f'Tipo de movimiento inválido: {tipo}'}), 400
+            query = query.filter(StockMovement.tipo == tipo)
+        
+        # El rango se pasa a UTC para recorrer el índice por fecha
+        inicio, fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
+        if inicio:
+            query = query.filter(StockMovement.fecha >= local_to_utc(inicio))
+        if fin:
+            query = query.filter(StockMovement.fecha < local_to_utc(fin))
+        
+        movimientos, pagination = keyset_page(query, StockMovement.fecha, StockMovement.id)
         return jsonify({
-            'discounts': [discount.to_dict() for discount in discounts]
+            'movimientos': [movimiento.to_dict() for movimiento in movimientos],
+            'pagination': pagination
         })
+        
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        print(f"Error al obtener descuentos: {str(e)}")
-        return jsonify({'error': 'Error al obtener descuentos'}), 500
+        print(f"Error al obtener movimientos de stock: {str(e)}")
+        return jsonify({'error': 'Error al obtener movimientos de stock'}), 500
 
-@app.route('/discounts/active', methods=['GET'])
-@login_required
-def get_active_discounts():
-    """Obtiene solo los descuentos activos"""
+@app.route('/stock-ledger/stock-at', methods=['GET'])
+@permission_required('can_manage_products')
+def get_stock_at():
+    """Stock de un artículo en una fecha y hora local ('YYYY-MM-DD' o 'YYYY-MM-DD HH:MM[:SS]'); por defecto ahora"""
     try:
-        discounts = Discount.query.filter(Discount.activo == True).all()
-        active_discounts = [d for d in discounts if d.is_active()]
+        article_id = request.args.get('article_id', type=int)
+        if not article_id:
+            return jsonify({'error': 'Campo requerido: article_id'}), 400
+        article = db.session.get(Article, article_id)
+        if not article:
+            return jsonify({'error': 'Artículo no encontrado'}), 404
+        
+        fecha = request.args.get('fecha')
+        if fecha:
+            try:
+                momento_local = datetime.fromisoformat(fecha)
+            except ValueError:
+                return jsonify({'error': 'Fecha inválida'}), 400
+            if len(fecha) == 10:
+                # Solo el día: el stock al cierre de ese día
+                momento_local += timedelta(days=1) - timedelta(microseconds=1)
+            momento = local_to_utc(momento_local)
+        else:
+            momento = datetime.utcnow()
+        
+        stock, origen, movimiento_id = ledger_stock_at(article_id, momento)
+        if stock is None:
+            # Sin movimientos registrados el stock no cambió
+            stock = article.stock
+        
+        return jsonify({
+            'article_id': article_id,
+            'title': article.title,
+            'fecha': to_local_time(momento).strftime('%Y-%m-%d %H:%M:%S'),
+            'stock': stock,
+            'origen': origen,
+            'movimiento_id': movimiento_id,
+            'stock_actual': article.stock
+        })
+        
+    except Exception as e:
+        print(f"Error al obtener stock histórico: {str(e)}")
+        return jsonify({'error': 'Error al obtener stock histórico'}), 500
+
+@app.route('/stock-ledger/check', methods=['GET'])
+@admin_required
+def get_stock_ledger_check():
+    """Verificación de articles.stock contra el ledger"""
+    try:
+        return jsonify(check_stock_ledger())
+    except Exception as e:
+        print(f"Error al verificar el ledger de stock: {str(e)}")
+        return jsonify({'error': 'Error al verificar el ledger de stock'}), 500
+
+@app.route('/stock-ledger/snapshot', methods=['POST'])
+@admin_required
+def create_stock_snapshot():
+    """Toma la foto de stock en el momento (además de la periódica por CLI)"""
+    try:
+        data = request.get_json(silent=True) or {}
+        retencion_dias = int(data.get('retencion_dias', STOCK_SNAPSHOT_RETENCION_DIAS))
+        if retencion_dias < 1:
+            return jsonify({'error': 'La retención debe ser de al menos 1 día'}), 400
+        resumen = take_stock_snapshot(retencion_dias)
+        db.session.commit()
+        return jsonify({'message': 'Foto de stock guardada', 'resumen': resumen})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al guardar la foto de stock: {str(e)}")
+        return jsonify({'error': 'Error al guardar la foto de stock'}), 500
+
+STOCK_ALERTAS_LIMIT_DEFAULT = 50
+
+@app.route('/stock-alerts', methods=['GET'])
+@login_required
+def get_stock_alerts():
+    """Alertas de stock posteriores al cursor (el id de la última alerta recibida).
+
+    Sin cursor devuelve las más recientes; en ambos casos en orden de emisión y
+    con el cursor para la siguiente consulta, que queda igual si no hay nuevas.
+    """
+    try:
+        limit = max(1, min(request.args.get('limit', STOCK_ALERTAS_LIMIT_DEFAULT, type=int), KEYSET_MAX_LIMIT))
+        query = db.session.query(StockAlert, Article.title).outerjoin(Article, StockAlert.article_id == Article.id)
+        tipo = request.args.get('tipo')
+        if tipo:
+            if tipo not in TIPOS_ALERTA:
+                return jsonify({'error': f'Tipo de alerta inválido: {tipo}'}), 400
+            query = query.filter(StockAlert.tipo == tipo)
+        
+        cursor = request.args.get('cursor')
+        if cursor:
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                return jsonify({'error': 'Cursor inválido'}), 400
+            filas = query.filter(StockAlert.id > cursor).order_by(StockAlert.id).limit(limit + 1).all()
+            has_more = len(filas) > limit
+            filas = filas[:limit]
+        else:
+            filas = query.order_by(StockAlert.id.desc()).limit(limit).all()[::-1]
+            has_more = False
+        
+        alertas = [dict(alerta.to_dict(), title=title or 'Producto eliminado') for alerta, title in filas]
+        return jsonify({
+            'alertas': alertas,
+            'cursor': alertas[-1]['id'] if alertas else cursor,
+            'has_more': has_more
+        })
+        
+    except Exception as e:
+        print(f"Error al obtener alertas de stock: {str(e)}")
+        return jsonify({'error': 'Error al obtener alertas de stock'}), 500
+
+# =====================
+# DESCUENTOS Y PROMOCIONES
+# =====================
+
+@app.route('/discounts', methods=['GET'])
+@login_required
+def get_discounts():
+    """Obtiene todos los descuentos disponibles"""
+    try:
+        discounts = Discount.query.order_by(Discount.created_at.desc()).all()
+        return jsonify({
+            'discounts': [discount.to_dict() for discount in discounts]
+        })
+    except Exception as e:
+        print(f"Error al obtener descuentos: {str(e)}")
+        return jsonify({'error': 'Error al obtener descuentos'}), 500
+
+@app.route('/discounts/active', methods=['GET'])
+@login_required
+def get_active_discounts():
+    """Obtiene solo los descuentos activos"""
+    try:
+        discounts = Discount.query.filter(Discount.activo == True).all()
+        active_discounts = [d for d in discounts if d.is_active()]
         return jsonify({
             'discounts': [discount.to_dict() for discount in active_discounts]
         })
@@ -1880,6 +3323,275 @@ def get_affected_products(promotion, cart_items):
         print(f"Error obteniendo productos afectados: {str(e)}")
         return []
 
+# =====================
+# ROLLUPS DE VENTAS
+# =====================
+
+def conflict_insert(target):
+    """INSERT del dialecto en uso, que admite ON CONFLICT"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(target)
+
+def upsert_increment(model, keys, deltas):
+    """Suma deltas a la fila de rollup identificada por keys (INSERT ... ON CONFLICT DO UPDATE)"""
+    stmt = conflict_insert(model).values(**keys, **deltas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={column: getattr(model, column) + stmt.excluded[column] for column in deltas}
+    )
+    db.session.execute(stmt)
+
+def upsert_increment_many(model, key_columns, filas):
+    """Como upsert_increment para varias filas con las mismas columnas, en un solo executemany"""
+    tabla = model.__table__
+    stmt = conflict_insert(tabla)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(key_columns),
+        set_={column: tabla.c[column] + stmt.excluded[column] for column in filas[0] if column not in key_columns}
+    )
+    db.session.execute(stmt, filas)
+
+def record_rollup(fecha_utc, metodo_pago, user_id, deltas):
+    """Actualiza los rollups diario y por hora (día y hora local de Chile)"""
+    local = to_local_time(fecha_utc)
+    keys = {'fecha': local.date(), 'metodo_pago': metodo_pago, 'user_id': user_id}
+    upsert_increment(SalesDailyRollup, keys, deltas)
+    upsert_increment(SalesHourlyRollup, dict(keys, hora=local.hour), deltas)
+    # El pronóstico del heatmap solo usa días completos: se invalida si cambia un día anterior a hoy
+    if local.date() < datetime.now(BUSINESS_TZ).date():
+        cache_invalidate('heatmap:')
+
+def record_sale_rollup(sale):
+    record_rollup(sale.fecha_venta, sale.metodo_pago, sale.user_id, {
+        'total_ventas': sale.total,
+        'cantidad_ventas': 1
+    })
+
+def record_return_rollup(devolucion):
+    record_rollup(devolucion.fecha_devolucion, ROLLUP_DEVOLUCION, devolucion.user_id, {
+        'total_devoluciones': devolucion.total,
+        'cantidad_devoluciones': 1
+    })
+
+def estimated_margin(monto, precio, margen_ganancia):
+    """Margen estimado de un monto vendido según la proporción margen_ganancia/precio del artículo"""
+    if not precio or not margen_ganancia:
+        return 0.0
+    return float(monto or 0) * float(margen_ganancia) / float(precio)
+
+def record_article_sale_rollup(sale, item, article):
+    margen = estimated_margin(item.subtotal, article.precio, article.margen_ganancia) if article else 0.0
+    upsert_increment(ArticleDailyRollup, {
+        'fecha': to_local_time(sale.fecha_venta).date(),
+        'article_id': item.article_id
+    }, {
+        'cantidad_vendida': item.quantity,
+        'total_ventas': item.subtotal,
+        'margen_estimado': margen,
+        'lineas_venta': 1
+    })
+
+def record_article_return_rollup(devolucion, article):
+    margen = estimated_margin(devolucion.total, article.precio, article.margen_ganancia) if article else 0.0
+    upsert_increment(ArticleDailyRollup, {
+        'fecha': to_local_time(devolucion.fecha_devolucion).date(),
+        'article_id': devolucion.article_id
+    }, {
+        'cantidad_devuelta': devolucion.quantity,
+        'total_devoluciones': devolucion.total,
+        'margen_devuelto': margen
+    })
+
+def article_unit_cost(precio, margen_ganancia):
+    """Costo unitario del artículo (precio - margen_ganancia), como Article.get_precio_costo()"""
+    return float(precio or 0) - float(margen_ganancia or 0)
+
+def record_loss_rollup(loss, article, signo=1):
+    """Suma una pérdida al rollup mensual de mermas (signo=-1 al eliminarla)"""
+    cantidad = signo * loss.cantidad_perdida
+    upsert_increment(ShrinkageMonthlyRollup, {
+        'mes': to_local_time(loss.fecha_registro).date().replace(day=1),
+        'article_id': loss.article_id
+    }, {
+        'perdidas_cantidad': cantidad,
+        'perdidas_vencido': cantidad if loss.tipo_perdida == 'vencido' else 0.0,
+        'perdidas_danado': cantidad if loss.tipo_perdida == 'dañado' else 0.0,
+        'perdidas_valor_costo': cantidad * article_unit_cost(article.precio, article.margen_ganancia) if article else 0.0,
+        'perdidas_registros': signo
+    })
+
+def count_adjustment_deltas(article_id, diferencia, costo_unitario):
+    """Aporte de un ajuste por conteo físico (stock nuevo - stock anterior) al rollup mensual de mermas"""
+    return {
+        'ajustes': 1,
+        'ajustes_faltante': 1 if diferencia < 0 else 0,
+        'diferencia_neta': diferencia,
+        'diferencia_absoluta': abs(diferencia),
+        'diferencia_valor_costo': diferencia * costo_unitario
+    }
+
+def record_count_rollups(mes, ajustes):
+    """Suma un lote de ajustes por conteo al rollup mensual; ajustes = [(article_id, diferencia, costo_unitario)]"""
+    por_articulo = {}
+    for article_id, diferencia, costo_unitario in ajustes:
+        fila = por_articulo.setdefault(article_id, {
+            'mes': mes, 'article_id': article_id, 'ajustes': 0, 'ajustes_faltante': 0,
+            'diferencia_neta': 0.0, 'diferencia_absoluta': 0.0, 'diferencia_valor_costo': 0.0
+        })
+        for column, value in count_adjustment_deltas(article_id, diferencia, costo_unitario).items():
+            fila[column] += value
+    if por_articulo:
+        upsert_increment_many(ShrinkageMonthlyRollup, ('mes', 'article_id'), list(por_articulo.values()))
+
+def rebuild_shrinkage_rollups():
+    """Reconstruye el rollup mensual de mermas (usa el costo actual de cada artículo)"""
+    por_mes = {}
+    
+    def acumular(fecha_local, fecha_utc, article_id, deltas):
+        dia = fecha_local or to_local_time(fecha_utc).date()
+        fila = por_mes.setdefault((dia.replace(day=1), article_id), {
+            column.name: 0 for column in ShrinkageMonthlyRollup.__table__.columns
+            if column.name not in ('id', 'mes', 'article_id')
+        })
+        for column, value in deltas.items():
+            fila[column] += value
+    
+    perdidas = db.session.query(InventoryLoss.fecha_local, InventoryLoss.fecha_registro, InventoryLoss.article_id,
+                                InventoryLoss.cantidad_perdida, InventoryLoss.tipo_perdida,
+                                Article.precio, Article.margen_ganancia)\
+                         .outerjoin(Article, InventoryLoss.article_id == Article.id)\
+                         .yield_per(1000)
+    for fecha_local, fecha_registro, article_id, cantidad, tipo, precio, margen_ganancia in perdidas:
+        acumular(fecha_local, fecha_registro, article_id, {
+            'perdidas_cantidad': cantidad,
+            'perdidas_vencido': cantidad if tipo == 'vencido' else 0.0,
+            'perdidas_danado': cantidad if tipo == 'dañado' else 0.0,
+            'perdidas_valor_costo': cantidad * article_unit_cost(precio, margen_ganancia),
+            'perdidas_registros': 1
+        })
+    
+    conteos = db.session.query(PhysicalCountHistory.fecha_local, PhysicalCountHistory.timestamp,
+                               PhysicalCountHistory.article_id, PhysicalCountHistory.difference,
+                               Article.precio, Article.margen_ganancia)\
+                        .outerjoin(Article, PhysicalCountHistory.article_id == Article.id)\
+                        .yield_per(1000)
+    for fecha_local, timestamp, article_id, diferencia, precio, margen_ganancia in conteos:
+        acumular(fecha_local, timestamp, article_id,
+                 count_adjustment_deltas(article_id, diferencia or 0, article_unit_cost(precio, margen_ganancia)))
+    
+    ShrinkageMonthlyRollup.query.delete()
+    if por_mes:
+        db.session.execute(insert(ShrinkageMonthlyRollup), [
+            dict(mes=mes, article_id=article_id, **valores)
+            for (mes, article_id), valores in por_mes.items()
+        ])
+    return len(por_mes)
+
+def rebuild_article_rollups():
+    """Reconstruye el rollup por artículo (usa el margen actual de cada artículo)"""
+    por_articulo = {}
+    
+    def acumular(fecha_utc, article_id, deltas):
+        fila = por_articulo.setdefault((to_local_time(fecha_utc).date(), article_id), {
+            'cantidad_vendida': 0.0,
+            'total_ventas': 0.0,
+            'margen_estimado': 0.0,
+            'lineas_venta': 0,
+            'cantidad_devuelta': 0.0,
+            'total_devoluciones': 0.0,
+            'margen_devuelto': 0.0
+        })
+        for column, value in deltas.items():
+            fila[column] += value
+    
+    items = db.session.query(Sale.fecha_venta, SaleItem.article_id, SaleItem.quantity, SaleItem.subtotal,
+                             Article.precio, Article.margen_ganancia)\
+                      .join(Sale, SaleItem.sale_id == Sale.id)\
+                      .outerjoin(Article, SaleItem.article_id == Article.id)\
+                      .yield_per(1000)
+    for fecha_venta, article_id, quantity, subtotal, precio, margen_ganancia in items:
+        acumular(fecha_venta, article_id, {
+            'cantidad_vendida': quantity or 0,
+            'total_ventas': subtotal or 0,
+            'margen_estimado': estimated_margin(subtotal, precio, margen_ganancia),
+            'lineas_venta': 1
+        })
+    
+    devoluciones = db.session.query(Devolucion.fecha_devolucion, Devolucion.article_id, Devolucion.quantity,
+                                    Devolucion.total, Article.precio, Article.margen_ganancia)\
+                             .outerjoin(Article, Devolucion.article_id == Article.id)\
+                             .yield_per(1000)
+    for fecha_devolucion, article_id, quantity, total, precio, margen_ganancia in devoluciones:
+        acumular(fecha_devolucion, article_id, {
+            'cantidad_devuelta': quantity or 0,
+            'total_devoluciones': total or 0,
+            'margen_devuelto': estimated_margin(total, precio, margen_ganancia)
+        })
+    
+    ArticleDailyRollup.query.delete()
+    if por_articulo:
+        db.session.execute(insert(ArticleDailyRollup), [
+            dict(fecha=fecha, article_id=article_id, **valores)
+            for (fecha, article_id), valores in por_articulo.items()
+        ])
+    return len(por_articulo)
+
+def rebuild_sales_rollups():
+    """Reconstruye los rollups diario y por hora desde sales y devoluciones; devuelve las filas de cada uno"""
+    diarios = {}
+    por_hora = {}
+    
+    def acumular(fecha_utc, metodo_pago, user_id, deltas):
+        local = to_local_time(fecha_utc)
+        for buckets, key in (
+            (diarios, (local.date(), metodo_pago, user_id)),
+            (por_hora, (local.date(), local.hour, metodo_pago, user_id))
+        ):
+            fila = buckets.setdefault(key, {
+                'total_ventas': 0.0,
+                'cantidad_ventas': 0,
+                'total_devoluciones': 0.0,
+                'cantidad_devoluciones': 0
+            })
+            for column, value in deltas.items():
+                fila[column] += value
+    
+    ventas = db.session.query(Sale.fecha_venta, Sale.metodo_pago, Sale.user_id, Sale.total).yield_per(1000)
+    for fecha_venta, metodo_pago, user_id, total in ventas:
+        acumular(fecha_venta, metodo_pago, user_id, {'total_ventas': total or 0, 'cantidad_ventas': 1})
+    
+    devoluciones = db.session.query(Devolucion.fecha_devolucion, Devolucion.user_id, Devolucion.total).yield_per(1000)
+    for fecha_devolucion, user_id, total in devoluciones:
+        acumular(fecha_devolucion, ROLLUP_DEVOLUCION, user_id, {'total_devoluciones': total or 0, 'cantidad_devoluciones': 1})
+    
+    SalesDailyRollup.query.delete()
+    SalesHourlyRollup.query.delete()
+    if diarios:
+        db.session.execute(insert(SalesDailyRollup), [
+            dict(fecha=fecha, metodo_pago=metodo_pago, user_id=user_id, **valores)
+            for (fecha, metodo_pago, user_id), valores in diarios.items()
+        ])
+    if por_hora:
+        db.session.execute(insert(SalesHourlyRollup), [
+            dict(fecha=fecha, hora=hora, metodo_pago=metodo_pago, user_id=user_id, **valores)
+            for (fecha, hora, metodo_pago, user_id), valores in por_hora.items()
+        ])
+    return len(diarios), len(por_hora)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Reconstruye los rollups de ventas (desde sales y devoluciones) y de mermas"""
+    diarios, por_hora = rebuild_sales_rollups()
+    por_articulo = rebuild_article_rollups()
+    mermas = rebuild_shrinkage_rollups()
+    db.session.commit()
+    cache_invalidate('heatmap:')
+    print(f"✅ Rollups reconstruidos: {diarios} filas diarias, {por_hora} filas por hora, "
+          f"{por_articulo} filas por artículo, {mermas} filas mensuales de mermas")
+
 # =====================
 # VENTAS
 # =====================
@@ -2012,6 +3724,7 @@ def create_sale():
             db.session.add(sale_discount)
         
         # Crear items de venta y actualizar stock
+        movimientos = []
         for item in cart_items:
             # Crear item de venta
             sale_item = SaleItem(
@@ -2028,6 +3741,14 @@ def create_sale():
             article = Article.query.get(item['id'])
             if article:
                 article.stock -= item['quantity']
+                movimientos.append(stock_movement(article, 'venta', -item['quantity'], nueva_venta.id))
+            
+            record_article_sale_rollup(nueva_venta, sale_item, article)
+        
+        record_stock_movements(movimientos, session['user_id'])
+        
+        # Acumular la venta en los rollups de gráficos
+        record_sale_rollup(nueva_venta)
         
         # Si es una venta retomada, eliminar la venta suspendida
         if suspended_sale_id:
@@ -2045,6 +3766,7 @@ def create_sale():
             turno_activo.total_tarjeta = (turno_activo.total_tarjeta or 0) + total
         
         db.session.commit()
+        invalidate_stock_report()
         
         # Actualizar la categoría de productos frecuentes después de cada venta
         try:
@@ -2070,6 +3792,11 @@ def create_sale():
         traceback.print_exc()
         return jsonify({'error': f'Error al procesar la venta: {str(e)}'}), 500
 
+def sales_listing_query(turno_id):
+    """Ventas de un turno con usuario e items cargados en bloque (sin una consulta por venta)"""
+    return Sale.query.filter_by(turno_id=turno_id)\
+                     .options(joinedload(Sale.user), selectinload(Sale.items))
+
 @app.route('/sales', methods=['GET'])
 @login_required
 def get_sales():
@@ -2085,16 +3812,8 @@ def get_sales():
                 'message': 'No hay turno activo'
             })
         
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        
-        sales = Sale.query.filter_by(turno_id=turno_activo.id).order_by(Sale.fecha_venta.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
-        
-        sales_data = []
-        for sale in sales.items:
-            sale_data = {
+        def sale_data(sale):
+            return {
                 'id': sale.id,
                 'ticket_number': sale.ticket_number,
                 'total': sale.total,
@@ -2113,21 +3832,42 @@ def get_sales():
                     for item in sale.items
                 ]
             }
-            sales_data.append(sale_data)
+        
+        query = sales_listing_query(turno_activo.id)
+        
+        if wants_ndjson():
+            ventas = query.order_by(Sale.fecha_venta.desc(), Sale.id.desc()).yield_per(200)
+            return ndjson_response(sale_data(sale) for sale in ventas)
+        
+        turno_info = {
+            'id': turno_activo.id,
+            'fecha_inicio': turno_activo.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
+            'total_efectivo': turno_activo.total_efectivo or 0,
+            'total_tarjeta': turno_activo.total_tarjeta or 0,
+            'total_ventas': turno_activo.total_ventas or 0,
+            'cantidad_ventas': turno_activo.cantidad_ventas or 0
+        }
+        
+        if 'cursor' in request.args:
+            try:
+                sales, meta = keyset_page(query, Sale.fecha_venta, Sale.id, request.args.get('per_page', 10, type=int))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'sales': [sale_data(sale) for sale in sales], 'turno_info': turno_info, **meta})
+        
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 10, type=int)
+        
+        sales = query.order_by(Sale.fecha_venta.desc(), Sale.id.desc()).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
         
         return jsonify({
-            'sales': sales_data,
+            'sales': [sale_data(sale) for sale in sales.items],
             'total_pages': sales.pages,
             'current_page': sales.page,
             'total_sales': sales.total,
-            'turno_info': {
-                'id': turno_activo.id,
-                'fecha_inicio': turno_activo.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
-                'total_efectivo': turno_activo.total_efectivo or 0,
-                'total_tarjeta': turno_activo.total_tarjeta or 0,
-                'total_ventas': turno_activo.total_ventas or 0,
-                'cantidad_ventas': turno_activo.cantidad_ventas or 0
-            }
+            'turno_info': turno_info
         })
         
     except Exception as e:
@@ -2352,15 +4092,20 @@ def create_return():
             motivo=motivo
         )
         db.session.add(nueva_devolucion)
+        db.session.flush()  # Para obtener la fecha de la devolución
+        record_return_rollup(nueva_devolucion)
+        record_article_return_rollup(nueva_devolucion, article)
         
         # Actualizar stock del artículo (devolver al inventario)
         article.stock += quantity
+        record_stock_movements([stock_movement(article, 'devolucion', quantity, nueva_devolucion.id)], session['user_id'])
         
         # Actualizar estadísticas del turno
         turno_activo.total_devoluciones = (turno_activo.total_devoluciones or 0) + total
         turno_activo.cantidad_devoluciones = (turno_activo.cantidad_devoluciones or 0) + 1
         
         db.session.commit()
+        invalidate_stock_report()
         
         return jsonify({
             'success': True,
@@ -2384,15 +4129,30 @@ def get_returns():
         if not turno_activo:
             return jsonify([])
         
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        query = Devolucion.query.filter_by(turno_id=turno_activo.id)\
+                                .options(joinedload(Devolucion.user))
         
-        devoluciones = Devolucion.query.filter_by(turno_id=turno_activo.id)\
-                                     .order_by(Devolucion.fecha_devolucion.desc())\
-                                     .paginate(page=page, per_page=per_page, error_out=False)
+        if 'cursor' in request.args:
+            try:
+                devoluciones, meta = keyset_page(query, Devolucion.fecha_devolucion, Devolucion.id,
+                                                 request.args.get('per_page', 10, type=int))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            page = request.args.get('page', 1, type=int)
+            per_page = request.args.get('per_page', 10, type=int)
+            
+            paginacion = query.order_by(Devolucion.fecha_devolucion.desc(), Devolucion.id.desc())\
+                              .paginate(page=page, per_page=per_page, error_out=False)
+            devoluciones = paginacion.items
+            meta = {
+                'total_pages': paginacion.pages,
+                'current_page': paginacion.page,
+                'total_returns': paginacion.total
+            }
         
         devoluciones_data = []
-        for devolucion in devoluciones.items:
+        for devolucion in devoluciones:
             devolucion_data = {
                 'id': devolucion.id,
                 'ticket_number': devolucion.ticket_number,
@@ -2406,12 +4166,7 @@ def get_returns():
             }
             devoluciones_data.append(devolucion_data)
         
-        return jsonify({
-            'returns': devoluciones_data,
-            'total_pages': devoluciones.pages,
-            'current_page': devoluciones.page,
-            'total_returns': devoluciones.total
-        })
+        return jsonify({'returns': devoluciones_data, **meta})
         
     except Exception as e:
         print(f"Error obteniendo devoluciones: {str(e)}")
@@ -2456,6 +4211,198 @@ def get_returns_by_turno(turno_id):
 # TURNOS
 # =====================
 
+# Cantidad de artículos que se guardan en el ranking del resumen de turno
+TOP_ARTICULOS_RESUMEN = 10
+
+def calculate_turno_summary(turno):
+    """Calcula los totales de un turno desde ventas y devoluciones (valores para TurnoResumen)"""
+    por_metodo = db.session.query(
+        Sale.metodo_pago,
+        func.coalesce(func.sum(Sale.total), 0),
+        func.count(Sale.id)
+    ).filter(Sale.turno_id == turno.id).group_by(Sale.metodo_pago).all()
+    totales_por_metodo = {
+        metodo: {'total': float(total), 'cantidad': cantidad}
+        for metodo, total, cantidad in por_metodo
+    }
+    total_ventas = sum(valores['total'] for valores in totales_por_metodo.values())
+    total_efectivo = totales_por_metodo.get('efectivo', {}).get('total', 0.0)
+    
+    total_devoluciones, cantidad_devoluciones = db.session.query(
+        func.coalesce(func.sum(Devolucion.total), 0),
+        func.count(Devolucion.id)
+    ).filter(Devolucion.turno_id == turno.id).one()
+    
+    descuentos = db.session.query(
+        SaleDiscount.tipo_descuento,
+        func.coalesce(func.sum(SaleDiscount.monto_descuento), 0),
+        func.count(SaleDiscount.id)
+    ).join(Sale, SaleDiscount.sale_id == Sale.id)\
+     .filter(Sale.turno_id == turno.id)\
+     .group_by(SaleDiscount.tipo_descuento).all()
+    descuentos_por_tipo = {
+        tipo: {'monto': float(monto), 'cantidad': cantidad}
+        for tipo, monto, cantidad in descuentos
+    }
+    
+    items_query = db.session.query(SaleItem).join(Sale, SaleItem.sale_id == Sale.id)\
+                                            .filter(Sale.turno_id == turno.id)
+    cantidad_items = items_query.with_entities(func.coalesce(func.sum(SaleItem.quantity), 0)).scalar()
+    top_articulos = items_query.with_entities(
+        SaleItem.article_id,
+        func.max(SaleItem.article_title),
+        func.sum(SaleItem.quantity),
+        func.sum(SaleItem.subtotal)
+    ).group_by(SaleItem.article_id)\
+     .order_by(func.sum(SaleItem.quantity).desc())\
+     .limit(TOP_ARTICULOS_RESUMEN).all()
+    
+    por_hora = db.session.query(
+        Sale.fecha_local,
+        Sale.hora_local,
+        func.coalesce(func.sum(Sale.total), 0),
+        func.count(Sale.id)
+    ).filter(Sale.turno_id == turno.id)\
+     .group_by(Sale.fecha_local, Sale.hora_local)\
+     .order_by(Sale.fecha_local, Sale.hora_local).all()
+    ventas_por_hora = [
+        {'hora': f"{fecha.strftime('%Y-%m-%d')} {hora:02d}:00", 'total': float(total), 'cantidad': cantidad}
+        for fecha, hora, total, cantidad in por_hora
+    ]
+    
+    return {
+        'turno_id': turno.id,
+        'user_id': turno.user_id,
+        'fecha_inicio': turno.fecha_inicio,
+        'fecha_cierre': turno.fecha_cierre,
+        'total_ventas': total_ventas,
+        'total_efectivo': total_efectivo,
+        # Igual que en create_sale: todo lo que no es efectivo se acumula como tarjeta
+        'total_tarjeta': total_ventas - total_efectivo,
+        'cantidad_ventas': sum(valores['cantidad'] for valores in totales_por_metodo.values()),
+        'total_devoluciones': float(total_devoluciones),
+        'cantidad_devoluciones': cantidad_devoluciones,
+        'total_descuentos': sum(valores['monto'] for valores in descuentos_por_tipo.values()),
+        'cantidad_items': float(cantidad_items or 0),
+        'totales_por_metodo': json.dumps(totales_por_metodo),
+        'descuentos_por_tipo': json.dumps(descuentos_por_tipo),
+        'top_articulos': json.dumps([{
+            'article_id': article_id,
+            'article_title': article_title,
+            'cantidad': float(cantidad or 0),
+            'total': float(total or 0)
+        } for article_id, article_title, cantidad, total in top_articulos]),
+        'ventas_por_hora': json.dumps(ventas_por_hora)
+    }
+
+def save_turno_summary(turno):
+    """Guarda el resumen inmutable de un turno cerrado (sin hacer commit)"""
+    if turno.resumen is not None:
+        return turno.resumen
+    resumen = TurnoResumen(**calculate_turno_summary(turno))
+    db.session.add(resumen)
+    return resumen
+
+def finalize_turno(turno):
+    """Cierra un turno con la hora de Chile y congela su resumen"""
+    turno.fecha_cierre = datetime.now(BUSINESS_TZ)
+    turno.activo = False
+    return save_turno_summary(turno)
+
+def summary_totals(resumen):
+    """Totales de historial tomados desde un TurnoResumen"""
+    return {
+        'total_ventas': resumen.total_ventas,
+        'total_efectivo': resumen.total_efectivo,
+        'total_tarjeta': resumen.total_tarjeta,
+        'cantidad_ventas': resumen.cantidad_ventas,
+        'total_devoluciones': resumen.total_devoluciones,
+        'cantidad_devoluciones': resumen.cantidad_devoluciones
+    }
+
+def live_turno_totals(turno_ids, chunk_size=500):
+    """Calcula en vivo los totales de los turnos que aún no tienen resumen (turno activo o históricos)"""
+    totales = {
+        turno_id: {
+            'total_ventas': 0.0,
+            'total_efectivo': 0.0,
+            'total_tarjeta': 0.0,
+            'cantidad_ventas': 0,
+            'total_devoluciones': 0.0,
+            'cantidad_devoluciones': 0
+        }
+        for turno_id in turno_ids
+    }
+    turno_ids = list(totales)
+    for start in range(0, len(turno_ids), chunk_size):
+        chunk = turno_ids[start:start + chunk_size]
+        ventas = db.session.query(
+            Sale.turno_id,
+            Sale.metodo_pago,
+            func.coalesce(func.sum(Sale.total), 0),
+            func.count(Sale.id)
+        ).filter(Sale.turno_id.in_(chunk)).group_by(Sale.turno_id, Sale.metodo_pago).all()
+        for turno_id, metodo_pago, total, cantidad in ventas:
+            turno_totales = totales[turno_id]
+            turno_totales['total_ventas'] += float(total)
+            turno_totales['cantidad_ventas'] += cantidad
+            if metodo_pago == 'efectivo':
+                turno_totales['total_efectivo'] += float(total)
+            else:
+                turno_totales['total_tarjeta'] += float(total)
+        
+        devoluciones = db.session.query(
+            Devolucion.turno_id,
+            func.coalesce(func.sum(Devolucion.total), 0),
+            func.count(Devolucion.id)
+        ).filter(Devolucion.turno_id.in_(chunk)).group_by(Devolucion.turno_id).all()
+        for turno_id, total, cantidad in devoluciones:
+            totales[turno_id]['total_devoluciones'] = float(total)
+            totales[turno_id]['cantidad_devoluciones'] = cantidad
+    return totales
+
+def iter_turnos_historial(fecha_inicio=None, fecha_fin=None, chunk_size=500):
+    """Recorre los turnos del rango como (turno, username, totales).
+
+    Los turnos cerrados se leen desde su resumen; solo los que no tienen
+    resumen (el turno activo o turnos antiguos sin respaldar) se calculan en vivo.
+    Las filas se leen por bloques desde el cursor, sin cargar el rango completo.
+    """
+    query = db.session.query(Turno, User.username, TurnoResumen)\
+                      .join(User, Turno.user_id == User.id)\
+                      .outerjoin(TurnoResumen, TurnoResumen.turno_id == Turno.id)
+    query = local_date_filter(query, Turno.fecha_local, fecha_inicio, fecha_fin)
+    
+    def flush(bloque):
+        en_vivo = live_turno_totals([turno.id for turno, _, resumen in bloque if resumen is None])
+        for turno, username, resumen in bloque:
+            yield turno, username, summary_totals(resumen) if resumen else en_vivo[turno.id]
+    
+    bloque = []
+    for row in query.order_by(Turno.fecha_inicio.desc()).yield_per(chunk_size):
+        bloque.append(row)
+        if len(bloque) >= chunk_size:
+            yield from flush(bloque)
+            bloque = []
+    yield from flush(bloque)
+
+@app.cli.command('backfill-local-dates')
+def backfill_local_dates_command():
+    """Calcula fecha_local/hora_local de las filas que no las tienen"""
+    backfill_local_dates()
+    print("✅ Fechas locales actualizadas")
+
+@app.cli.command('backfill-turno-resumenes')
+def backfill_turno_summaries():
+    """Genera el resumen de los turnos cerrados que todavía no lo tienen"""
+    pendientes = Turno.query.outerjoin(TurnoResumen, TurnoResumen.turno_id == Turno.id)\
+                            .filter(Turno.activo == False, TurnoResumen.id.is_(None))\
+                            .order_by(Turno.id).all()
+    for turno in pendientes:
+        save_turno_summary(turno)
+    db.session.commit()
+    print(f"✅ Resúmenes generados: {len(pendientes)}")
+
 @app.route('/close-turno', methods=['POST'])
 @login_required
 def close_turno():
@@ -2465,24 +4412,14 @@ def close_turno():
         if not turno_activo:
             return jsonify({'error': 'No hay turno activo'}), 400
         
-        # Cerrar turno usando la zona horaria de Chile
-        chile_tz = pytz.timezone('America/Santiago')
-        turno_activo.fecha_cierre = datetime.now(chile_tz)
-        turno_activo.activo = False
-        
+        # Cerrar turno y guardar su resumen inmutable
+        resumen_turno = finalize_turno(turno_activo)
+
         db.session.commit()
         
         # Preparar resumen del turno
-        resumen = {
-            'turno_id': turno_activo.id,
-            'fecha_inicio': turno_activo.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
-            'fecha_cierre': turno_activo.fecha_cierre.strftime('%Y-%m-%d %H:%M:%S'),
-            'total_ventas': float(turno_activo.total_ventas or 0),
-            'total_efectivo': float(turno_activo.total_efectivo or 0),
-            'total_tarjeta': float(turno_activo.total_tarjeta or 0),
-            'cantidad_ventas': turno_activo.cantidad_ventas or 0,
-            'usuario': turno_activo.user.username if turno_activo.user else 'Desconocido'
-        }
+        resumen = resumen_turno.to_dict()
+        resumen['usuario'] = turno_activo.user.username if turno_activo.user else 'Desconocido'
         
         return jsonify({
             'message': 'Turno cerrado exitosamente',
@@ -2522,15 +4459,30 @@ def get_turno_actual():
 @permission_required('can_view_shift_history')
 def get_historial_turnos():
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        query = Turno.query.filter_by(activo=False).options(joinedload(Turno.user))
         
-        turnos = Turno.query.filter_by(activo=False).order_by(Turno.fecha_cierre.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        if 'cursor' in request.args:
+            try:
+                # fecha_inicio nunca es NULL (fecha_cierre puede serlo y cortaría el keyset)
+                turnos, meta = keyset_page(query, Turno.fecha_inicio, Turno.id, request.args.get('per_page', 10, type=int))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        else:
+            page = request.args.get('page', 1, type=int)
+            per_page = request.args.get('per_page', 10, type=int)
+            
+            paginacion = query.order_by(Turno.fecha_cierre.desc(), Turno.id.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            turnos = paginacion.items
+            meta = {
+                'total_pages': paginacion.pages,
+                'current_page': paginacion.page,
+                'total_turnos': paginacion.total
+            }
         
         turnos_data = []
-        for turno in turnos.items:
+        for turno in turnos:
             turno_data = {
                 'id': turno.id,
                 'usuario': turno.user.username,
@@ -2543,16 +4495,136 @@ def get_historial_turnos():
             }
             turnos_data.append(turno_data)
         
-        return jsonify({
-            'turnos': turnos_data,
-            'total_pages': turnos.pages,
-            'current_page': turnos.page,
-            'total_turnos': turnos.total
-        })
+        return jsonify({'turnos': turnos_data, **meta})
         
     except Exception as e:
         return jsonify({'error': 'Error al obtener historial de turnos'}), 500
 
+# Granularidades de los gráficos, de la más fina a la más gruesa
+GRANULARIDADES_GRAFICO = ('hora', 'dia', 'semana', 'mes')
+MAX_PUNTOS_GRAFICO = 120
+# Desplazamientos disponibles para comparar periodos (None = mismo largo del rango)
+COMPARACIONES_GRAFICO = {
+    'periodo_anterior': None,
+    'semana_anterior': timedelta(days=7),
+    'anio_anterior': timedelta(days=364)  # 52 semanas para mantener los días de la semana alineados
+}
+
+def chart_bucket_key(fecha, hora, granularidad):
+    """Inicio del bucket al que pertenece un día (y hora) local"""
+    if granularidad == 'hora':
+        return datetime.combine(fecha, datetime.min.time()) + timedelta(hours=hora)
+    if granularidad == 'semana':
+        return fecha - timedelta(days=fecha.weekday())
+    if granularidad == 'mes':
+        return fecha.replace(day=1)
+    return fecha
+
+def chart_buckets(inicio, fin, granularidad):
+    """Lista de buckets que cubren los días locales [inicio, fin)"""
+    buckets = []
+    actual = chart_bucket_key(inicio, 0, granularidad)
+    limite = datetime.combine(fin, datetime.min.time()) if granularidad == 'hora' else fin
+    while actual < limite:
+        buckets.append(actual)
+        if granularidad == 'hora':
+            actual += timedelta(hours=1)
+        elif granularidad == 'dia':
+            actual += timedelta(days=1)
+        elif granularidad == 'semana':
+            actual += timedelta(days=7)
+        else:
+            actual = (actual.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return buckets
+
+def chart_bucket_label(bucket, granularidad):
+    if granularidad == 'hora':
+        return bucket.strftime('%Y-%m-%d %H:00')
+    if granularidad == 'mes':
+        return bucket.strftime('%Y-%m')
+    return bucket.strftime('%Y-%m-%d')
+
+def choose_chart_granularity(inicio, fin, max_puntos):
+    """La granularidad más fina que no supera max_puntos en el rango"""
+    for granularidad in GRANULARIDADES_GRAFICO:
+        if len(chart_buckets(inicio, fin, granularidad)) <= max_puntos:
+            return granularidad
+    return GRANULARIDADES_GRAFICO[-1]
+
+def load_chart_series(inicio, fin, granularidad, metodo_pago=None, user_id=None):
+    """Suma ventas y cantidad por bucket desde los rollups, con ceros en los buckets vacíos"""
+    if granularidad == 'hora':
+        rollup = SalesHourlyRollup
+        columnas = [SalesHourlyRollup.fecha, SalesHourlyRollup.hora]
+    else:
+        rollup = SalesDailyRollup
+        columnas = [SalesDailyRollup.fecha]
+    
+    query = db.session.query(
+        *columnas,
+        func.sum(rollup.total_ventas),
+        func.sum(rollup.cantidad_ventas)
+    ).filter(
+        rollup.metodo_pago != ROLLUP_DEVOLUCION,
+        rollup.fecha >= inicio,
+        rollup.fecha < fin
+    )
+    if metodo_pago:
+        query = query.filter(rollup.metodo_pago == metodo_pago)
+    if user_id:
+        query = query.filter(rollup.user_id == user_id)
+    
+    buckets = chart_buckets(inicio, fin, granularidad)
+    valores = {bucket: [0.0, 0] for bucket in buckets}
+    for fila in query.group_by(*columnas):
+        hora = fila[1] if granularidad == 'hora' else 0
+        total_ventas, cantidad = fila[-2], fila[-1]
+        bucket = valores.get(chart_bucket_key(fila[0], hora, granularidad))
+        if bucket is not None:
+            bucket[0] += float(total_ventas or 0)
+            bucket[1] += int(cantidad or 0)
+    
+    return {
+        'labels': [chart_bucket_label(bucket, granularidad) for bucket in buckets],
+        'ventas': [valores[bucket][0] for bucket in buckets],
+        'cantidad': [valores[bucket][1] for bucket in buckets]
+    }
+
+def lttb_indices(values, threshold):
+    """Índices elegidos por Largest-Triangle-Three-Buckets para dibujar una serie con threshold puntos"""
+    n = len(values)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    
+    indices = [0]
+    bucket_size = (n - 2) / (threshold - 2)
+    anterior = 0
+    for i in range(threshold - 2):
+        # Promedio del siguiente bucket como tercer vértice del triángulo
+        inicio_sig = int((i + 1) * bucket_size) + 1
+        fin_sig = min(int((i + 2) * bucket_size) + 1, n)
+        promedio_x = (inicio_sig + fin_sig - 1) / 2
+        promedio_y = sum(values[inicio_sig:fin_sig]) / max(fin_sig - inicio_sig, 1)
+        
+        # Elegir el punto del bucket actual que forma el triángulo de mayor área
+        inicio_actual = int(i * bucket_size) + 1
+        fin_actual = int((i + 1) * bucket_size) + 1
+        mejor, mejor_area = inicio_actual, -1
+        for j in range(inicio_actual, fin_actual):
+            area = abs(
+                (anterior - promedio_x) * (values[j] - values[anterior])
+                - (anterior - j) * (promedio_y - values[anterior])
+            )
+            if area > mejor_area:
+                mejor, mejor_area = j, area
+        indices.append(mejor)
+        anterior = mejor
+    indices.append(n - 1)
+    return indices
+
+def downsample_series(serie, indices):
+    return {columna: [valores[i] for i in indices] for columna, valores in serie.items()}
+
 @app.route('/turnos-graficos', methods=['GET'])
 @permission_required('can_view_shift_history')
 def get_turnos_graficos():
@@ -2563,83 +4635,104 @@ def get_turnos_graficos():
 
         print(f"Fechas recibidas: inicio={fecha_inicio}, fin={fecha_fin}")
 
-        # Query base para ventas y cantidades
-        query = db.session.query(
-            func.strftime('%Y-%m-%d', Sale.fecha_venta).label('fecha'),
-            func.sum(Sale.total).label('total_ventas'),
-            func.count(Sale.id).label('cantidad_total')
-        ).filter(Sale.turno_id.isnot(None))
-
-        # Aplicar filtros de fecha si se proporcionan
-        if fecha_inicio:
-            try:
-                fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
-                query = query.filter(Sale.fecha_venta >= fecha_inicio)
-                print(f"Filtro fecha inicio aplicado: {fecha_inicio}")
-            except ValueError as e:
-                print(f"Error al parsear fecha_inicio: {e}")
-                return jsonify({'error': 'Formato de fecha inicio inválido'}), 400
-        
-        if fecha_fin:
-            try:
-                fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
-                fecha_fin = fecha_fin + timedelta(days=1)  # Incluir todo el día final
-                query = query.filter(Sale.fecha_venta < fecha_fin)
-                print(f"Filtro fecha fin aplicado: {fecha_fin}")
-            except ValueError as e:
-                print(f"Error al parsear fecha_fin: {e}")
-                return jsonify({'error': 'Formato de fecha fin inválido'}), 400
-
-        # Agrupar por fecha y ordenar
-        query = query.group_by(func.strftime('%Y-%m-%d', Sale.fecha_venta))\
-                     .order_by(func.strftime('%Y-%m-%d', Sale.fecha_venta))
-        
-        print("Ejecutando consulta...")
-        resultados = query.all()
-        print(f"Resultados obtenidos: {len(resultados)}")
-        
-        # Debug: imprimir los tipos de datos y valores
-        for idx, r in enumerate(resultados):
-            print(f"Resultado {idx}:")
-            print(f"  fecha: {type(r[0])} = {r[0]}")
-            print(f"  ventas: {type(r[1])} = {r[1]}")
-            print(f"  cantidad: {type(r[2])} = {r[2]}")
-
-        # Preparar datos para los gráficos
-        labels = []
-        ventas_data = []
-        cantidad_data = []
-        
-        for r in resultados:
-            # La fecha viene como string desde la consulta SQL
-            fecha = r[0]
-            if isinstance(fecha, datetime):
-                labels.append(fecha.strftime('%Y-%m-%d'))
-            else:
-                labels.append(str(fecha))
-            
-            # Convertir valores numéricos de manera segura
-            try:
-                ventas_data.append(float(r[1]) if r[1] is not None else 0.0)
-            except (TypeError, ValueError):
-                ventas_data.append(0.0)
-                
-            try:
-                cantidad_data.append(int(r[2]) if r[2] is not None else 0)
-            except (TypeError, ValueError):
-                cantidad_data.append(0)
+        try:
+            fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d').date() if fecha_inicio else None
+        except ValueError as e:
+            print(f"Error al parsear fecha_inicio: {e}")
+            return jsonify({'error': 'Formato de fecha inicio inválido'}), 400
+        try:
+            fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d').date() + timedelta(days=1) if fecha_fin else None
+        except ValueError as e:
+            print(f"Error al parsear fecha_fin: {e}")
+            return jsonify({'error': 'Formato de fecha fin inválido'}), 400
+
+        # Sin rango explícito se grafica desde el primer día con ventas hasta hoy (hora de Chile)
+        if not fecha_fin:
+            fecha_fin = datetime.now(BUSINESS_TZ).date() + timedelta(days=1)
+        if not fecha_inicio:
+            primer_dia = db.session.query(func.min(SalesDailyRollup.fecha)).scalar()
+            fecha_inicio = min(primer_dia, fecha_fin - timedelta(days=1)) if primer_dia else fecha_fin - timedelta(days=30)
+        if fecha_inicio >= fecha_fin:
+            return jsonify({'error': 'La fecha de inicio debe ser anterior a la fecha fin'}), 400
+
+        granularidad = request.args.get('granularidad', 'auto')
+        max_puntos = min(max(request.args.get('max_puntos', MAX_PUNTOS_GRAFICO, type=int), 3), 1000)
+        comparar = request.args.get('comparar')
+        if granularidad != 'auto' and granularidad not in GRANULARIDADES_GRAFICO:
+            return jsonify({'error': f'Granularidad inválida: {granularidad}'}), 400
+        if comparar and comparar not in COMPARACIONES_GRAFICO:
+            return jsonify({'error': f'Comparación inválida: {comparar}'}), 400
+        if granularidad == 'auto':
+            granularidad = choose_chart_granularity(fecha_inicio, fecha_fin, max_puntos)
+
+        # Filtros opcionales por método de pago y usuario
+        filtros = {
+            'metodo_pago': request.args.get('metodo_pago'),
+            'user_id': request.args.get('user_id', type=int)
+        }
 
-        # Retornar datos en formato JSON para los gráficos
-        return jsonify({
+        serie = load_chart_series(fecha_inicio, fecha_fin, granularidad, **filtros)
+        totales = {'ventas': sum(serie['ventas']), 'cantidad': sum(serie['cantidad'])}
+
+        comparacion = None
+        if comparar:
+            desplazamiento = COMPARACIONES_GRAFICO[comparar] or (fecha_fin - fecha_inicio)
+            comp_inicio = fecha_inicio - desplazamiento
+            comp_fin = fecha_fin - desplazamiento
+            comparacion = load_chart_series(comp_inicio, comp_fin, granularidad, **filtros)
+            # Alinear por posición con la serie actual
+            largo = len(serie['labels'])
+            for columna, relleno in (('labels', ''), ('ventas', 0.0), ('cantidad', 0)):
+                valores = comparacion[columna][:largo]
+                comparacion[columna] = valores + [relleno] * (largo - len(valores))
+            comparacion['fecha_inicio'] = comp_inicio.strftime('%Y-%m-%d')
+            comparacion['fecha_fin'] = (comp_fin - timedelta(days=1)).strftime('%Y-%m-%d')
+            comparacion['totales'] = {'ventas': sum(comparacion['ventas']), 'cantidad': sum(comparacion['cantidad'])}
+
+        # Reducir puntos conservando la forma de la serie de ventas
+        puntos_originales = len(serie['labels'])
+        if puntos_originales > max_puntos:
+            indices = lttb_indices(serie['ventas'], max_puntos)
+            serie = downsample_series(serie, indices)
+            if comparacion:
+                comparacion.update(downsample_series(
+                    {columna: comparacion[columna] for columna in ('labels', 'ventas', 'cantidad')},
+                    indices
+                ))
+
+        respuesta = {
             'ventas': {
-                'labels': labels,
-                'data': ventas_data
+                'labels': serie['labels'],
+                'data': serie['ventas']
             },
             'cantidad': {
-                'labels': labels,
-                'data': cantidad_data
+                'labels': serie['labels'],
+                'data': serie['cantidad']
+            },
+            'granularidad': granularidad,
+            'fecha_inicio': fecha_inicio.strftime('%Y-%m-%d'),
+            'fecha_fin': (fecha_fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+            'puntos_originales': puntos_originales,
+            'totales': totales
+        }
+        if comparacion:
+            respuesta['comparacion'] = {
+                'tipo': comparar,
+                'fecha_inicio': comparacion['fecha_inicio'],
+                'fecha_fin': comparacion['fecha_fin'],
+                'ventas': {
+                    'labels': comparacion['labels'],
+                    'data': comparacion['ventas']
+                },
+                'cantidad': {
+                    'labels': comparacion['labels'],
+                    'data': comparacion['cantidad']
+                },
+                'totales': comparacion['totales']
             }
-        })
+
+        # Retornar datos en formato JSON para los gráficos
+        return jsonify(respuesta)
 
     except Exception as e:
         import traceback
@@ -2658,61 +4751,26 @@ def ver_graficos_turnos():
 def get_turnos_historial():
     try:
         # Obtener parámetros de fecha
-        fecha_inicio = request.args.get('fecha_inicio')
-        fecha_fin = request.args.get('fecha_fin')
-        
-        # Configurar la zona horaria de Chile/Santiago
-        chile_tz = pytz.timezone('America/Santiago')
+        fecha_inicio, fecha_fin = parse_date_range(
+            request.args.get('fecha_inicio'),
+            request.args.get('fecha_fin')
+        )
         
-        # Query base
-        query = db.session.query(
-            Turno,
-            User,
-            func.coalesce(func.sum(Sale.total), 0).label('total_ventas'),
-            func.count(Sale.id).label('num_ventas'),
-            func.coalesce(func.sum(case((Devolucion.id != None, Devolucion.total), else_=0)), 0).label('total_devoluciones'),
-            func.count(Devolucion.id).label('num_devoluciones')
-        ).join(User, Turno.user_id == User.id)\
-         .outerjoin(Sale, Sale.turno_id == Turno.id)\
-         .outerjoin(Devolucion, Devolucion.turno_id == Turno.id)
-        
-        # Aplicar filtros de fecha si se proporcionan
-        if fecha_inicio:
-            fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
-            query = query.filter(Turno.fecha_inicio >= fecha_inicio)
-
-        if fecha_fin:
-            fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
-            fecha_fin = fecha_fin + timedelta(days=1)  # Incluir todo el día final
-            query = query.filter(Turno.fecha_inicio < fecha_fin)
-        
-        # Agrupar y ordenar resultados
-        results = query.group_by(Turno.id, User.id)\
-                      .order_by(Turno.fecha_inicio.desc())\
-                      .all()        # Formatear resultados
+        # Formatear resultados
         turnos_list = []
-        for turno, user, total_ventas, num_ventas, total_devoluciones, num_devoluciones in results:
-            fecha_apertura_str = None
-            fecha_cierre_str = None
-            
-            if turno.fecha_inicio:
-                fecha_apertura_str = turno.fecha_inicio.astimezone(chile_tz).strftime('%Y-%m-%d %H:%M:%S')
-            
-            if turno.fecha_cierre:
-                fecha_cierre_str = turno.fecha_cierre.astimezone(chile_tz).strftime('%Y-%m-%d %H:%M:%S')
-            
+        for turno, username, totales in iter_turnos_historial(fecha_inicio, fecha_fin):
             turno_dict = {
                 'turno_id': turno.id,
-                'usuario': user.username,
-                'fecha_inicio': fecha_apertura_str,
-                'fecha_cierre': fecha_cierre_str,
+                'usuario': username,
+                'fecha_inicio': turno.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S') if turno.fecha_inicio else None,
+                'fecha_cierre': turno.fecha_cierre.strftime('%Y-%m-%d %H:%M:%S') if turno.fecha_cierre else None,
                 'activo': turno.activo,
-                'total_ventas': float(total_ventas),
-                'num_ventas': num_ventas or 0,
-                'total_devoluciones': float(total_devoluciones),
-                'num_devoluciones': num_devoluciones or 0,
-                'total_efectivo': float(turno.total_efectivo),
-                'total_tarjeta': float(turno.total_tarjeta),
+                'total_ventas': float(totales['total_ventas']),
+                'num_ventas': totales['cantidad_ventas'],
+                'total_devoluciones': float(totales['total_devoluciones']),
+                'num_devoluciones': totales['cantidad_devoluciones'],
+                'total_efectivo': float(totales['total_efectivo']),
+                'total_tarjeta': float(totales['total_tarjeta']),
                 'cantidad_ventas': int(turno.cantidad_ventas),
                 'cantidad_devoluciones': int(turno.cantidad_devoluciones)
             }
@@ -2723,352 +4781,293 @@ def get_turnos_historial():
     except Exception as e:
         print(f"Error en get_turnos_historial: {str(e)}")
         return jsonify({'error': str(e)}), 500
+
+TURNOS_EXCEL_COLUMNAS = [
+    # (encabezado, ancho, formato)
+    ('ID', 8, None),
+    ('Usuario', 15, None),
+    ('Fecha Apertura', 20, 'yyyy-mm-dd hh:mm:ss'),
+    ('Fecha Cierre', 20, 'yyyy-mm-dd hh:mm:ss'),
+    ('Total Ventas', 15, '#,##0.00'),
+    ('Ventas en Efectivo', 18, '#,##0.00'),
+    ('Ventas con Tarjeta', 18, '#,##0.00'),
+    ('Num. Ventas', 12, '#,##0'),
+    ('Total Devoluciones', 18, '#,##0.00'),
+    ('Num. Devoluciones', 15, '#,##0'),
+    ('Estado', 10, None)
+]
+
+def export_spool():
+    """Archivo temporal privado para armar exportaciones (en memoria hasta EXPORT_SPOOL_MAX_SIZE, luego en disco)"""
+    return tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE, dir=EXPORT_TMP_FOLDER)
+
+def track_progress(rows, progress=None, every=200):
+    """Recorre `rows` informando cada `every` filas la cantidad procesada a `progress`"""
+    procesados = 0
+    for procesados, row in enumerate(rows, 1):
+        yield row
+        if progress and procesados % every == 0:
+            progress(procesados)
+    if progress:
+        progress(procesados)
+
+def write_excel_rows(output, titulo, columnas, filas):
+    """Escribe una hoja write-only en `output` a partir de un iterable de filas.
+
+    `columnas` es una lista de (encabezado, ancho, formato). Las filas se escriben
+    a medida que llegan, por lo que la memoria usada no depende de su cantidad.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet(titulo)
+    
+    # En modo write-only los anchos deben definirse antes de escribir filas
+    for col, (_, ancho, _) in enumerate(columnas, 1):
+        ws.column_dimensions[get_column_letter(col)].width = ancho
+    
+    header_font = Font(bold=True)
+    header_alignment = Alignment(horizontal='center')
+    number_alignment = Alignment(horizontal='right')
+    
+    def celda(value, formato=None):
+        cell = WriteOnlyCell(ws, value=value)
+        if formato:
+            cell.number_format = formato
+            if formato.startswith('#'):
+                cell.alignment = number_alignment
+        return cell
+    
+    encabezados = []
+    for header, _, _ in columnas:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = header_font
+        cell.alignment = header_alignment
+        encabezados.append(cell)
+    ws.append(encabezados)
+    
+    for valores in filas:
+        ws.append([celda(valor, formato) for valor, (_, _, formato) in zip(valores, columnas)])
+    
+    wb.save(output)
+
+def write_turnos_excel(output, fecha_inicio=None, fecha_fin=None, progress=None):
+    """Escribe el historial de turnos en `output` leyendo los turnos por bloques"""
+    def filas():
+        for turno, username, totales in iter_turnos_historial(fecha_inicio, fecha_fin):
+            # Turno guarda la hora local, se exporta tal cual
+            yield [
+                turno.id,
+                username,
+                turno.fecha_inicio,
+                turno.fecha_cierre if turno.fecha_cierre else "Abierto",
+                float(totales['total_ventas'] or 0.0),
+                float(totales['total_efectivo'] or 0.0),
+                float(totales['total_tarjeta'] or 0.0),
+                int(totales['cantidad_ventas'] or 0),
+                float(totales['total_devoluciones'] or 0.0),
+                int(totales['cantidad_devoluciones'] or 0),
+                "Activo" if turno.activo else "Cerrado"
+            ]
+    
+    write_excel_rows(output, "Historial de Turnos", TURNOS_EXCEL_COLUMNAS, track_progress(filas(), progress))
+
+PDF_FILAS_POR_TABLA = 35  # filas por tabla, aproximadamente una página
+PDF_ESTILO_TABLA = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 9),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('BOX', (0, 0), (-1, -1), 2, colors.black),
+    ('GRID', (0, 0), (-1, 0), 2, colors.black)
+])
+TURNOS_PDF_COLUMNAS = [
+    # (encabezado, ancho en puntos)
+    ('ID', 35), ('Usuario', 75), ('Fecha Apertura', 100), ('Fecha Cierre', 100), ('Total Ventas', 75),
+    ('Num. Ventas', 60), ('Total Dev.', 70), ('Num. Dev.', 55), ('Estado', 55)
+]
+VENTAS_PDF_COLUMNAS = [('Ticket', 150), ('Fecha', 110), ('Método de Pago', 100), ('Items', 60), ('Total', 90)]
+DEVOLUCIONES_PDF_COLUMNAS = [('Ticket', 130), ('Fecha', 110), ('Producto', 160), ('Cantidad', 60), ('Total', 80), ('Motivo', 110)]
+
+def format_clp(valor):
+    return f"${float(valor):,.0f}" if valor else "$0"
+
+def pdf_tables(columnas, filas, size=PDF_FILAS_POR_TABLA):
+    """Divide las filas en tablas de tamaño página con encabezado repetido y anchos fijos
+    (así todas las tablas del reporte quedan alineadas)"""
+    encabezado = [header for header, _ in columnas]
+    anchos = [ancho for _, ancho in columnas]
+    bloque = []
+    for fila in filas:
+        bloque.append(fila)
+        if len(bloque) >= size:
+            yield Table([encabezado] + bloque, colWidths=anchos, repeatRows=1, style=PDF_ESTILO_TABLA)
+            bloque = []
+    if bloque:
+        yield Table([encabezado] + bloque, colWidths=anchos, repeatRows=1, style=PDF_ESTILO_TABLA)
+
+class StreamedDocTemplate(BaseDocTemplate):
+    """Documento de una sola plantilla de página (como SimpleDocTemplate) que se
+    construye desde un generador de flowables sin cargarlos todos en memoria.
+
+    En vez de entregar una lista a build(), se mantiene una lista propia con unos
+    pocos flowables, se rellena desde el generador y cada uno se procesa con
+    handle_flowable(), que también deja al inicio de la lista los restos de una
+    tabla partida entre páginas. Verificado con ReportLab 5.0.1.
+    """
+    def __init__(self, filename, **kw):
+        super().__init__(filename, **kw)
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id='normal')
+        self.addPageTemplates([PageTemplate(id='normal', frames=[frame], pagesize=self.pagesize)])
+    
+    def build_streamed(self, generator, buffer=3):
+        self._startBuild()
+        self.canv._doctemplate = self
+        pendientes = []
+        try:
+            while True:
+                while generator is not None and len(pendientes) < buffer:
+                    try:
+                        pendientes.append(next(generator))
+                    except StopIteration:
+                        generator = None
+                if not pendientes:
+                    break
+                self.clean_hanging()
+                self.handle_flowable(pendientes)
+        finally:
+            del self.canv._doctemplate
+        self._endBuild()
+
+def turno_detail_flowables(turno, username, styles):
+    """Sección de detalle de un turno: sus ventas y devoluciones, leídas por bloques"""
+    apertura = turno.fecha_inicio.strftime('%Y-%m-%d %H:%M')
+    cierre = turno.fecha_cierre.strftime('%Y-%m-%d %H:%M') if turno.fecha_cierre else 'Abierto'
+    yield Paragraph(f"Turno #{turno.id} - {username} ({apertura} / {cierre})", styles['Heading3'])
+    
+    # Correlacionada por venta: la resuelve el índice de sale_items.sale_id sin recorrer toda la tabla
+    items_por_venta = select(func.count(SaleItem.id)).where(SaleItem.sale_id == Sale.id).scalar_subquery()
+    ventas = db.session.query(Sale.ticket_number, Sale.fecha_venta, Sale.metodo_pago, Sale.total, items_por_venta)\
+                       .filter(Sale.turno_id == turno.id)\
+                       .order_by(Sale.fecha_venta, Sale.id)\
+                       .yield_per(500)
+    filas_ventas = (
+        [ticket, to_local_time(fecha).strftime('%Y-%m-%d %H:%M:%S'), metodo_pago, str(items or 0), format_clp(total)]
+        for ticket, fecha, metodo_pago, total, items in ventas
+    )
+    hay_ventas = False
+    for table in pdf_tables(VENTAS_PDF_COLUMNAS, filas_ventas):
+        if not hay_ventas:
+            yield Paragraph("Ventas", styles['Heading4'])
+            hay_ventas = True
+        yield table
+    if not hay_ventas:
+        yield Paragraph("Sin ventas", styles['Normal'])
+    
+    devoluciones = db.session.query(Devolucion.ticket_number, Devolucion.fecha_devolucion, Devolucion.article_title,
+                                    Devolucion.quantity, Devolucion.total, Devolucion.motivo)\
+                             .filter(Devolucion.turno_id == turno.id)\
+                             .order_by(Devolucion.fecha_devolucion, Devolucion.id)\
+                             .yield_per(500)
+    filas_devoluciones = (
+        [ticket, to_local_time(fecha).strftime('%Y-%m-%d %H:%M:%S') if fecha else '', titulo[:35], str(cantidad),
+         format_clp(total), (motivo or '')[:25]]
+        for ticket, fecha, titulo, cantidad, total, motivo in devoluciones
+    )
+    hay_devoluciones = False
+    for table in pdf_tables(DEVOLUCIONES_PDF_COLUMNAS, filas_devoluciones):
+        if not hay_devoluciones:
+            yield Paragraph("Devoluciones", styles['Heading4'])
+            hay_devoluciones = True
+        yield table
+
+def write_turnos_pdf(output, fecha_inicio=None, fecha_fin=None, progress=None, detalle=False):
+    """Escribe el historial de turnos en PDF dentro de `output`.
+
+    Las filas se agrupan en tablas de una página con encabezado repetido y los
+    flowables se generan a medida que ReportLab los consume. Con `detalle` se
+    agrega una sección por turno con sus ventas y devoluciones.
+    """
+    doc = StreamedDocTemplate(output, pagesize=landscape(letter))
+    styles = getSampleStyleSheet()
+    
+    def flowables():
+        yield Paragraph("Historial de Turnos", styles['Heading1'])
         
-        if fecha_inicio and fecha_fin:
-            query = query.filter(
-                Turno.fecha_inicio >= fecha_inicio,
-                Turno.fecha_cierre <= fecha_fin
-            )
-        
-        turnos = query.group_by(Turno.id)\
-                      .order_by(Turno.fecha_inicio.desc())\
-                      .all()
-        
-        return jsonify([{
-            'turno_id': turno.turno_id,
-            'fecha_inicio': turno.fecha_inicio.isoformat(),
-            'fecha_cierre': turno.fecha_cierre.isoformat() if turno.fecha_cierre else None,
-            'usuario': turno.usuario,
-            'total_ventas': float(turno.total_ventas),
-            'total_efectivo': float(turno.total_efectivo),
-            'total_tarjeta': float(turno.total_tarjeta),
-            'cantidad_ventas': turno.cantidad_ventas,
-            'total_devoluciones': float(turno.total_devoluciones),
-            'cantidad_devoluciones': turno.cantidad_devoluciones
-        } for turno in turnos])
-        
-    except Exception as e:
-        print(f"Error en turnos-historial: {str(e)}")
-        return jsonify({'error': 'Error al obtener historial de turnos'}), 500
+        filas = (
+            [
+                str(turno.id),
+                username,
+                turno.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
+                turno.fecha_cierre.strftime('%Y-%m-%d %H:%M:%S') if turno.fecha_cierre else "Abierto",
+                format_clp(totales['total_ventas']),
+                str(totales['cantidad_ventas']),
+                format_clp(totales['total_devoluciones']),
+                str(totales['cantidad_devoluciones']),
+                "Activo" if turno.activo else "Cerrado"
+            ]
+            for turno, username, totales in track_progress(iter_turnos_historial(fecha_inicio, fecha_fin), progress)
+        )
+        yield from pdf_tables(TURNOS_PDF_COLUMNAS, filas)
+        
+        if detalle:
+            yield PageBreak()
+            yield Paragraph("Detalle por Turno", styles['Heading1'])
+            turnos = db.session.query(Turno, User.username)\
+                               .join(User, Turno.user_id == User.id)
+            turnos = local_date_filter(turnos, Turno.fecha_local, fecha_inicio, fecha_fin)
+            for turno, username in turnos.order_by(Turno.fecha_inicio.desc()).yield_per(100):
+                yield from turno_detail_flowables(turno, username, styles)
+    
+    doc.build_streamed(flowables())
 
 @app.route('/turnos-historial/excel', methods=['GET'])
 @permission_required('can_view_shift_history')
 def export_turnos_excel():
-    temp_path = None
     try:
-        # Limpiar archivos temporales antiguos
-        def remove_old_files():
-            try:
-                for filename in os.listdir(UPLOAD_FOLDER):
-                    if filename.startswith('turnos_historial_') and filename.endswith('.xlsx'):
-                        file_path = os.path.join(UPLOAD_FOLDER, filename)
-                        try:
-                            if os.path.isfile(file_path):
-                                os.unlink(file_path)
-                        except PermissionError:
-                            # Si el archivo está en uso, lo intentamos ignorar
-                            continue
-                        except Exception as e:
-                            # Log otros errores pero continuamos
-                            print(f'Error al eliminar archivo {filename}: {e}')
-            except Exception as e:
-                print(f'Error al limpiar archivos temporales: {e}')
-        
-        # Intentar limpiar archivos antiguos, pero no bloquear si falla
-        remove_old_files()
-
-        # Obtener parámetros de fecha
-        fecha_inicio = request.args.get('fecha_inicio')
-        fecha_fin = request.args.get('fecha_fin')
-
-        # Crear un nuevo libro de trabajo
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Historial de Turnos"
-
-        # Configurar estilos
-        header_font = Font(bold=True)
-        header_alignment = Alignment(horizontal='center')
-        
-        # Configurar zona horaria
-        chile_tz = pytz.timezone('America/Santiago')
-
-        # Definir anchos de columna
-        column_widths = {
-            1: 8,   # ID
-            2: 15,  # Usuario
-            3: 20,  # Fecha Apertura
-            4: 20,  # Fecha Cierre
-            5: 15,  # Total Ventas
-            6: 18,  # Ventas en Efectivo
-            7: 18,  # Ventas con Tarjeta
-            8: 12,  # Num. Ventas
-            9: 18,  # Total Devoluciones
-            10: 15, # Num. Devoluciones
-            11: 10  # Estado
-        }
+        fecha_inicio, fecha_fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
         
-        # Escribir encabezados y configurar columnas
-        headers = ['ID', 'Usuario', 'Fecha Apertura', 'Fecha Cierre', 'Total Ventas', 'Ventas en Efectivo', 
-                  'Ventas con Tarjeta', 'Num. Ventas', 'Total Devoluciones', 'Num. Devoluciones', 'Estado']
-                  
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col)
-            cell.value = header
-            cell.font = header_font
-            cell.alignment = header_alignment
-            
-            # Establecer ancho de columna
-            ws.column_dimensions[get_column_letter(col)].width = column_widths[col]
-            
-        # Estilo para las celdas con números
-        number_alignment = Alignment(horizontal='right')
-
-        # Query base
-        query = db.session.query(
-            Turno,
-            User,
-            func.coalesce(func.sum(Sale.total), 0).label('total_ventas'),
-            func.count(Sale.id).label('num_ventas'),
-            func.coalesce(func.sum(case((Devolucion.id != None, Devolucion.total), else_=0)), 0).label('total_devoluciones'),
-            func.count(Devolucion.id).label('num_devoluciones')
-        ).join(User, Turno.user_id == User.id)\
-         .outerjoin(Sale, Sale.turno_id == Turno.id)\
-         .outerjoin(Devolucion, Devolucion.turno_id == Turno.id)
-
-        # Aplicar filtros de fecha si se proporcionan
-        if fecha_inicio:
-            fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
-            query = query.filter(Turno.fecha_inicio >= fecha_inicio)
-        
-        if fecha_fin:
-            fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
-            fecha_fin = fecha_fin + timedelta(days=1)
-            query = query.filter(Turno.fecha_inicio < fecha_fin)
-
-        # Agrupar y ordenar
-        query = query.group_by(Turno.id, User.id)\
-                    .order_by(Turno.fecha_inicio.desc())
-
-        # Escribir datos
-        for row, (turno, user, total_ventas, num_ventas, total_devoluciones, num_devoluciones) in enumerate(query.all(), 2):
-            # ID y Usuario
-            ws.cell(row=row, column=1, value=turno.id)
-            ws.cell(row=row, column=2, value=user.username)
-            
-            # Fechas con formato
-            cell_fecha_inicio = ws.cell(row=row, column=3)
-            fecha_inicio_local = turno.fecha_inicio.astimezone(chile_tz).replace(tzinfo=None)
-            cell_fecha_inicio.value = fecha_inicio_local
-            cell_fecha_inicio.number_format = 'yyyy-mm-dd hh:mm:ss'
-            
-            cell_fecha_cierre = ws.cell(row=row, column=4)
-            if turno.fecha_cierre:
-                fecha_cierre_local = turno.fecha_cierre.astimezone(chile_tz).replace(tzinfo=None)
-                cell_fecha_cierre.value = fecha_cierre_local
-                cell_fecha_cierre.number_format = 'yyyy-mm-dd hh:mm:ss'
-            else:
-                cell_fecha_cierre.value = "Abierto"
-            
-            # Valores monetarios con formato
-            cell_total_ventas = ws.cell(row=row, column=5, value=float(total_ventas if total_ventas is not None else 0.0))
-            cell_total_ventas.number_format = '#,##0.00'
-            cell_total_ventas.alignment = number_alignment
-            
-            cell_total_efectivo = ws.cell(row=row, column=6, value=float(turno.total_efectivo or 0.0))
-            cell_total_efectivo.number_format = '#,##0.00'
-            cell_total_efectivo.alignment = number_alignment
-            
-            cell_total_tarjeta = ws.cell(row=row, column=7, value=float(turno.total_tarjeta or 0.0))
-            cell_total_tarjeta.number_format = '#,##0.00'
-            cell_total_tarjeta.alignment = number_alignment
-            
-            # Cantidades
-            cell_num_ventas = ws.cell(row=row, column=8, value=int(num_ventas or 0))
-            cell_num_ventas.number_format = '#,##0'
-            cell_num_ventas.alignment = number_alignment
-            
-            cell_total_devol = ws.cell(row=row, column=9, value=float(total_devoluciones or 0.0))
-            cell_total_devol.number_format = '#,##0.00'
-            cell_total_devol.alignment = number_alignment
-            
-            cell_num_devol = ws.cell(row=row, column=10, value=int(num_devoluciones or 0))
-            cell_num_devol.number_format = '#,##0'
-            cell_num_devol.alignment = number_alignment
-            
-            # Estado
-            ws.cell(row=row, column=11, value="Activo" if turno.activo else "Cerrado")
-            ws.cell(row=row, column=8, value=int(num_ventas or 0)).number_format = '#,##0'
-            ws.cell(row=row, column=9, value=float(total_devoluciones or 0.0)).number_format = '#,##0.00'
-            ws.cell(row=row, column=10, value=int(num_devoluciones or 0)).number_format = '#,##0'
-            
-            # Estado
-            ws.cell(row=row, column=11, value="Activo" if turno.activo else "Cerrado")
-
-        # Ajustar ancho de columnas y aplicar formatos
-        for column in ws.columns:
-            max_length = 0
-            column = list(column)
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2)
-            ws.column_dimensions[column[0].column_letter].width = adjusted_width
-
-            # Aplicar formato de moneda a columnas específicas
-            if column[0].column in [5, 6, 7, 9]:  # Columnas con valores monetarios
-                for cell in column[1:]:  # Excluir el encabezado
-                    cell.number_format = '#,##0.00'
-
+        # El archivo se arma en un spool privado (nunca en la carpeta pública de uploads)
+        output = export_spool()
         try:
-            # Guardar archivo temporalmente con nombre único
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-            temp_filename = f"turnos_historial_{timestamp}.xlsx"
-            temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-            
-            # Intentar guardar el archivo
-            max_retries = 3
-            retry_delay = 0.5  # segundos
-            
-            for attempt in range(max_retries):
-                try:
-                    wb.save(temp_path)
-                    # Si el guardado fue exitoso, salimos del bucle
-                    break
-                except PermissionError as e:
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-                        # Intentar con un nuevo nombre si falla
-                        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
-                        temp_filename = f"turnos_historial_{timestamp}.xlsx"
-                        temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
-                    else:
-                        raise e
-            if not os.path.exists(temp_path):
-                raise Exception("El archivo no se pudo crear correctamente")
-
-            # Enviar archivo
-            return send_file(
-                temp_path,
-                mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                as_attachment=True,
-                download_name='historial_turnos.xlsx'
-            )
-        except Exception as e:
-            print(f"Error al guardar o enviar el archivo Excel: {str(e)}")
-            return jsonify({'error': 'Error al exportar a Excel'}), 500
-        finally:
-            # Intentar eliminar el archivo temporal después de enviarlo
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except Exception as e:
-                print(f"Error al eliminar archivo temporal: {str(e)}")
+            write_turnos_excel(output, fecha_inicio, fecha_fin)
+            output.seek(0)
+        except Exception:
+            output.close()
+            raise
+        
+        # send_file cierra el spool al terminar de enviar la respuesta
+        return send_file(
+            output,
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            as_attachment=True,
+            download_name='historial_turnos.xlsx'
+        )
     
     except Exception as e:
         print(f"Error en export_turnos_excel: {str(e)}")
-        return jsonify({'error': str(e)}), 500
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return jsonify({'error': 'Error al exportar a Excel'}), 500
 
 @app.route('/turnos-historial/pdf', methods=['GET'])
 @permission_required('can_view_shift_history')
 def export_turnos_pdf():
     try:
-        # Obtener parámetros de fecha
-        fecha_inicio = request.args.get('fecha_inicio')
-        fecha_fin = request.args.get('fecha_fin')
-
-        # Configurar zona horaria
-        chile_tz = pytz.timezone('America/Santiago')
-
-        # Crear documento PDF
-        temp_filename = f"turnos_historial_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], temp_filename)
-        doc = SimpleDocTemplate(temp_path, pagesize=letter)
-
-        # Crear elementos del PDF
-        elements = []
-        
-        # Estilo para el título
-        styles = getSampleStyleSheet()
-        title_style = styles['Heading1']
-        title = Paragraph("Historial de Turnos", title_style)
-        elements.append(title)
-
-        # Query base
-        query = db.session.query(
-            Turno,
-            User,
-            func.coalesce(func.sum(Sale.total), 0).label('total_ventas'),
-            func.count(Sale.id).label('num_ventas'),
-            func.coalesce(func.sum(case((Devolucion.id != None, Devolucion.total), else_=0)), 0).label('total_devoluciones'),
-            func.count(Devolucion.id).label('num_devoluciones')
-        ).join(User, Turno.user_id == User.id)\
-         .outerjoin(Sale, Sale.turno_id == Turno.id)\
-         .outerjoin(Devolucion, Devolucion.turno_id == Turno.id)
-
-        # Aplicar filtros de fecha si se proporcionan
-        if fecha_inicio:
-            fecha_inicio = datetime.strptime(fecha_inicio, '%Y-%m-%d')
-            query = query.filter(Turno.fecha_inicio >= fecha_inicio)
-        
-        if fecha_fin:
-            fecha_fin = datetime.strptime(fecha_fin, '%Y-%m-%d')
-            fecha_fin = fecha_fin + timedelta(days=1)
-            query = query.filter(Turno.fecha_inicio < fecha_fin)
-
-        # Agrupar y ordenar
-        query = query.group_by(Turno.id, User.id)\
-                    .order_by(Turno.fecha_inicio.desc())
-
-        # Crear tabla de datos
-        data = [['ID', 'Usuario', 'Fecha Apertura', 'Fecha Cierre', 'Total Ventas', 
-                'Num. Ventas', 'Total Dev.', 'Num. Dev.', 'Estado']]
-
-        for turno, user, total_ventas, num_ventas, total_devoluciones, num_devoluciones in query.all():
-            row = [
-                str(turno.id),
-                user.username,
-                turno.fecha_inicio.astimezone(chile_tz).strftime('%Y-%m-%d %H:%M:%S'),
-                turno.fecha_cierre.astimezone(chile_tz).strftime('%Y-%m-%d %H:%M:%S') if turno.fecha_cierre else "Abierto",
-                f"${float(total_ventas):,.0f}" if total_ventas else "$0",
-                str(num_ventas),
-                f"${float(total_devoluciones):,.0f}" if total_devoluciones else "$0",
-                str(num_devoluciones),
-                "Activo" if turno.activo else "Cerrado"
-            ]
-            data.append(row)
-
-        # Crear tabla y establecer estilo
-        table = Table(data)
-        style = TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, 0), 11),
-            ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-            ('FONTSIZE', (0, 1), (-1, -1), 10),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-            ('BOX', (0, 0), (-1, -1), 2, colors.black),
-            ('GRID', (0, 0), (-1, 0), 2, colors.black)
-        ])
-        table.setStyle(style)
+        fecha_inicio, fecha_fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
+        detalle = request.args.get('detalle', 'false').lower() in ('1', 'true', 'si')
         
-        # Añadir tabla al documento
-        elements.append(table)
+        output = export_spool()
+        try:
+            write_turnos_pdf(output, fecha_inicio, fecha_fin, detalle=detalle)
+            output.seek(0)
+        except Exception:
+            output.close()
+            raise
         
-        # Generar PDF
-        doc.build(elements)
-
         # Enviar archivo
         return send_file(
-            temp_path,
+            output,
             mimetype='application/pdf',
             as_attachment=True,
             download_name='historial_turnos.pdf'
@@ -3077,102 +5076,825 @@ def export_turnos_pdf():
     except Exception as e:
         print(f"Error en export_turnos_pdf: {str(e)}")
         return jsonify({'error': str(e)}), 500
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-        
-        query = db.session.query(
-            Turno.id.label('turno_id'),
-            Turno.fecha_inicio,
-            Turno.fecha_cierre,
-            User.username.label('usuario'),
-            func.coalesce(func.sum(Sale.total), 0).label('total_ventas'),
-            func.coalesce(func.sum(case((Sale.metodo_pago == 'efectivo', Sale.total), else_=0)), 0).label('total_efectivo'),
-            func.coalesce(func.sum(case((Sale.metodo_pago == 'tarjeta', Sale.total), else_=0)), 0).label('total_tarjeta'),
-            func.coalesce(func.count(Sale.id), 0).label('cantidad_ventas'),
-            # Campos de devoluciones
-            func.coalesce(Turno.total_devoluciones, 0).label('total_devoluciones'),
-            func.coalesce(Turno.cantidad_devoluciones, 0).label('cantidad_devoluciones')
-        ).join(User, Turno.user_id == User.id)\
-         .outerjoin(Sale, Turno.id == Sale.turno_id)\
-         .filter(Turno.activo == False)
-        
-        if fecha_inicio and fecha_fin:
-            query = query.filter(
-                func.date(Turno.fecha_inicio) >= fecha_inicio,
-                func.date(Turno.fecha_inicio) <= fecha_fin
-            )
-        
-        turnos = query.group_by(Turno.id)\
-                      .order_by(Turno.fecha_inicio.desc())\
-                      .all()
-        
-        return jsonify([{
-            'turno_id': turno.turno_id,
-            'fecha_inicio': turno.fecha_inicio.isoformat(),
-            'fecha_cierre': turno.fecha_cierre.isoformat() if turno.fecha_cierre else None,
-            'usuario': turno.usuario,
-            'total_ventas': float(turno.total_ventas),
-            'total_efectivo': float(turno.total_efectivo),
-            'total_tarjeta': float(turno.total_tarjeta),
-            'cantidad_ventas': turno.cantidad_ventas,
-            'total_devoluciones': float(turno.total_devoluciones),  
-            'cantidad_devoluciones': turno.cantidad_devoluciones  
-        } for turno in turnos])
-        
-    except Exception as e:
-        print(f"Error en turnos-historial: {str(e)}")
-        return jsonify({'error': 'Error al obtener historial de turnos'}), 500
 
 @app.route('/turnos/<int:turno_id>/ventas', methods=['GET'])
 @permission_required('can_view_shift_history')
 def get_ventas_turno(turno_id):
+    """Ventas de un turno.
+
+    Por defecto devuelve la lista completa; con formato=ndjson la envía línea a
+    línea y con 'cursor' (vacío para la primera página) pagina por (fecha_venta, id).
+    """
     try:
         # Verificar que el turno existe
         turno = Turno.query.get(turno_id)
         if not turno:
             return jsonify({'error': 'Turno no encontrado'}), 404
         
-        # Obtener ventas del turno
-        ventas = Sale.query.filter_by(turno_id=turno_id)\
-                          .order_by(Sale.fecha_venta.desc())\
-                          .all()
-        
-        result = []
-        for venta in ventas:
-            # Obtener items de la venta
-            items = SaleItem.query.filter_by(sale_id=venta.id).all()
-            
-            venta_data = {
+        def venta_data(venta):
+            return {
                 'id': venta.id,
                 'ticket_number': venta.ticket_number,
                 'total': float(venta.total),
                 'metodo_pago': venta.metodo_pago,
                 'fecha_venta': venta.fecha_venta.isoformat(),
                 'user': venta.user.username if venta.user else 'Desconocido',
-                'items_count': len(items),
+                'items_count': len(venta.items),
                 'nota': venta.nota,  # Incluir la nota de la venta
-                'items': []
+                'items': [
+                    {
+                        'article_title': item.article_title,
+                        'quantity': item.quantity,
+                        'unit_price': float(item.unit_price),
+                        'subtotal': float(item.subtotal)
+                    }
+                    for item in venta.items
+                ]
             }
-            
-            # Agregar items de la venta
-            for item in items:
-                item_data = {
-                    'article_title': item.article_title,
-                    'quantity': item.quantity,
-                    'unit_price': float(item.unit_price),
-                    'subtotal': float(item.subtotal)
-                }
-                venta_data['items'].append(item_data)
-            
-            result.append(venta_data)
         
-        return jsonify(result)
+        query = sales_listing_query(turno_id)
+        
+        if wants_ndjson():
+            ventas = query.order_by(Sale.fecha_venta.desc(), Sale.id.desc()).yield_per(200)
+            return ndjson_response(venta_data(venta) for venta in ventas)
+        
+        if 'cursor' in request.args:
+            try:
+                ventas, meta = keyset_page(query, Sale.fecha_venta, Sale.id)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'ventas': [venta_data(venta) for venta in ventas], **meta})
+        
+        ventas = query.order_by(Sale.fecha_venta.desc(), Sale.id.desc()).all()
+        return jsonify([venta_data(venta) for venta in ventas])
         
     except Exception as e:
         print(f"Error al obtener ventas del turno: {str(e)}")
         return jsonify({'error': 'Error al obtener ventas del turno'}), 500
 
+# =====================
+# ANALÍTICA DE VENTAS
+# =====================
+
+# Métricas de ventas por artículo/categoría, leídas desde article_daily_rollup
+ORDENES_ANALITICA = ('ingresos', 'cantidad', 'margen')
+ANALITICA_DIAS_DEFAULT = 30
+
+def analytics_date_range():
+    """Rango de días locales [inicio, fin) de la request; por defecto los últimos ANALITICA_DIAS_DEFAULT días"""
+    inicio, fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
+    if fin is None:
+        fin = datetime.combine(datetime.now(BUSINESS_TZ).date() + timedelta(days=1), datetime.min.time())
+    if inicio is None:
+        inicio = fin - timedelta(days=ANALITICA_DIAS_DEFAULT)
+    if inicio >= fin:
+        raise ValueError('La fecha de inicio debe ser anterior a la fecha fin')
+    return inicio, fin
+
+def analytics_columns():
+    """Agregados netos de devoluciones sobre ArticleDailyRollup"""
+    ingresos = func.coalesce(func.sum(ArticleDailyRollup.total_ventas), 0)
+    devoluciones = func.coalesce(func.sum(ArticleDailyRollup.total_devoluciones), 0)
+    cantidad = func.coalesce(func.sum(ArticleDailyRollup.cantidad_vendida), 0)
+    cantidad_devuelta = func.coalesce(func.sum(ArticleDailyRollup.cantidad_devuelta), 0)
+    margen = func.coalesce(func.sum(ArticleDailyRollup.margen_estimado), 0) - \
+             func.coalesce(func.sum(ArticleDailyRollup.margen_devuelto), 0)
+    return {
+        'ingresos': ingresos.label('ingresos'),
+        'devoluciones': devoluciones.label('devoluciones'),
+        'ingresos_netos': (ingresos - devoluciones).label('ingresos_netos'),
+        'cantidad_vendida': cantidad.label('cantidad_vendida'),
+        'cantidad_devuelta': cantidad_devuelta.label('cantidad_devuelta'),
+        'cantidad_neta': (cantidad - cantidad_devuelta).label('cantidad_neta'),
+        'margen_estimado': margen.label('margen_estimado'),
+        'lineas_venta': func.coalesce(func.sum(ArticleDailyRollup.lineas_venta), 0).label('lineas_venta')
+    }
+
+def analytics_metrics(row, total_ingresos):
+    ingresos_netos = float(row.ingresos_netos)
+    return {
+        'cantidad_vendida': float(row.cantidad_vendida),
+        'cantidad_devuelta': float(row.cantidad_devuelta),
+        'cantidad_neta': float(row.cantidad_neta),
+        'ingresos': float(row.ingresos),
+        'devoluciones': float(row.devoluciones),
+        'ingresos_netos': ingresos_netos,
+        'margen_estimado': round(float(row.margen_estimado), 2),
+        'lineas_venta': int(row.lineas_venta),
+        'participacion': round(ingresos_netos * 100 / total_ingresos, 2) if total_ingresos else 0.0
+    }
+
+def analytics_response(group_query, columnas, describe):
+    """Ejecuta la consulta agrupada del rango, la ordena y arma la respuesta con ranking y totales"""
+    orden = request.args.get('orden', 'ingresos')
+    if orden not in ORDENES_ANALITICA:
+        return jsonify({'error': f'Orden inválido: {orden}'}), 400
+    limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+    try:
+        inicio, fin = analytics_date_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    group_query = local_date_filter(group_query, ArticleDailyRollup.fecha, inicio, fin)
+    orden_columna = {
+        'ingresos': columnas['ingresos_netos'],
+        'cantidad': columnas['cantidad_neta'],
+        'margen': columnas['margen_estimado']
+    }[orden]
+    rows = group_query.order_by(orden_columna.desc()).limit(limit).all()
+    
+    totales_query = db.session.query(*columnas.values())
+    if request.args.get('category_id', type=int):
+        totales_query = totales_query.join(Article, ArticleDailyRollup.article_id == Article.id)\
+                                     .filter(Article.category_id == request.args.get('category_id', type=int))
+    totales_row = local_date_filter(totales_query, ArticleDailyRollup.fecha, inicio, fin).one()
+    total_ingresos = float(totales_row.ingresos_netos)
+    
+    return jsonify({
+        'fecha_inicio': inicio.strftime('%Y-%m-%d'),
+        'fecha_fin': (fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'orden': orden,
+        'resultados': [
+            dict(ranking=ranking, **describe(row), **analytics_metrics(row, total_ingresos))
+            for ranking, row in enumerate(rows, 1)
+        ],
+        'totales': analytics_metrics(totales_row, total_ingresos)
+    })
+
+@app.route('/analytics/articles', methods=['GET'])
+@permission_required('can_view_shift_history')
+def get_article_analytics():
+    """Ventas por artículo en un rango: cantidad, ingresos, devoluciones y margen estimado, con ranking"""
+    try:
+        columnas = analytics_columns()
+        query = db.session.query(
+            ArticleDailyRollup.article_id,
+            Article.title,
+            Article.category_id,
+            Category.name.label('category_name'),
+            *columnas.values()
+        ).outerjoin(Article, ArticleDailyRollup.article_id == Article.id)\
+         .outerjoin(Category, Article.category_id == Category.id)\
+         .group_by(ArticleDailyRollup.article_id, Article.title, Article.category_id, Category.name)
+        
+        category_id = request.args.get('category_id', type=int)
+        if category_id:
+            query = query.filter(Article.category_id == category_id)
+        
+        return analytics_response(query, columnas, lambda row: {
+            'article_id': row.article_id,
+            'title': row.title or 'Producto eliminado',
+            'category_id': row.category_id,
+            'category': row.category_name or 'Sin categoría'
+        })
+        
+    except Exception as e:
+        print(f"Error en analítica por artículo: {str(e)}")
+        return jsonify({'error': 'Error al obtener analítica por artículo'}), 500
+
+@app.route('/analytics/categories', methods=['GET'])
+@permission_required('can_view_shift_history')
+def get_category_analytics():
+    """Ventas por categoría en un rango, con ranking"""
+    try:
+        columnas = analytics_columns()
+        query = db.session.query(
+            Article.category_id,
+            Category.name.label('category_name'),
+            func.count(func.distinct(ArticleDailyRollup.article_id)).label('articulos'),
+            *columnas.values()
+        ).outerjoin(Article, ArticleDailyRollup.article_id == Article.id)\
+         .outerjoin(Category, Article.category_id == Category.id)\
+         .group_by(Article.category_id, Category.name)
+        
+        return analytics_response(query, columnas, lambda row: {
+            'category_id': row.category_id,
+            'category': row.category_name or 'Sin categoría',
+            'articulos': row.articulos
+        })
+        
+    except Exception as e:
+        print(f"Error en analítica por categoría: {str(e)}")
+        return jsonify({'error': 'Error al obtener analítica por categoría'}), 500
+
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+HEATMAP_SEMANAS_DEFAULT = 8
+HEATMAP_ALPHA = 0.3  # peso de la semana más reciente en el suavizado exponencial del pronóstico
+HEATMAP_CACHE_TTL = 6 * 60 * 60  # respaldo; el pronóstico se invalida al actualizar rollups de días pasados
+
+def load_hourly_matrix(inicio, fin, metodo_pago=None, user_id=None):
+    """Matrices (días, 24) de cantidad y monto vendidos por día local [inicio, fin) y hora, con ceros donde no hubo ventas"""
+    n_dias = (fin - inicio).days
+    cantidad = np.zeros((n_dias, 24))
+    ventas = np.zeros((n_dias, 24))
+    
+    query = db.session.query(
+        SalesHourlyRollup.fecha,
+        SalesHourlyRollup.hora,
+        func.sum(SalesHourlyRollup.cantidad_ventas),
+        func.sum(SalesHourlyRollup.total_ventas)
+    ).filter(
+        SalesHourlyRollup.metodo_pago != ROLLUP_DEVOLUCION,
+        SalesHourlyRollup.fecha >= inicio,
+        SalesHourlyRollup.fecha < fin
+    )
+    if metodo_pago:
+        query = query.filter(SalesHourlyRollup.metodo_pago == metodo_pago)
+    if user_id:
+        query = query.filter(SalesHourlyRollup.user_id == user_id)
+    
+    filas = query.group_by(SalesHourlyRollup.fecha, SalesHourlyRollup.hora).all()
+    if filas:
+        dias = np.array([(fecha - inicio).days for fecha, _, _, _ in filas])
+        horas = np.array([hora for _, hora, _, _ in filas])
+        cantidad[dias, horas] = [float(c or 0) for _, _, c, _ in filas]
+        ventas[dias, horas] = [float(v or 0) for _, _, _, v in filas]
+    return cantidad, ventas
+
+def weekday_average(matriz, inicio):
+    """Promedio por (día de semana, hora) de una matriz (días, 24) que empieza en `inicio`"""
+    weekdays = (np.arange(matriz.shape[0]) + inicio.weekday()) % 7
+    suma = np.zeros((7, 24))
+    np.add.at(suma, weekdays, matriz)
+    muestras = np.bincount(weekdays, minlength=7)
+    return suma / np.maximum(muestras, 1)[:, None], muestras
+
+def heatmap_forecast(semanas, metodo_pago=None, user_id=None):
+    """Carga esperada de la próxima semana por (día de semana, hora).
+
+    Usa las últimas `semanas` semanas completas (de lunes a domingo, terminando
+    antes de hoy) y las pondera con suavizado exponencial, dando más peso a las
+    recientes. Se cachea por día hasta que cambien los rollups de días pasados.
+    """
+    hoy = datetime.now(BUSINESS_TZ).date()
+    key = f"heatmap:{hoy}:{semanas}:{metodo_pago}:{user_id}"
+    cacheado = cache_get(key)
+    if cacheado is not None:
+        return cacheado
+    
+    fin = hoy - timedelta(days=hoy.weekday())  # lunes de esta semana
+    inicio = fin - timedelta(weeks=semanas)
+    cantidad, ventas = load_hourly_matrix(inicio, fin, metodo_pago, user_id)
+    
+    # Peso alpha*(1-alpha)^edad, con edad 0 para la semana más reciente
+    edades = np.arange(semanas)[::-1]
+    pesos = HEATMAP_ALPHA * (1 - HEATMAP_ALPHA) ** edades
+    pesos /= pesos.sum()
+    
+    proxima = fin + timedelta(weeks=1)  # lunes de la próxima semana
+    pronostico = {
+        'semana_inicio': proxima.strftime('%Y-%m-%d'),
+        'historia_inicio': inicio.strftime('%Y-%m-%d'),
+        'historia_fin': (fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'semanas_historia': semanas,
+        'cantidad': np.round(np.tensordot(pesos, cantidad.reshape(semanas, 7, 24), axes=1), 2).tolist(),
+        'ventas': np.round(np.tensordot(pesos, ventas.reshape(semanas, 7, 24), axes=1), 2).tolist()
+    }
+    return cache_set(key, pronostico, HEATMAP_CACHE_TTL)
+
+@app.route('/analytics/heatmap', methods=['GET'])
+@permission_required('can_view_shift_history')
+def get_sales_heatmap():
+    """Promedio de ventas (cantidad y monto) por día de semana y hora local, más el pronóstico de la próxima semana"""
+    try:
+        metodo_pago = request.args.get('metodo_pago')
+        user_id = request.args.get('user_id', type=int)
+        semanas = max(1, min(request.args.get('semanas', HEATMAP_SEMANAS_DEFAULT, type=int), 52))
+        
+        inicio, fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
+        fin = fin.date() if fin else datetime.now(BUSINESS_TZ).date() + timedelta(days=1)
+        inicio = inicio.date() if inicio else fin - timedelta(weeks=HEATMAP_SEMANAS_DEFAULT)
+        if inicio >= fin:
+            return jsonify({'error': 'La fecha de inicio debe ser anterior a la fecha fin'}), 400
+        
+        cantidad, ventas = load_hourly_matrix(inicio, fin, metodo_pago, user_id)
+        promedio_cantidad, muestras = weekday_average(cantidad, inicio)
+        promedio_ventas, _ = weekday_average(ventas, inicio)
+        
+        return jsonify({
+            'fecha_inicio': inicio.strftime('%Y-%m-%d'),
+            'fecha_fin': (fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+            'dias': DIAS_SEMANA,
+            'horas': list(range(24)),
+            'cantidad': np.round(promedio_cantidad, 2).tolist(),
+            'ventas': np.round(promedio_ventas, 2).tolist(),
+            'muestras': muestras.tolist(),
+            'pronostico': heatmap_forecast(semanas, metodo_pago, user_id)
+        })
+        
+    except Exception as e:
+        print(f"Error en heatmap de ventas: {str(e)}")
+        return jsonify({'error': 'Error al obtener heatmap de ventas'}), 500
+
+MERMAS_MESES_DEFAULT = 12
+MERMAS_REINCIDENCIA_MESES = 2  # meses con diferencia de conteo desde los que un artículo se considera reincidente
+ORDENES_MERMAS = ('valor', 'cantidad', 'varianza', 'reincidencia')
+
+def shrinkage_month_range():
+    """Rango de meses [inicio, fin) de la request, ajustado a meses completos; por defecto los últimos 12"""
+    inicio, fin = parse_date_range(request.args.get('fecha_inicio'), request.args.get('fecha_fin'))
+    hoy = datetime.now(BUSINESS_TZ).date()
+    fin = (fin.date() - timedelta(days=1)) if fin else hoy
+    fin = (fin.replace(day=1) + timedelta(days=32)).replace(day=1)
+    if inicio is None:
+        inicio = fin
+        for _ in range(MERMAS_MESES_DEFAULT):
+            inicio = (inicio - timedelta(days=1)).replace(day=1)
+    else:
+        inicio = inicio.date().replace(day=1)
+    if inicio >= fin:
+        raise ValueError('La fecha de inicio debe ser anterior a la fecha fin')
+    return inicio, fin
+
+def shrinkage_columns(por_articulo=False):
+    """Agregados de ShrinkageMonthlyRollup: pérdidas registradas y diferencias de conteo.
+
+    Con por_articulo hay una fila por mes en cada grupo, así los meses con
+    diferencia se cuentan sin DISTINCT.
+    """
+    suma = lambda column: func.coalesce(func.sum(column), 0)
+    perdidas_valor = suma(ShrinkageMonthlyRollup.perdidas_valor_costo)
+    diferencia_valor = suma(ShrinkageMonthlyRollup.diferencia_valor_costo)
+    return {
+        'perdidas_cantidad': suma(ShrinkageMonthlyRollup.perdidas_cantidad).label('perdidas_cantidad'),
+        'perdidas_vencido': suma(ShrinkageMonthlyRollup.perdidas_vencido).label('perdidas_vencido'),
+        'perdidas_danado': suma(ShrinkageMonthlyRollup.perdidas_danado).label('perdidas_danado'),
+        'perdidas_registros': suma(ShrinkageMonthlyRollup.perdidas_registros).label('perdidas_registros'),
+        'perdidas_valor_costo': perdidas_valor.label('perdidas_valor_costo'),
+        'ajustes': suma(ShrinkageMonthlyRollup.ajustes).label('ajustes'),
+        'ajustes_faltante': suma(ShrinkageMonthlyRollup.ajustes_faltante).label('ajustes_faltante'),
+        'diferencia_neta': suma(ShrinkageMonthlyRollup.diferencia_neta).label('diferencia_neta'),
+        'diferencia_absoluta': suma(ShrinkageMonthlyRollup.diferencia_absoluta).label('diferencia_absoluta'),
+        'diferencia_valor_costo': diferencia_valor.label('diferencia_valor_costo'),
+        # Las pérdidas registradas restan valor; un faltante en el conteo (diferencia negativa) también
+        'merma_valor_costo': (perdidas_valor - diferencia_valor).label('merma_valor_costo'),
+        'meses_con_diferencia': (
+            func.coalesce(func.sum(case((ShrinkageMonthlyRollup.ajustes > 0, 1), else_=0)), 0) if por_articulo
+            else func.count(func.distinct(case((ShrinkageMonthlyRollup.ajustes > 0, ShrinkageMonthlyRollup.mes), else_=None)))
+        ).label('meses_con_diferencia')
+    }
+
+def shrinkage_metrics(valores):
+    ajustes = int(valores['ajustes'])
+    return {
+        'perdidas_cantidad': round(float(valores['perdidas_cantidad']), 3),
+        'perdidas_vencido': round(float(valores['perdidas_vencido']), 3),
+        'perdidas_danado': round(float(valores['perdidas_danado']), 3),
+        'perdidas_registros': int(valores['perdidas_registros']),
+        'perdidas_valor_costo': round(float(valores['perdidas_valor_costo']), 2),
+        'ajustes': ajustes,
+        'ajustes_faltante': int(valores['ajustes_faltante']),
+        'diferencia_neta': round(float(valores['diferencia_neta']), 3),
+        'varianza_promedio': round(float(valores['diferencia_absoluta']) / ajustes, 3) if ajustes else 0.0,
+        'diferencia_valor_costo': round(float(valores['diferencia_valor_costo']), 2),
+        'merma_valor_costo': round(float(valores['merma_valor_costo']), 2),
+        'meses_con_diferencia': int(valores['meses_con_diferencia'])
+    }
+
+@app.route('/analytics/shrinkage', methods=['GET'])
+@permission_required('can_manage_inventory_losses')
+def get_shrinkage_analytics():
+    """Mermas por artículo o categoría en meses completos: pérdidas registradas y diferencias de los conteos físicos a costo, con serie mensual acumulada y artículos reincidentes"""
+    try:
+        agrupar = request.args.get('agrupar', 'articulo')
+        if agrupar not in ('articulo', 'categoria'):
+            return jsonify({'error': f'Agrupación inválida: {agrupar}'}), 400
+        orden = request.args.get('orden', 'valor')
+        if orden not in ORDENES_MERMAS:
+            return jsonify({'error': f'Orden inválido: {orden}'}), 400
+        limit = max(1, min(request.args.get('limit', 50, type=int), 500))
+        min_meses = max(1, request.args.get('min_meses', MERMAS_REINCIDENCIA_MESES, type=int))
+        category_id = request.args.get('category_id', type=int)
+        try:
+            inicio, fin = shrinkage_month_range()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        columnas = shrinkage_columns()
+        por_articulo = shrinkage_columns(por_articulo=True)
+        
+        def rango(query):
+            query = query.filter(ShrinkageMonthlyRollup.mes >= inicio, ShrinkageMonthlyRollup.mes < fin)
+            if category_id:
+                query = query.filter(ShrinkageMonthlyRollup.article_id.in_(
+                    select(Article.id).where(Article.category_id == category_id)
+                ))
+            return query
+        
+        # Una sola pasada por artículo alimenta el ranking y los reincidentes
+        articulos = rango(db.session.query(ShrinkageMonthlyRollup.article_id, *por_articulo.values()))\
+            .group_by(ShrinkageMonthlyRollup.article_id).all()
+        reincidentes = heapq.nlargest(
+            limit,
+            (row for row in articulos if row.meses_con_diferencia >= min_meses),
+            key=lambda row: (row.meses_con_diferencia, row.diferencia_absoluta)
+        )
+        
+        orden_clave = {
+            'valor': lambda row: row.merma_valor_costo,
+            'cantidad': lambda row: row.perdidas_cantidad - row.diferencia_neta,
+            'varianza': lambda row: row.diferencia_absoluta,
+            'reincidencia': lambda row: row.meses_con_diferencia
+        }[orden]
+        if agrupar == 'articulo':
+            rows = heapq.nlargest(limit, articulos, key=orden_clave)
+        else:
+            rows = rango(db.session.query(
+                Article.category_id, Category.name.label('category_name'),
+                func.count(func.distinct(ShrinkageMonthlyRollup.article_id)).label('articulos'),
+                *columnas.values()
+            ).outerjoin(Article, ShrinkageMonthlyRollup.article_id == Article.id)
+             .outerjoin(Category, Article.category_id == Category.id))\
+                .group_by(Article.category_id, Category.name).all()
+            rows = heapq.nlargest(limit, rows, key=orden_clave)
+        
+        nombres = {}
+        ids = {row.article_id for row in reincidentes}
+        if agrupar == 'articulo':
+            ids.update(row.article_id for row in rows)
+        if ids:
+            nombres = {
+                row.id: row for row in db.session.query(
+                    Article.id, Article.title, Article.category_id, Category.name.label('category_name')
+                ).outerjoin(Category, Article.category_id == Category.id).filter(Article.id.in_(ids))
+            }
+        
+        def describe(row):
+            if agrupar == 'categoria':
+                return {
+                    'category_id': row.category_id,
+                    'category': row.category_name or 'Sin categoría',
+                    'articulos': row.articulos
+                }
+            articulo = nombres.get(row.article_id)
+            return {
+                'article_id': row.article_id,
+                'title': articulo.title if articulo else 'Producto eliminado',
+                'category_id': articulo.category_id if articulo else None,
+                'category': (articulo.category_name if articulo else None) or 'Sin categoría'
+            }
+        
+        # Los totales del rango salen de sumar la serie mensual, sin otra pasada por el rollup
+        serie = rango(db.session.query(ShrinkageMonthlyRollup.mes, *columnas.values()))\
+            .group_by(ShrinkageMonthlyRollup.mes).order_by(ShrinkageMonthlyRollup.mes).all()
+        serie_mensual = []
+        totales = {column: 0 for column in columnas}
+        acumulada = 0.0
+        for row in serie:
+            metricas = shrinkage_metrics(row._mapping)
+            acumulada += metricas['merma_valor_costo']
+            serie_mensual.append(dict(mes=row.mes.strftime('%Y-%m'), merma_acumulada=round(acumulada, 2), **metricas))
+            for column in totales:
+                totales[column] += row._mapping[column]
+        
+        return jsonify({
+            'fecha_inicio': inicio.strftime('%Y-%m-%d'),
+            'fecha_fin': (fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+            'agrupar': agrupar,
+            'orden': orden,
+            'resultados': [
+                dict(ranking=ranking, **describe(row), **shrinkage_metrics(row._mapping))
+                for ranking, row in enumerate(rows, 1)
+            ],
+            'serie_mensual': serie_mensual,
+            'reincidentes': [{
+                'article_id': row.article_id,
+                'title': nombres[row.article_id].title if row.article_id in nombres else 'Producto eliminado',
+                'meses_con_diferencia': int(row.meses_con_diferencia),
+                'ajustes': int(row.ajustes),
+                'diferencia_neta': round(float(row.diferencia_neta), 3),
+                'varianza_promedio': round(float(row.diferencia_absoluta) / row.ajustes, 3) if row.ajustes else 0.0,
+                'diferencia_valor_costo': round(float(row.diferencia_valor_costo), 2)
+            } for row in reincidentes],
+            'totales': shrinkage_metrics(totales)
+        })
+        
+    except Exception as e:
+        print(f"Error en analítica de mermas: {str(e)}")
+        return jsonify({'error': 'Error al obtener analítica de mermas'}), 500
+
+# =====================
+# CLASIFICACIÓN ABC/XYZ
+# =====================
+
+ABC_UMBRALES = (80.0, 95.0)  # % acumulado de ingresos hasta donde llegan las clases A y B
+XYZ_UMBRALES = (0.5, 1.0)  # coeficiente de variación semanal máximo de las clases X e Y
+CLASIFICACION_DIAS_DEFAULT = 90
+CLASIFICACION_BATCH = 50000
+
+def classify_articles(dias=CLASIFICACION_DIAS_DEFAULT, con_xyz=True):
+    """Clasifica todos los artículos activos en A/B/C (y X/Y/Z) y reemplaza article_classifications.
+
+    Lee el rollup diario por artículo de los últimos `dias` días completos por
+    bloques y acumula con NumPy, sin crear objetos por fila.
+    """
+    fin = datetime.now(BUSINESS_TZ).date()
+    inicio = fin - timedelta(days=dias)
+    n_semanas = max(dias // 7, 1)  # semanas completas contadas hacia atrás desde `fin`
+    
+    ids = np.array(sorted(row_id for (row_id,) in db.session.query(Article.id).filter(Article.activo == True)), dtype=np.int64)
+    ingresos = np.zeros(len(ids))
+    cantidad = np.zeros(len(ids))
+    semanal = np.zeros((len(ids), n_semanas))
+    
+    if len(ids):
+        resultado = db.session.execute(
+            select(
+                ArticleDailyRollup.article_id,
+                ArticleDailyRollup.fecha,
+                ArticleDailyRollup.total_ventas - ArticleDailyRollup.total_devoluciones,
+                ArticleDailyRollup.cantidad_vendida - ArticleDailyRollup.cantidad_devuelta
+            ).where(ArticleDailyRollup.fecha >= inicio, ArticleDailyRollup.fecha < fin)
+        ).yield_per(CLASIFICACION_BATCH)
+        
+        for bloque in resultado.partitions():
+            article_ids = np.fromiter((row[0] for row in bloque), dtype=np.int64, count=len(bloque))
+            fechas = np.array([row[1] for row in bloque], dtype='datetime64[D]')
+            montos = np.fromiter((row[2] or 0 for row in bloque), dtype=float, count=len(bloque))
+            cantidades = np.fromiter((row[3] or 0 for row in bloque), dtype=float, count=len(bloque))
+            
+            # Solo artículos activos: los demás no aparecen en ids
+            posiciones = np.clip(np.searchsorted(ids, article_ids), 0, len(ids) - 1)
+            validos = ids[posiciones] == article_ids
+            posiciones = posiciones[validos]
+            semanas = ((np.datetime64(fin, 'D') - fechas[validos]).astype(int) - 1) // 7
+            
+            np.add.at(ingresos, posiciones, montos[validos])
+            np.add.at(cantidad, posiciones, cantidades[validos])
+            # Los días que no completan una semana al inicio de la ventana no entran en el XYZ
+            completas = semanas < n_semanas
+            np.add.at(semanal, (posiciones[completas], semanas[completas]), cantidades[validos][completas])
+    
+    # ABC: orden de Pareto por ingresos; el artículo que cruza el umbral queda en la clase del umbral
+    total = ingresos[ingresos > 0].sum()
+    orden = np.argsort(-ingresos, kind='stable')
+    participacion = np.where(ingresos > 0, ingresos, 0) * 100 / total if total else np.zeros(len(ids))
+    acumulada = np.empty(len(ids))
+    acumulada[orden] = np.cumsum(participacion[orden])
+    previa = acumulada - participacion
+    clases_abc = np.where(ingresos <= 0, 'C',
+                 np.where(previa < ABC_UMBRALES[0], 'A',
+                 np.where(previa < ABC_UMBRALES[1], 'B', 'C')))
+    
+    # XYZ: coeficiente de variación de la demanda semanal; sin demanda = Z
+    coeficientes = np.full(len(ids), np.nan)
+    clases_xyz = np.full(len(ids), None, dtype=object)
+    if con_xyz and len(ids):
+        medias = semanal.mean(axis=1)
+        con_demanda = medias > 0
+        coeficientes[con_demanda] = semanal[con_demanda].std(axis=1) / medias[con_demanda]
+        clases_xyz = np.where(~con_demanda, 'Z',
+                     np.where(coeficientes <= XYZ_UMBRALES[0], 'X',
+                     np.where(coeficientes <= XYZ_UMBRALES[1], 'Y', 'Z'))).astype(object)
+    
+    calculado_en = datetime.utcnow()
+    filas = [
+        {
+            'article_id': int(ids[i]),
+            'clase_abc': str(clases_abc[i]),
+            'clase_xyz': clases_xyz[i] if clases_xyz[i] is None else str(clases_xyz[i]),
+            'ingresos': float(ingresos[i]),
+            'cantidad': float(cantidad[i]),
+            'participacion': round(float(participacion[i]), 4),
+            'participacion_acumulada': round(float(acumulada[i]), 4),
+            'coeficiente_variacion': None if np.isnan(coeficientes[i]) else round(float(coeficientes[i]), 4),
+            'ventana_dias': dias,
+            'calculado_en': calculado_en
+        }
+        for i in range(len(ids))
+    ]
+    
+    db.session.execute(delete(ArticleClassification))
+    for start in range(0, len(filas), CLASIFICACION_BATCH):
+        db.session.execute(insert(ArticleClassification), filas[start:start + CLASIFICACION_BATCH])
+    db.session.commit()
+    
+    resumen = {
+        'articulos': len(ids),
+        'ventana_dias': dias,
+        'fecha_inicio': inicio.strftime('%Y-%m-%d'),
+        'fecha_fin': (fin - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'ingresos_totales': float(total),
+        'abc': {clase: int((clases_abc == clase).sum()) for clase in 'ABC'}
+    }
+    if con_xyz:
+        resumen['xyz'] = {clase: int((clases_xyz == clase).sum()) for clase in 'XYZ'}
+    return resumen
+
+@app.cli.command('classify-articles')
+@click.option('--dias', default=CLASIFICACION_DIAS_DEFAULT, show_default=True, help='Días de ventas a considerar')
+@click.option('--sin-xyz', is_flag=True, help='Calcular solo la clasificación ABC')
+def classify_articles_command(dias, sin_xyz):
+    """Clasifica el catálogo en A/B/C por ingresos y X/Y/Z por variabilidad de la demanda"""
+    resumen = classify_articles(dias, con_xyz=not sin_xyz)
+    print(f"✅ Artículos clasificados: {resumen['articulos']} (ABC {resumen['abc']}, XYZ {resumen.get('xyz')})")
+
+@app.route('/articles/classify', methods=['POST'])
+@admin_required
+def run_article_classification():
+    """Recalcula la clasificación ABC/XYZ del catálogo"""
+    try:
+        data = request.get_json(silent=True) or {}
+        dias = int(data.get('dias', CLASIFICACION_DIAS_DEFAULT))
+        if dias < 7 or dias > 730:
+            return jsonify({'error': 'La ventana debe estar entre 7 y 730 días'}), 400
+        xyz = data.get('xyz', True)
+        con_xyz = xyz is True or str(xyz).lower() in ('1', 'true', 'si')
+        resumen = classify_articles(dias, con_xyz=con_xyz)
+        return jsonify({'message': 'Clasificación actualizada', 'resumen': resumen})
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error al clasificar artículos: {str(e)}")
+        return jsonify({'error': 'Error al clasificar artículos'}), 500
+
+# =====================
+# SUGERENCIAS DE REPOSICIÓN
+# =====================
+
+REPOSICION_DIAS_HISTORIA = 56
+REPOSICION_ALPHA = 0.1  # peso del día más reciente en el suavizado exponencial de la velocidad de venta
+REPOSICION_PLAZO_DIAS = 7  # días entre el pedido y la llegada de la mercadería
+REPOSICION_COBERTURA_DIAS = 14  # días de demanda que debe cubrir el pedido una vez recibido
+REPOSICION_Z = 1.65  # nivel de servicio ~95% para el stock de seguridad
+
+def seconds_until_midnight():
+    ahora = datetime.now(BUSINESS_TZ)
+    manana = BUSINESS_TZ.localize(datetime.combine(ahora.date() + timedelta(days=1), datetime.min.time()))
+    return max((manana - ahora).total_seconds(), 1)
+
+def reorder_demand():
+    """Demanda diaria de todos los artículos activos, calculada en un lote y cacheada hasta la medianoche.
+
+    Lee el rollup diario por artículo de los últimos REPOSICION_DIAS_HISTORIA
+    días completos en una matriz artículos x días y con NumPy obtiene la
+    velocidad suavizada y la desviación diaria de todo el catálogo a la vez;
+    las pérdidas salen de un GROUP BY sobre inventory_losses.
+    """
+    hoy = datetime.now(BUSINESS_TZ).date()
+    key = f"reorder:{hoy}"
+    cacheado = cache_get(key)
+    if cacheado is not None:
+        return cacheado
+    
+    dias = REPOSICION_DIAS_HISTORIA
+    inicio = hoy - timedelta(days=dias)
+    ids = np.array(sorted(row_id for (row_id,) in db.session.query(Article.id).filter(Article.activo == True)), dtype=np.int64)
+    diario = np.zeros((len(ids), dias))
+    perdidas = np.zeros(len(ids))
+    
+    if len(ids):
+        # Por la conexión (Core) y no por la sesión: las filas no pasan por la carga del ORM
+        resultado = db.session.connection().execution_options(yield_per=CLASIFICACION_BATCH).execute(
+            select(
+                ArticleDailyRollup.article_id,
+                # Como texto 'YYYY-MM-DD': NumPy lo convierte en bloque, sin crear un date por fila
+                db.cast(ArticleDailyRollup.fecha, db.String),
+                ArticleDailyRollup.cantidad_vendida - ArticleDailyRollup.cantidad_devuelta
+            ).where(ArticleDailyRollup.fecha >= inicio, ArticleDailyRollup.fecha < hoy)
+        )
+        for bloque in resultado.partitions():
+            article_ids = np.fromiter((row[0] for row in bloque), dtype=np.int64, count=len(bloque))
+            fechas = np.array([row[1][:10] for row in bloque], dtype='datetime64[D]')
+            cantidades = np.fromiter((row[2] or 0 for row in bloque), dtype=float, count=len(bloque))
+            posiciones = np.clip(np.searchsorted(ids, article_ids), 0, len(ids) - 1)
+            validos = ids[posiciones] == article_ids
+            dias_desde_inicio = (fechas[validos] - np.datetime64(inicio, 'D')).astype(int)
+            np.add.at(diario, (posiciones[validos], dias_desde_inicio), cantidades[validos])
+        
+        por_articulo = db.session.query(InventoryLoss.article_id, func.sum(InventoryLoss.cantidad_perdida))\
+            .filter(InventoryLoss.fecha_local >= inicio, InventoryLoss.fecha_local < hoy)\
+            .group_by(InventoryLoss.article_id).all()
+        if por_articulo:
+            article_ids = np.array([row[0] for row in por_articulo], dtype=np.int64)
+            posiciones = np.clip(np.searchsorted(ids, article_ids), 0, len(ids) - 1)
+            validos = ids[posiciones] == article_ids
+            perdidas[posiciones[validos]] = np.array([row[1] or 0 for row in por_articulo], dtype=float)[validos]
+    
+    # Peso alpha*(1-alpha)^edad, con edad 0 para ayer
+    edades = np.arange(dias)[::-1]
+    pesos = REPOSICION_ALPHA * (1 - REPOSICION_ALPHA) ** edades
+    pesos /= pesos.sum()
+    
+    demanda = {
+        'ids': ids,
+        'velocidad': np.clip(diario @ pesos, 0, None),
+        'desviacion': diario.std(axis=1) if len(ids) else np.zeros(0),
+        'perdida_diaria': perdidas / dias,
+        'historia_inicio': inicio.strftime('%Y-%m-%d'),
+        'historia_fin': (hoy - timedelta(days=1)).strftime('%Y-%m-%d'),
+        'calculado_en': datetime.now(BUSINESS_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    }
+    return cache_set(key, demanda, seconds_until_midnight())
+
+def reorder_suggestions(plazo_dias=REPOSICION_PLAZO_DIAS, cobertura_dias=REPOSICION_COBERTURA_DIAS):
+    """Cantidad a pedir de cada artículo activo con el stock actual y la demanda cacheada.
+
+    Se pide cuando el stock no alcanza el punto de reorden (demanda durante el
+    plazo más el stock de seguridad) y se pide hasta cubrir plazo + cobertura.
+    El stock de seguridad es el mayor entre stock_minimo y z * desviación * raíz(plazo).
+    """
+    demanda = reorder_demand()
+    ids = demanda['ids']
+    filas = db.session.query(
+        Article.id, Article.title, Article.stock, Article.stock_minimo, Article.unit_type,
+        Article.category_id, Category.name.label('category_name')
+    ).outerjoin(Category, Article.category_id == Category.id).filter(Article.activo == True).all()
+    articulos = {fila.id: fila for fila in filas}
+    # Los artículos activados después del cálculo quedan fuera hasta el próximo
+    presentes = np.array([int(article_id) in articulos for article_id in ids], dtype=bool)
+    stock = np.array([(articulos[int(article_id)].stock or 0) if presente else 0
+                      for article_id, presente in zip(ids, presentes)], dtype=float)
+    minimo = np.array([(articulos[int(article_id)].stock_minimo or 0) if presente else 0
+                       for article_id, presente in zip(ids, presentes)], dtype=float)
+    
+    diaria = demanda['velocidad'] + demanda['perdida_diaria']
+    seguridad = np.maximum(minimo, REPOSICION_Z * demanda['desviacion'] * np.sqrt(plazo_dias))
+    punto_reorden = diaria * plazo_dias + seguridad
+    objetivo = diaria * (plazo_dias + cobertura_dias) + seguridad
+    sugerida = np.where(presentes & (stock <= punto_reorden), np.maximum(objetivo - stock, 0), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cobertura = np.where(diaria > 0, stock / diaria, np.inf)
+    
+    resultados = []
+    for i in np.flatnonzero(presentes):
+        fila = articulos[int(ids[i])]
+        por_peso = fila.unit_type == 'peso'
+        cantidad = round(float(sugerida[i]), 2) if por_peso else int(np.ceil(sugerida[i]))
+        resultados.append({
+            'article_id': fila.id,
+            'title': fila.title,
+            'category_id': fila.category_id,
+            'category': fila.category_name or 'Sin categoría',
+            'unit_type': fila.unit_type or 'unidades',
+            'stock': fila.stock,
+            'stock_minimo': fila.stock_minimo,
+            'velocidad_diaria': round(float(demanda['velocidad'][i]), 3),
+            'perdida_diaria': round(float(demanda['perdida_diaria'][i]), 3),
+            'demanda_diaria': round(float(diaria[i]), 3),
+            'stock_seguridad': round(float(seguridad[i]), 2),
+            'punto_reorden': round(float(punto_reorden[i]), 2),
+            'dias_cobertura': None if np.isinf(cobertura[i]) else round(float(cobertura[i]), 1),
+            'cantidad_sugerida': cantidad,
+            # Se agota antes de que llegue un pedido hecho hoy
+            'urgente': bool(stock[i] < diaria[i] * plazo_dias)
+        })
+    resultados.sort(key=lambda r: (r['dias_cobertura'] is None, r['dias_cobertura'] or 0, r['article_id']))
+    return demanda, resultados
+
+@app.route('/articles/reorder-suggestions', methods=['GET'])
+@permission_required('can_manage_products')
+def get_reorder_suggestions():
+    """Cantidades a pedir por artículo según la velocidad de venta, las pérdidas, el stock y el plazo de entrega"""
+    try:
+        plazo_dias = request.args.get('plazo_dias', REPOSICION_PLAZO_DIAS, type=int)
+        cobertura_dias = request.args.get('cobertura_dias', REPOSICION_COBERTURA_DIAS, type=int)
+        if not 1 <= plazo_dias <= 180 or not 1 <= cobertura_dias <= 180:
+            return jsonify({'error': 'El plazo y la cobertura deben estar entre 1 y 180 días'}), 400
+        category_id = request.args.get('category_id', type=int)
+        todos = request.args.get('todos', '').lower() in ('1', 'true')
+        limit = max(1, min(request.args.get('limit', 200, type=int), 5000))
+        
+        demanda, resultados = reorder_suggestions(plazo_dias, cobertura_dias)
+        if not todos:
+            resultados = [r for r in resultados if r['cantidad_sugerida'] > 0]
+        if category_id:
+            resultados = [r for r in resultados if r['category_id'] == category_id]
+        
+        return jsonify({
+            'parametros': {
+                'plazo_dias': plazo_dias,
+                'cobertura_dias': cobertura_dias,
+                'historia_inicio': demanda['historia_inicio'],
+                'historia_fin': demanda['historia_fin'],
+                'alpha': REPOSICION_ALPHA,
+                'z': REPOSICION_Z
+            },
+            'calculado_en': demanda['calculado_en'],
+            'total': len(resultados),
+            'urgentes': sum(1 for r in resultados if r['urgente']),
+            'sugerencias': resultados[:limit]
+        })
+        
+    except Exception as e:
+        print(f"Error al calcular sugerencias de reposición: {str(e)}")
+        return jsonify({'error': 'Error al calcular sugerencias de reposición'}), 500
+
+@app.route('/articles/reorder-suggestions/recalcular', methods=['POST'])
+@admin_required
+def recalculate_reorder_suggestions():
+    """Descarta la demanda cacheada y la vuelve a calcular (por defecto se recalcula cada medianoche)"""
+    try:
+        cache_invalidate('reorder:')
+        demanda = reorder_demand()
+        return jsonify({
+            'message': 'Demanda recalculada',
+            'articulos': len(demanda['ids']),
+            'calculado_en': demanda['calculado_en']
+        })
+    except Exception as e:
+        print(f"Error al recalcular sugerencias de reposición: {str(e)}")
+        return jsonify({'error': 'Error al recalcular sugerencias de reposición'}), 500
+
 # =====================
 # HISTORIALES DE AUDITORÍA
 # =====================
@@ -3199,13 +5921,26 @@ def get_product_history():
         if user_id:
             query = query.filter(ProductHistory.user_id == user_id)
         
-        # Paginar y ordenar por fecha descendente
-        history = query.order_by(ProductHistory.timestamp.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        query = query.options(joinedload(ProductHistory.article), joinedload(ProductHistory.user))
+        
+        if 'cursor' in request.args:
+            entries, meta = keyset_page(query, ProductHistory.timestamp, ProductHistory.id, per_page)
+        else:
+            # Paginar y ordenar por fecha descendente
+            history = query.order_by(ProductHistory.timestamp.desc(), ProductHistory.id.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            entries = history.items
+            meta = {
+                'total_pages': history.pages,
+                'current_page': history.page,
+                'total_entries': history.total,
+                'has_next': history.has_next,
+                'has_prev': history.has_prev
+            }
         
         result = []
-        for entry in history.items:
+        for entry in entries:
             entry_data = {
                 'id': entry.id,
                 'article_id': entry.article_id,
@@ -3220,15 +5955,10 @@ def get_product_history():
             }
             result.append(entry_data)
         
-        return jsonify({
-            'history': result,
-            'total_pages': history.pages,
-            'current_page': history.page,
-            'total_entries': history.total,
-            'has_next': history.has_next,
-            'has_prev': history.has_prev
-        })
+        return jsonify({'history': result, **meta})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error obteniendo historial de productos: {str(e)}")
         return jsonify({'error': 'Error al obtener historial de productos'}), 500
@@ -3252,13 +5982,26 @@ def get_physical_count_history():
         if user_id:
             query = query.filter(PhysicalCountHistory.user_id == user_id)
         
-        # Paginar y ordenar por fecha descendente
-        history = query.order_by(PhysicalCountHistory.timestamp.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        query = query.options(joinedload(PhysicalCountHistory.article), joinedload(PhysicalCountHistory.user))
+        
+        if 'cursor' in request.args:
+            entries, meta = keyset_page(query, PhysicalCountHistory.timestamp, PhysicalCountHistory.id, per_page)
+        else:
+            # Paginar y ordenar por fecha descendente
+            history = query.order_by(PhysicalCountHistory.timestamp.desc(), PhysicalCountHistory.id.desc()).paginate(
+                page=page, per_page=per_page, error_out=False
+            )
+            entries = history.items
+            meta = {
+                'total_pages': history.pages,
+                'current_page': history.page,
+                'total_entries': history.total,
+                'has_next': history.has_next,
+                'has_prev': history.has_prev
+            }
         
         result = []
-        for entry in history.items:
+        for entry in entries:
             entry_data = {
                 'id': entry.id,
                 'article_id': entry.article_id,
@@ -3274,15 +6017,10 @@ def get_physical_count_history():
             }
             result.append(entry_data)
         
-        return jsonify({
-            'history': result,
-            'total_pages': history.pages,
-            'current_page': history.page,
-            'total_entries': history.total,
-            'has_next': history.has_next,
-            'has_prev': history.has_prev
-        })
+        return jsonify({'history': result, **meta})
         
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Error obteniendo historial de conteos físicos: {str(e)}")
         return jsonify({'error': 'Error al obtener historial de conteos físicos'}), 500
@@ -3348,6 +6086,487 @@ def get_product_specific_history(article_id):
         print(f"Error obteniendo historial específico: {str(e)}")
         return jsonify({'error': 'Error al obtener historial del producto'}), 500
 
+# =====================
+# TRABAJOS DE REPORTES
+# =====================
+
+# Las exportaciones pesadas se encolan en un pool acotado de hilos y el cliente
+# consulta su estado. Los archivos de periodos cerrados se guardan en un caché
+# direccionado por contenido (tipo + formato + parámetros) y se reutilizan.
+REPORT_WORKERS = 2
+REPORT_MAX_PENDING = 10  # trabajos pendientes o en proceso admitidos a la vez
+REPORT_JOB_TTL = timedelta(hours=1)  # tiempo que se conserva un trabajo terminado
+REPORT_CACHE_TTL = timedelta(days=30)  # un reporte en caché sin pedirse en este tiempo se borra
+REPORT_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'reports')
+os.makedirs(REPORT_CACHE_FOLDER, exist_ok=True)
+
+REPORT_FORMATOS = {
+    'excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'pdf': ('pdf', 'application/pdf')
+}
+
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='reportes')
+report_jobs = {}
+report_jobs_lock = threading.Lock()
+
+def count_turnos(params):
+    inicio, fin = parse_date_range(params.get('fecha_inicio'), params.get('fecha_fin'))
+    return local_date_filter(Turno.query, Turno.fecha_local, inicio, fin).count()
+
+def turnos_period_closed(params):
+    """El periodo está cerrado si ya terminó y no quedan turnos activos dentro de él"""
+    inicio, fin = parse_date_range(params.get('fecha_inicio'), params.get('fecha_fin'))
+    if not fin or fin > now_local():
+        return False
+    query = local_date_filter(Turno.query.filter(Turno.activo == True), Turno.fecha_local, inicio, fin)
+    return query.count() == 0
+
+VENTAS_TURNO_EXCEL_COLUMNAS = [
+    ('Ticket', 22, None),
+    ('Fecha', 20, 'yyyy-mm-dd hh:mm:ss'),
+    ('Usuario', 15, None),
+    ('Método de Pago', 15, None),
+    ('Total Venta', 15, '#,##0.00'),
+    ('Producto', 30, None),
+    ('Cantidad', 10, '#,##0'),
+    ('Precio Unitario', 15, '#,##0.00'),
+    ('Subtotal', 15, '#,##0.00')
+]
+
+def count_ventas_turno(params):
+    return SaleItem.query.join(Sale, SaleItem.sale_id == Sale.id)\
+                         .filter(Sale.turno_id == params['turno_id']).count()
+
+def ventas_turno_closed(params):
+    turno = Turno.query.get(params['turno_id'])
+    return turno is not None and not turno.activo
+
+def write_ventas_turno_excel(output, params, progress=None):
+    """Una fila por item vendido en el turno"""
+    rows = db.session.query(Sale, SaleItem, User.username)\
+                     .join(SaleItem, SaleItem.sale_id == Sale.id)\
+                     .outerjoin(User, Sale.user_id == User.id)\
+                     .filter(Sale.turno_id == params['turno_id'])\
+                     .order_by(Sale.fecha_venta, Sale.id, SaleItem.id)\
+                     .yield_per(500)
+    filas = (
+        [
+            venta.ticket_number,
+            to_local_time(venta.fecha_venta).replace(tzinfo=None),
+            username or 'Desconocido',
+            venta.metodo_pago,
+            float(venta.total),
+            item.article_title,
+            item.quantity,
+            float(item.unit_price),
+            float(item.subtotal)
+        ]
+        for venta, item, username in rows
+    )
+    write_excel_rows(output, f"Ventas Turno {params['turno_id']}", VENTAS_TURNO_EXCEL_COLUMNAS, track_progress(filas, progress))
+
+PERDIDAS_EXCEL_COLUMNAS = [
+    ('ID', 8, None),
+    ('Fecha', 20, 'yyyy-mm-dd hh:mm:ss'),
+    ('Producto', 30, None),
+    ('Tipo', 12, None),
+    ('Cantidad', 12, '#,##0.00'),
+    ('Unidad', 12, None),
+    ('Motivo', 40, None),
+    ('Usuario', 15, None)
+]
+
+def inventory_losses_query(params):
+    inicio, fin = parse_date_range(params.get('fecha_desde'), params.get('fecha_hasta'))
+    query = InventoryLoss.query
+    if params.get('article_id'):
+        query = query.filter(InventoryLoss.article_id == params['article_id'])
+    if params.get('tipo_perdida'):
+        query = query.filter(InventoryLoss.tipo_perdida == params['tipo_perdida'])
+    return local_date_filter(query, InventoryLoss.fecha_local, inicio, fin)
+
+def write_perdidas_excel(output, params, progress=None):
+    rows = db.session.query(InventoryLoss, Article.title, Article.unit_type)\
+                     .outerjoin(Article, InventoryLoss.article_id == Article.id)\
+                     .filter(InventoryLoss.id.in_(inventory_losses_query(params).with_entities(InventoryLoss.id)))\
+                     .order_by(InventoryLoss.fecha_registro.desc())\
+                     .yield_per(500)
+    filas = (
+        [
+            loss.id,
+            to_local_time(loss.fecha_registro).replace(tzinfo=None),
+            title,
+            loss.tipo_perdida,
+            float(loss.cantidad_perdida),
+            unit_type,
+            loss.motivo,
+            loss.usuario_registro
+        ]
+        for loss, title, unit_type in rows
+    )
+    write_excel_rows(output, "Pérdidas de Inventario", PERDIDAS_EXCEL_COLUMNAS, track_progress(filas, progress))
+
+AUDITORIA_EXCEL_COLUMNAS = [
+    ('ID', 8, None),
+    ('Fecha', 20, 'yyyy-mm-dd hh:mm:ss'),
+    ('Producto', 30, None),
+    ('Usuario', 15, None),
+    ('Acción', 18, None),
+    ('Descripción', 60, None),
+    ('Valores Anteriores', 40, None),
+    ('Valores Nuevos', 40, None)
+]
+
+def product_history_query(params):
+    inicio, fin = parse_date_range(params.get('fecha_desde'), params.get('fecha_hasta'))
+    query = ProductHistory.query
+    if params.get('article_id'):
+        query = query.filter(ProductHistory.article_id == params['article_id'])
+    if params.get('action'):
+        query = query.filter(ProductHistory.action == params['action'])
+    if params.get('user_id'):
+        query = query.filter(ProductHistory.user_id == params['user_id'])
+    return local_date_filter(query, ProductHistory.fecha_local, inicio, fin)
+
+def write_auditoria_excel(output, params, progress=None):
+    rows = db.session.query(ProductHistory, Article.title, User.username)\
+                     .outerjoin(Article, ProductHistory.article_id == Article.id)\
+                     .outerjoin(User, ProductHistory.user_id == User.id)\
+                     .filter(ProductHistory.id.in_(product_history_query(params).with_entities(ProductHistory.id)))\
+                     .order_by(ProductHistory.timestamp.desc())\
+                     .yield_per(500)
+    filas = (
+        [
+            entry.id,
+            to_local_time(entry.timestamp).replace(tzinfo=None),
+            title or 'Producto eliminado',
+            username or 'Usuario desconocido',
+            entry.action,
+            entry.description,
+            entry.old_values,
+            entry.new_values
+        ]
+        for entry, title, username in rows
+    )
+    write_excel_rows(output, "Historial de Productos", AUDITORIA_EXCEL_COLUMNAS, track_progress(filas, progress))
+
+def local_period_closed(desde, hasta):
+    """Para reportes filtrados por fecha_local: el periodo está cerrado si su último día local ya terminó"""
+    def closed(params):
+        _, fin = parse_date_range(params.get(desde), params.get(hasta))
+        return fin is not None and fin <= now_local()
+    return closed
+
+# Tipos de reporte disponibles: permiso requerido, parámetros admitidos (nombre -> tipo),
+# conteo de filas para el progreso, criterio de periodo cerrado y generador por formato
+REPORTES = {
+    'turnos': {
+        'permiso': 'can_view_shift_history',
+        'parametros': {'fecha_inicio': 'fecha', 'fecha_fin': 'fecha', 'detalle': 'booleano'},
+        'nombre': 'historial_turnos',
+        'contar': count_turnos,
+        'cerrado': turnos_period_closed,
+        'formatos': {
+            'excel': lambda output, params, progress: write_turnos_excel(output, *parse_date_range(params.get('fecha_inicio'), params.get('fecha_fin')), progress=progress),
+            'pdf': lambda output, params, progress: write_turnos_pdf(output, *parse_date_range(params.get('fecha_inicio'), params.get('fecha_fin')), progress=progress, detalle=params.get('detalle', False))
+        }
+    },
+    'ventas_turno': {
+        'permiso': 'can_view_shift_history',
+        'parametros': {'turno_id': 'entero'},
+        'requeridos': ('turno_id',),
+        'nombre': 'ventas_turno',
+        'contar': count_ventas_turno,
+        'cerrado': ventas_turno_closed,
+        'formatos': {'excel': write_ventas_turno_excel}
+    },
+    'perdidas': {
+        'permiso': 'can_manage_inventory_losses',
+        'parametros': {'fecha_desde': 'fecha', 'fecha_hasta': 'fecha', 'tipo_perdida': 'texto', 'article_id': 'entero'},
+        'nombre': 'perdidas_inventario',
+        'contar': lambda params: inventory_losses_query(params).count(),
+        'cerrado': local_period_closed('fecha_desde', 'fecha_hasta'),
+        'formatos': {'excel': write_perdidas_excel}
+    },
+    'auditoria': {
+        'permiso': 'can_view_audit_logs',
+        'parametros': {'fecha_desde': 'fecha', 'fecha_hasta': 'fecha', 'action': 'texto', 'article_id': 'entero', 'user_id': 'entero'},
+        'nombre': 'historial_productos',
+        'contar': lambda params: product_history_query(params).count(),
+        'cerrado': local_period_closed('fecha_desde', 'fecha_hasta'),
+        'formatos': {'excel': write_auditoria_excel}
+    }
+}
+
+def normalize_report_params(reporte, data):
+    """Deja solo los parámetros admitidos por el reporte, validados y con tipo normalizado"""
+    params = {}
+    for nombre, tipo in reporte['parametros'].items():
+        valor = data.get(nombre)
+        if valor in (None, ''):
+            continue
+        if tipo == 'fecha':
+            datetime.strptime(str(valor), '%Y-%m-%d')
+            params[nombre] = str(valor)
+        elif tipo == 'entero':
+            params[nombre] = int(valor)
+        elif tipo == 'booleano':
+            params[nombre] = valor is True or str(valor).lower() in ('1', 'true', 'si')
+        else:
+            params[nombre] = str(valor)
+    for nombre in reporte.get('requeridos', ()):
+        if nombre not in params:
+            raise ValueError(f'Falta el parámetro {nombre}')
+    return params
+
+def report_cache_key(tipo, formato, params):
+    """Nombre del archivo en caché; lleva el tipo como prefijo para poder invalidar un tipo completo"""
+    contenido = json.dumps({'tipo': tipo, 'formato': formato, 'params': params}, sort_keys=True)
+    return f"{tipo}-{hashlib.sha256(contenido.encode('utf-8')).hexdigest()}"
+
+# Generación del caché por tipo: los trabajos iniciados antes de una invalidación
+# no guardan su archivo como reutilizable
+report_cache_generation = {}
+
+def invalidate_report_cache(tipo):
+    """Descarta los reportes en caché de un tipo cuyos datos de periodos cerrados cambiaron"""
+    with report_jobs_lock:
+        report_cache_generation[tipo] = report_cache_generation.get(tipo, 0) + 1
+    for filename in os.listdir(REPORT_CACHE_FOLDER):
+        if filename.startswith(f"{tipo}-"):
+            try:
+                os.unlink(os.path.join(REPORT_CACHE_FOLDER, filename))
+            except OSError as e:
+                print(f"Error al eliminar {filename}: {e}")
+
+def report_job_dict(job):
+    return {
+        'job_id': job['id'],
+        'tipo': job['tipo'],
+        'formato': job['formato'],
+        'params': job['params'],
+        'estado': job['estado'],
+        'procesados': job['procesados'],
+        'total': job['total'],
+        'progreso': job['progreso'],
+        'desde_cache': job['desde_cache'],
+        'error': job['error'],
+        'creado': job['creado'].strftime('%Y-%m-%d %H:%M:%S'),
+        'finalizado': job['finalizado'].strftime('%Y-%m-%d %H:%M:%S') if job['finalizado'] else None,
+        'descarga': f"/reportes/{job['id']}/descargar" if job['estado'] == 'completado' else None
+    }
+
+def purge_report_jobs():
+    """Olvida los trabajos terminados hace más de REPORT_JOB_TTL y borra sus archivos no cacheados
+    y los del caché que no se pidieron en REPORT_CACHE_TTL"""
+    limite = datetime.now() - REPORT_JOB_TTL
+    with report_jobs_lock:
+        vencidos = [job for job in report_jobs.values()
+                    if job['finalizado'] and job['finalizado'] < limite]
+        for job in vencidos:
+            del report_jobs[job['id']]
+    for job in vencidos:
+        if job['path'] and not job['cacheable']:
+            try:
+                os.unlink(job['path'])
+            except OSError:
+                pass
+    
+    # Caché: por fecha de modificación, que se renueva cada vez que se entrega un archivo
+    # (con el lock tomado, así un pedido no puede tomar del caché un archivo que se está borrando)
+    limite_cache = (datetime.now() - REPORT_CACHE_TTL).timestamp()
+    with report_jobs_lock:
+        en_uso = {job['path'] for job in report_jobs.values() if job['path']}
+        for filename in os.listdir(REPORT_CACHE_FOLDER):
+            path = os.path.join(REPORT_CACHE_FOLDER, filename)
+            if filename.split('-', 1)[0] not in REPORTES or path in en_uso:
+                continue
+            try:
+                if os.path.getmtime(path) < limite_cache:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+def run_report_job(job_id):
+    job = report_jobs[job_id]
+    reporte = REPORTES[job['tipo']]
+    extension = REPORT_FORMATOS[job['formato']][0]
+    temporal = os.path.join(REPORT_CACHE_FOLDER, f"tmp-{job_id}.{extension}")
+    
+    def progress(procesados):
+        job['procesados'] = procesados
+        if job['total']:
+            job['progreso'] = min(99, int(procesados * 100 / job['total']))
+    
+    with app.app_context():
+        try:
+            job['estado'] = 'procesando'
+            job['total'] = reporte['contar'](job['params'])
+            with open(temporal, 'wb') as output:
+                reporte['formatos'][job['formato']](output, job['params'], progress)
+            with report_jobs_lock:
+                # Si los datos cambiaron mientras se generaba, el archivo sirve solo a este trabajo
+                if job['cacheable'] and report_cache_generation.get(job['tipo'], 0) != job['generacion']:
+                    job['cacheable'] = False
+            nombre = job['cache_key'] if job['cacheable'] else job_id
+            destino = os.path.join(REPORT_CACHE_FOLDER, f"{nombre}.{extension}")
+            # El archivo final aparece completo o no aparece
+            os.replace(temporal, destino)
+            job['path'] = destino
+            job['progreso'] = 100
+            job['estado'] = 'completado'
+        except Exception as e:
+            print(f"❌ Error generando reporte {job['tipo']} ({job_id}): {str(e)}")
+            job['estado'] = 'error'
+            job['error'] = str(e)
+            if os.path.exists(temporal):
+                os.unlink(temporal)
+        finally:
+            job['finalizado'] = datetime.now()
+            db.session.remove()
+
+def get_report_job_for_user(job_id):
+    """Devuelve el trabajo si existe y pertenece al usuario de la sesión (o es admin)"""
+    job = report_jobs.get(job_id)
+    if not job:
+        return None
+    if job['user_id'] != session['user_id']:
+        user = User.query.get(session['user_id'])
+        if not user or not user.is_admin:
+            return None
+    return job
+
+@app.route('/reportes', methods=['POST'])
+@login_required
+def enqueue_report():
+    """Encola un reporte; si es de un periodo cerrado ya generado se entrega desde el caché"""
+    try:
+        data = request.get_json() or {}
+        tipo = data.get('tipo')
+        formato = data.get('formato', 'excel')
+        
+        reporte = REPORTES.get(tipo)
+        if not reporte:
+            return jsonify({'error': f'Tipo de reporte inválido: {tipo}'}), 400
+        if formato not in reporte['formatos']:
+            return jsonify({'error': f'Formato no disponible para {tipo}: {formato}'}), 400
+        
+        user = User.query.get(session['user_id'])
+        if not user or not user.has_permission(reporte['permiso']):
+            return jsonify({'error': 'No tienes permisos para esta acción'}), 403
+        
+        try:
+            params = normalize_report_params(reporte, data.get('params') or {})
+        except ValueError as e:
+            return jsonify({'error': f'Parámetros inválidos: {str(e)}'}), 400
+        
+        purge_report_jobs()
+        
+        cache_key = report_cache_key(tipo, formato, params)
+        cacheable = reporte['cerrado'](params)
+        extension = REPORT_FORMATOS[formato][0]
+        cache_path = os.path.join(REPORT_CACHE_FOLDER, f"{cache_key}.{extension}")
+        
+        job = {
+            'id': uuid.uuid4().hex,
+            'tipo': tipo,
+            'formato': formato,
+            'params': params,
+            'user_id': user.id,
+            'cache_key': cache_key,
+            'cacheable': cacheable,
+            'generacion': None,
+            'estado': 'pendiente',
+            'procesados': 0,
+            'total': None,
+            'progreso': 0,
+            'desde_cache': False,
+            'error': None,
+            'path': None,
+            'creado': datetime.now(),
+            'finalizado': None
+        }
+        
+        with report_jobs_lock:
+            job['generacion'] = report_cache_generation.get(tipo, 0)
+            if cacheable and os.path.exists(cache_path):
+                os.utime(cache_path)
+                job.update(estado='completado', progreso=100, desde_cache=True,
+                           path=cache_path, finalizado=datetime.now())
+                report_jobs[job['id']] = job
+                return jsonify(report_job_dict(job)), 200
+            
+            en_curso = [j for j in report_jobs.values() if j['estado'] in ('pendiente', 'procesando')]
+            # Un pedido idéntico en curso se comparte en vez de generarse dos veces
+            for existente in en_curso:
+                if existente['cache_key'] == cache_key and existente['user_id'] == user.id \
+                        and existente['generacion'] == job['generacion']:
+                    return jsonify(report_job_dict(existente)), 202
+            if len(en_curso) >= REPORT_MAX_PENDING:
+                return jsonify({'error': 'Hay demasiados reportes en proceso, intenta más tarde'}), 429
+            
+            report_jobs[job['id']] = job
+        
+        report_executor.submit(run_report_job, job['id'])
+        return jsonify(report_job_dict(job)), 202
+        
+    except Exception as e:
+        print(f"Error al encolar reporte: {str(e)}")
+        return jsonify({'error': 'Error al encolar reporte'}), 500
+
+@app.route('/reportes', methods=['GET'])
+@login_required
+def list_report_jobs():
+    """Trabajos de reporte del usuario actual"""
+    purge_report_jobs()
+    with report_jobs_lock:
+        jobs = [job for job in report_jobs.values() if job['user_id'] == session['user_id']]
+    jobs.sort(key=lambda job: job['creado'], reverse=True)
+    return jsonify([report_job_dict(job) for job in jobs])
+
+@app.route('/reportes/<job_id>', methods=['GET'])
+@login_required
+def get_report_job(job_id):
+    job = get_report_job_for_user(job_id)
+    if not job:
+        return jsonify({'error': 'Reporte no encontrado'}), 404
+    return jsonify(report_job_dict(job))
+
+@app.route('/reportes/<job_id>/descargar', methods=['GET'])
+@login_required
+def download_report(job_id):
+    try:
+        job = get_report_job_for_user(job_id)
+        if not job:
+            return jsonify({'error': 'Reporte no encontrado'}), 404
+        if job['estado'] != 'completado':
+            return jsonify({'error': 'El reporte aún no está listo', 'estado': job['estado']}), 409
+        if not os.path.exists(job['path']):
+            return jsonify({'error': 'El archivo del reporte ya no está disponible'}), 410
+        
+        extension, mimetype = REPORT_FORMATOS[job['formato']]
+        return send_file(
+            job['path'],
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=f"{REPORTES[job['tipo']]['nombre']}.{extension}"
+        )
+    except Exception as e:
+        print(f"Error al descargar reporte: {str(e)}")
+        return jsonify({'error': 'Error al descargar reporte'}), 500
+
+@app.cli.command('clear-report-cache')
+def clear_report_cache():
+    """Borra los reportes guardados en el caché de exportaciones"""
+    eliminados = 0
+    for filename in os.listdir(REPORT_CACHE_FOLDER):
+        try:
+            os.unlink(os.path.join(REPORT_CACHE_FOLDER, filename))
+            eliminados += 1
+        except OSError as e:
+            print(f"Error al eliminar {filename}: {e}")
+    print(f"✅ Reportes eliminados del caché: {eliminados}")
+
 # =====================
 # GESTIÓN DE USUARIOS
 # =====================
@@ -3540,5 +6759,15 @@ def get_user_permissions():
         print(f"Error obteniendo permisos: {str(e)}")
         return jsonify({'error': 'Error al obtener permisos'}), 500
 
+# Al final del módulo: upgrade_schema() usa funciones definidas más arriba (rollups, foto de stock)
+with app.app_context():
+    try:
+        db.create_all()  # Esto creará solo las tablas/columnas faltantes
+        upgrade_schema()
+        print("Base de datos actualizada")
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error actualizando BD: {e}")
+
 if __name__ == '__main__':
     app.run(host='localhost', port=5000, debug=True)
@@ -4,10 +4,12 @@ db = SQLAlchemy()
 
 # Importar solo los modelos existentes
 from .user import User
-from .article import Article, Category
-from .sale import Sale, SaleItem, Turno
+from .article import Article, Category, ArticleClassification
+from .sale import Sale, SaleItem, Turno, TurnoResumen
 from .inventory_loss import InventoryLoss
-from .physical_inventory import PhysicalInventory
+from .physical_inventory import PhysicalInventory, PhysicalInventorySession, PhysicalInventoryArchive
 from .discount import Discount, Promotion, SaleDiscount
 from .history import ProductHistory, PhysicalCountHistory
+from .rollup import SalesDailyRollup, SalesHourlyRollup, ArticleDailyRollup, ShrinkageMonthlyRollup
+from .stock_movement import StockMovement, StockSnapshot, StockAlert
 # NO importar app ni db desde app.py - eso causa import circular
\ No newline at end of file
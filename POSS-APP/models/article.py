@@ -60,4 +60,39 @@ class Article(db.Model):
     # Las relaciones ya están definidas con backref en Category y SaleItem
     
     def __repr__(self):
-        return f'<Article {self.title}>'
\ No newline at end of file
+        return f'<Article {self.title}>'
+
+# Clasificación ABC (aporte a los ingresos) y XYZ (variabilidad de la demanda) de cada artículo activo.
+# La recalcula por completo el proceso de clasificación; no se edita a mano.
+class ArticleClassification(db.Model):
+    __tablename__ = 'article_classifications'
+    
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), primary_key=True)
+    clase_abc = db.Column(db.String(1), nullable=False, index=True)  # 'A', 'B' o 'C'
+    clase_xyz = db.Column(db.String(1), nullable=True, index=True)  # 'X', 'Y', 'Z' o None si no se calculó
+    ingresos = db.Column(db.Float, default=0.0, nullable=False)  # Ingresos netos de devoluciones en la ventana
+    cantidad = db.Column(db.Float, default=0.0, nullable=False)  # Cantidad neta vendida en la ventana
+    participacion = db.Column(db.Float, default=0.0, nullable=False)  # % de los ingresos totales
+    participacion_acumulada = db.Column(db.Float, default=0.0, nullable=False)  # % acumulado en el orden de Pareto
+    coeficiente_variacion = db.Column(db.Float, nullable=True)  # Desv. estándar / media de la demanda semanal
+    ventana_dias = db.Column(db.Integer, nullable=False)
+    calculado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    article = db.relationship('Article', backref=db.backref('classification', uselist=False))
+    
+    def __repr__(self):
+        return f'<ArticleClassification Article {self.article_id}: {self.clase_abc}{self.clase_xyz or ""}>'
+    
+    def to_dict(self):
+        return {
+            'article_id': self.article_id,
+            'clase_abc': self.clase_abc,
+            'clase_xyz': self.clase_xyz,
+            'ingresos': self.ingresos,
+            'cantidad': self.cantidad,
+            'participacion': self.participacion,
+            'participacion_acumulada': self.participacion_acumulada,
+            'coeficiente_variacion': self.coeficiente_variacion,
+            'ventana_dias': self.ventana_dias,
+            'calculado_en': self.calculado_en.strftime('%Y-%m-%d %H:%M:%S')
+        }
\ No newline at end of file
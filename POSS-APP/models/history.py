@@ -1,5 +1,6 @@
 from models import db
 from datetime import datetime, timezone
+from models.local_time import track_local_date
 
 class ProductHistory(db.Model):
     __tablename__ = 'product_history'
@@ -12,11 +13,20 @@ class ProductHistory(db.Model):
     old_values = db.Column(db.Text, nullable=True)  # JSON con valores anteriores
     new_values = db.Column(db.Text, nullable=True)  # JSON con valores nuevos
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de timestamp
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relaciones
     article = db.relationship('Article', backref='history_entries')
     user = db.relationship('User', backref='product_changes')
     
+    # Índices para la paginación keyset por (fecha, id)
+    __table_args__ = (
+        db.Index('ix_product_history_timestamp', 'timestamp', 'id'),
+        db.Index('ix_product_history_article_timestamp', 'article_id', 'timestamp', 'id'),
+        db.Index('ix_product_history_fecha_local', 'fecha_local'),
+    )
+    
     def __repr__(self):
         return f'<ProductHistory {self.action} on Article {self.article_id} by User {self.user_id}>'
 
@@ -31,10 +41,22 @@ class PhysicalCountHistory(db.Model):
     difference = db.Column(db.Float, nullable=False)  # Diferencia (new - old)
     observation = db.Column(db.Text, nullable=True)  # Observaciones del conteo
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), nullable=False)
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de timestamp
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relaciones
     article = db.relationship('Article', backref='count_history')
     user = db.relationship('User', backref='physical_counts')
     
+    # Índices para la paginación keyset por (fecha, id)
+    __table_args__ = (
+        db.Index('ix_physical_count_history_timestamp', 'timestamp', 'id'),
+        db.Index('ix_physical_count_history_article_timestamp', 'article_id', 'timestamp', 'id'),
+        db.Index('ix_physical_count_history_fecha_local', 'fecha_local'),
+    )
+    
     def __repr__(self):
-        return f'<PhysicalCountHistory Article {self.article_id}: {self.old_stock} -> {self.new_stock}>'
\ No newline at end of file
+        return f'<PhysicalCountHistory Article {self.article_id}: {self.old_stock} -> {self.new_stock}>'
+
+track_local_date(ProductHistory, 'timestamp')
+track_local_date(PhysicalCountHistory, 'timestamp')
\ No newline at end of file
@@ -1,5 +1,6 @@
 from . import db
 from datetime import datetime
+from models.local_time import track_local_date
 
 class InventoryLoss(db.Model):
     __tablename__ = 'inventory_losses'
@@ -11,10 +12,20 @@ class InventoryLoss(db.Model):
     motivo = db.Column(db.Text, nullable=True)  # Descripción opcional del motivo
     fecha_registro = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     usuario_registro = db.Column(db.String(50), nullable=True)  # Usuario que registró la pérdida
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de fecha_registro
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relación con Article
     article = db.relationship('Article', backref=db.backref('inventory_losses', lazy=True))
     
+    # Índices para la paginación keyset por (fecha, id), también dentro de un artículo o un tipo
+    __table_args__ = (
+        db.Index('ix_inventory_losses_fecha', 'fecha_registro', 'id'),
+        db.Index('ix_inventory_losses_article_fecha', 'article_id', 'fecha_registro', 'id'),
+        db.Index('ix_inventory_losses_tipo_fecha', 'tipo_perdida', 'fecha_registro', 'id'),
+        db.Index('ix_inventory_losses_fecha_local', 'fecha_local'),
+    )
+    
     def __repr__(self):
         return f'<InventoryLoss {self.id}: {self.cantidad_perdida} {self.article.title}>'
     
@@ -29,4 +40,6 @@ class InventoryLoss(db.Model):
             'motivo': self.motivo,
             'fecha_registro': self.fecha_registro.strftime('%Y-%m-%d %H:%M:%S'),
             'usuario_registro': self.usuario_registro
-        }
\ No newline at end of file
+        }
+
+track_local_date(InventoryLoss, 'fecha_registro')
\ No newline at end of file
@@ -0,0 +1,60 @@
+from models import db
+from datetime import datetime, timezone
+import pytz
+
+# Zona horaria del negocio: los filtros por fecha de los reportes usan el día local
+BUSINESS_TZ = pytz.timezone('America/Santiago')
+
+# Modelos con fecha_local/hora_local: (modelo, columna de origen, si la columna se guarda en UTC)
+LOCAL_DATE_MODELS = []
+
+def to_local_time(dt):
+    """Datetime guardado en UTC (naive o aware) a hora local del negocio"""
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(BUSINESS_TZ)
+
+def local_to_utc(dt):
+    """Datetime naive en hora local a naive UTC, para comparar con columnas guardadas en UTC"""
+    return BUSINESS_TZ.localize(dt).astimezone(pytz.utc).replace(tzinfo=None)
+
+def now_local():
+    """Hora local del negocio sin zona horaria (como se guarda en Turno)"""
+    return datetime.now(BUSINESS_TZ).replace(tzinfo=None)
+
+def local_date_hour(dt, stored_utc=True):
+    """Día y hora local de un timestamp.
+
+    Los naive se interpretan como UTC o como hora local según cómo los guarda
+    su tabla (Sale/Devolucion/historiales en UTC, Turno en hora local).
+    """
+    if dt is None:
+        return None, None
+    if dt.tzinfo is None and not stored_utc:
+        return dt.date(), dt.hour
+    local = to_local_time(dt)
+    return local.date(), local.hour
+
+def with_local_date(filas, fecha, stored_utc=True):
+    """Agrega fecha_local/hora_local de `fecha` a filas de un INSERT por lotes.
+
+    insert(Modelo) con una lista de dicts no pasa por los eventos del ORM de
+    track_local_date, así que esas columnas van explícitas en cada fila.
+    """
+    fecha_local, hora_local = local_date_hour(fecha, stored_utc)
+    return [dict(fila, fecha_local=fecha_local, hora_local=hora_local) for fila in filas]
+
+def track_local_date(model, column, stored_utc=True):
+    """Mantiene fecha_local/hora_local del modelo a partir de `column` al insertar o actualizar"""
+    LOCAL_DATE_MODELS.append((model, column, stored_utc))
+    
+    def set_local_date(mapper, connection, target):
+        if getattr(target, column) is None:
+            # Mismo valor que pondría el default de la columna, que se evalúa después de este evento
+            setattr(target, column, datetime.now(timezone.utc) if stored_utc else datetime.now(BUSINESS_TZ))
+        target.fecha_local, target.hora_local = local_date_hour(getattr(target, column), stored_utc)
+    
+    db.event.listen(model, 'before_insert', set_local_date)
+    db.event.listen(model, 'before_update', set_local_date)
@@ -1,5 +1,6 @@
 from . import db
 from datetime import datetime
+import json
 
 class PhysicalInventory(db.Model):
     __tablename__ = 'physical_inventory'
@@ -11,14 +12,20 @@ class PhysicalInventory(db.Model):
     cantidad_fisica = db.Column(db.Float, nullable=True)  # Stock contado físicamente
     diferencia = db.Column(db.Float, nullable=True)  # cantidad_fisica - cantidad_sistema
     estado = db.Column(db.String(20), default='pendiente', nullable=False)  # 'pendiente', 'contado', 'ajustado'
-    fecha_conteo = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    fecha_conteo = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)  # Momento del último conteo (UTC)
     fecha_ajuste = db.Column(db.DateTime, nullable=True)  # Cuándo se aplicó el ajuste
     usuario_conteo = db.Column(db.String(50), nullable=False)  # Usuario que realizó el conteo
     notas = db.Column(db.Text, nullable=True)  # Observaciones adicionales
+    movimientos_posteriores = db.Column(db.Float, nullable=True)  # Neto de ventas/devoluciones/pérdidas entre el conteo y el ajuste
     
     # Relación con Article
     article = db.relationship('Article', backref=db.backref('physical_inventories', lazy=True))
     
+    __table_args__ = (
+        db.Index('ix_physical_inventory_session_article', 'conteo_session_id', 'article_id'),
+        db.Index('ix_physical_inventory_article_conteo', 'article_id', 'estado', 'fecha_conteo'),  # Último conteo por artículo
+    )
+    
     def __repr__(self):
         return f'<PhysicalInventory {self.id}: {self.article.title if self.article else "N/A"}>'
     
@@ -44,5 +51,98 @@ class PhysicalInventory(db.Model):
             'fecha_ajuste': self.fecha_ajuste.strftime('%Y-%m-%d %H:%M:%S') if self.fecha_ajuste else None,
             'usuario_conteo': self.usuario_conteo,
             'notas': self.notas,
+            'movimientos_posteriores': self.movimientos_posteriores,
             'tiene_diferencia': abs(self.diferencia) > 0.01 if self.diferencia is not None else False
-        }
\ No newline at end of file
+        }
+    
+    @staticmethod
+    def pending_dict(session_id, article, fecha):
+        """Artículo aún sin fila de conteo en una sesión diferida, con la forma de to_dict()"""
+        return {
+            'id': None,
+            'conteo_session_id': session_id,
+            'article_id': article.id,
+            'article_title': article.title,
+            'article_unit_type': article.unit_type,
+            'cantidad_sistema': article.stock,
+            'cantidad_fisica': None,
+            'diferencia': None,
+            'estado': 'pendiente',
+            'fecha_conteo': fecha.strftime('%Y-%m-%d %H:%M:%S'),
+            'fecha_ajuste': None,
+            'usuario_conteo': None,
+            'notas': None,
+            'movimientos_posteriores': None,
+            'tiene_diferencia': False
+        }
+
+class PhysicalInventorySession(db.Model):
+    __tablename__ = 'physical_inventory_sessions'
+    
+    id = db.Column(db.String(36), primary_key=True)  # Mismo UUID que PhysicalInventory.conteo_session_id
+    modo = db.Column(db.String(20), default='completo', nullable=False)  # 'completo' o 'diferido'
+    total_productos = db.Column(db.Integer, default=0, nullable=False)  # Artículos que abarca la sesión
+    fecha_inicio = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    usuario_conteo = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    alcance = db.Column(db.Text, nullable=True)  # JSON con el alcance del conteo; None = catálogo completo
+    # Resumen de las filas de la sesión (incluye las archivadas al compactar)
+    contados = db.Column(db.Integer, default=0, nullable=True)
+    ajustados = db.Column(db.Integer, default=0, nullable=True)
+    con_diferencias = db.Column(db.Integer, default=0, nullable=True)
+    compactada = db.Column(db.Boolean, default=False, nullable=True)  # Filas sin diferencia movidas al archivo
+    fecha_compactacion = db.Column(db.DateTime, nullable=True)
+    filas_archivadas = db.Column(db.Integer, default=0, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_physical_inventory_sessions_fecha', 'fecha_inicio'),
+    )
+    
+    def __repr__(self):
+        return f'<PhysicalInventorySession {self.id} ({self.modo})>'
+    
+    @property
+    def diferida(self):
+        """En modo diferido las filas de conteo se crean al contar cada artículo"""
+        return self.modo == 'diferido'
+    
+    def to_dict(self):
+        return {
+            'session_id': self.id,
+            'modo': self.modo,
+            'total_productos': self.total_productos,
+            'fecha_inicio': self.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
+            'usuario_conteo': self.usuario_conteo,
+            'alcance': json.loads(self.alcance) if self.alcance else None,
+            'contados': self.contados or 0,
+            'ajustados': self.ajustados or 0,
+            'con_diferencias': self.con_diferencias or 0,
+            'compactada': bool(self.compactada),
+            'filas_archivadas': self.filas_archivadas or 0
+        }
+
+class PhysicalInventoryArchive(db.Model):
+    """Filas de conteo sin diferencia de sesiones compactadas (mismas columnas que physical_inventory)"""
+    __tablename__ = 'physical_inventory_archive'
+    
+    id = db.Column(db.Integer, primary_key=True)  # Mismo id que tenía en physical_inventory
+    conteo_session_id = db.Column(db.String(36), nullable=False)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    cantidad_sistema = db.Column(db.Float, nullable=False)
+    cantidad_fisica = db.Column(db.Float, nullable=True)
+    diferencia = db.Column(db.Float, nullable=True)
+    estado = db.Column(db.String(20), nullable=False)
+    fecha_conteo = db.Column(db.DateTime, nullable=False)
+    fecha_ajuste = db.Column(db.DateTime, nullable=True)
+    usuario_conteo = db.Column(db.String(50), nullable=False)
+    notas = db.Column(db.Text, nullable=True)
+    movimientos_posteriores = db.Column(db.Float, nullable=True)
+    archivado_en = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_physical_inventory_archive_session', 'conteo_session_id'),
+        db.Index('ix_physical_inventory_archive_article_conteo', 'article_id', 'estado', 'fecha_conteo'),
+    )
+    
+    def __repr__(self):
+        return f'<PhysicalInventoryArchive {self.id}: Article {self.article_id}>'
\ No newline at end of file
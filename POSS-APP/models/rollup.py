@@ -0,0 +1,90 @@
+from models import db
+
+# Valor de metodo_pago usado en las filas que acumulan devoluciones
+ROLLUP_DEVOLUCION = 'devolucion'
+
+class SalesDailyRollup(db.Model):
+    __tablename__ = 'sales_daily_rollup'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False)  # Día local (America/Santiago)
+    metodo_pago = db.Column(db.String(20), nullable=False)  # 'efectivo', 'tarjeta' o ROLLUP_DEVOLUCION
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_ventas = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_ventas = db.Column(db.Integer, default=0, nullable=False)
+    total_devoluciones = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_devoluciones = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('fecha', 'metodo_pago', 'user_id', name='uq_sales_daily_rollup'),
+    )
+    
+    def __repr__(self):
+        return f'<SalesDailyRollup {self.fecha} {self.metodo_pago} User {self.user_id}: ${self.total_ventas}>'
+
+class SalesHourlyRollup(db.Model):
+    __tablename__ = 'sales_hourly_rollup'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False)  # Día local (America/Santiago)
+    hora = db.Column(db.Integer, nullable=False)  # Hora local 0-23
+    metodo_pago = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    total_ventas = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_ventas = db.Column(db.Integer, default=0, nullable=False)
+    total_devoluciones = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_devoluciones = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('fecha', 'hora', 'metodo_pago', 'user_id', name='uq_sales_hourly_rollup'),
+    )
+    
+    def __repr__(self):
+        return f'<SalesHourlyRollup {self.fecha} {self.hora}h {self.metodo_pago} User {self.user_id}: ${self.total_ventas}>'
+
+class ArticleDailyRollup(db.Model):
+    __tablename__ = 'article_daily_rollup'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.Date, nullable=False)  # Día local (America/Santiago)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    cantidad_vendida = db.Column(db.Float, default=0.0, nullable=False)
+    total_ventas = db.Column(db.Float, default=0.0, nullable=False)
+    margen_estimado = db.Column(db.Float, default=0.0, nullable=False)  # Según margen_ganancia/precio al momento de la venta
+    lineas_venta = db.Column(db.Integer, default=0, nullable=False)  # Items de venta acumulados
+    cantidad_devuelta = db.Column(db.Float, default=0.0, nullable=False)
+    total_devoluciones = db.Column(db.Float, default=0.0, nullable=False)
+    margen_devuelto = db.Column(db.Float, default=0.0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('fecha', 'article_id', name='uq_article_daily_rollup'),
+        db.Index('ix_article_daily_rollup_article', 'article_id', 'fecha'),
+    )
+    
+    def __repr__(self):
+        return f'<ArticleDailyRollup {self.fecha} Article {self.article_id}: ${self.total_ventas}>'
+
+class ShrinkageMonthlyRollup(db.Model):
+    __tablename__ = 'shrinkage_monthly_rollup'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    mes = db.Column(db.Date, nullable=False)  # Primer día del mes local (America/Santiago)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    perdidas_cantidad = db.Column(db.Float, default=0.0, nullable=False)
+    perdidas_vencido = db.Column(db.Float, default=0.0, nullable=False)
+    perdidas_danado = db.Column(db.Float, default=0.0, nullable=False)
+    perdidas_valor_costo = db.Column(db.Float, default=0.0, nullable=False)  # cantidad * (precio - margen_ganancia) al registrar
+    perdidas_registros = db.Column(db.Integer, default=0, nullable=False)
+    ajustes = db.Column(db.Integer, default=0, nullable=False)  # Ajustes por conteo físico con diferencia
+    ajustes_faltante = db.Column(db.Integer, default=0, nullable=False)  # Ajustes donde se contó menos que el sistema
+    diferencia_neta = db.Column(db.Float, default=0.0, nullable=False)  # Suma de (stock nuevo - stock anterior)
+    diferencia_absoluta = db.Column(db.Float, default=0.0, nullable=False)
+    diferencia_valor_costo = db.Column(db.Float, default=0.0, nullable=False)
+    
+    __table_args__ = (
+        db.UniqueConstraint('mes', 'article_id', name='uq_shrinkage_monthly_rollup'),
+        db.Index('ix_shrinkage_monthly_rollup_article', 'article_id', 'mes'),
+    )
+    
+    def __repr__(self):
+        return f'<ShrinkageMonthlyRollup {self.mes} Article {self.article_id}: ${self.perdidas_valor_costo}>'
\ No newline at end of file
@@ -1,6 +1,7 @@
 from models import db
 from datetime import datetime, timezone
-import pytz
+import json
+from models.local_time import BUSINESS_TZ, track_local_date
 
 class Sale(db.Model):
     __tablename__ = 'sales'
@@ -13,12 +14,21 @@ class Sale(db.Model):
     metodo_pago = db.Column(db.String(20), nullable=False, default='efectivo')  # 'efectivo' o 'tarjeta'
     turno_id = db.Column(db.Integer, db.ForeignKey('turnos.id'), nullable=True)  # Relación con turno
     nota = db.Column(db.Text, nullable=True)  # Campo para notas de la venta
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de fecha_venta
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relaciones - CORREGIDO
     user = db.relationship('User', backref='user_sales')  # ← Cambiar nombre del backref
     items = db.relationship('SaleItem', back_populates='sale', cascade='all, delete-orphan')  # ← Usar back_populates
     turno = db.relationship('Turno', back_populates='sales')  # ← Usar back_populates
     
+    # Índices para la paginación keyset por (fecha, id)
+    __table_args__ = (
+        db.Index('ix_sales_turno_fecha', 'turno_id', 'fecha_venta', 'id'),
+        db.Index('ix_sales_fecha', 'fecha_venta', 'id'),
+        db.Index('ix_sales_fecha_local', 'fecha_local', 'hora_local'),
+    )
+    
     def __repr__(self):
         return f'<Sale {self.ticket_number}: ${self.total}>'
 
@@ -37,6 +47,12 @@ class SaleItem(db.Model):
     sale = db.relationship("Sale", back_populates="items")  # ← Usar back_populates
     article = db.relationship("Article", backref="article_sale_items")  # ← Cambiar nombre del backref
     
+    # Índices para recorrer los ítems de un rango de ventas y las ventas de un artículo
+    __table_args__ = (
+        db.Index('ix_sale_items_sale', 'sale_id'),
+        db.Index('ix_sale_items_article_sale', 'article_id', 'sale_id'),
+    )
+    
     def __repr__(self):
         return f'<SaleItem {self.quantity}x {self.article_title}>'
 
@@ -45,7 +61,7 @@ class Turno(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    fecha_inicio = db.Column(db.DateTime, default=lambda: datetime.now(pytz.timezone('America/Santiago')), nullable=False)
+    fecha_inicio = db.Column(db.DateTime, default=lambda: datetime.now(BUSINESS_TZ), nullable=False)
     fecha_cierre = db.Column(db.DateTime, nullable=True)
     monto_inicial = db.Column(db.Float, default=0.0, nullable=False)  # Monto con que se abre la caja
     total_efectivo = db.Column(db.Float, default=0.0, nullable=False)  # Total vendido en efectivo
@@ -55,12 +71,21 @@ class Turno(db.Model):
     total_devoluciones = db.Column(db.Float, default=0.0, nullable=False)  # Total de devoluciones
     cantidad_devoluciones = db.Column(db.Integer, default=0, nullable=False)  # Número de devoluciones
     activo = db.Column(db.Boolean, default=True, nullable=False)  # Si el turno está activo
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de fecha_inicio
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relaciones
     # Nota: No es necesario usar backref aquí, ya que las relaciones se manejan en Sale
     user = db.relationship('User', backref='user_turnos')  
     sales = db.relationship('Sale', back_populates='turno')  
     
+    # Índices para la paginación keyset por (fecha, id)
+    __table_args__ = (
+        db.Index('ix_turnos_fecha_inicio', 'fecha_inicio', 'id'),
+        db.Index('ix_turnos_activo_cierre', 'activo', 'fecha_cierre', 'id'),
+        db.Index('ix_turnos_fecha_local', 'fecha_local'),
+    )
+    
     def __repr__(self):
         return f'<Turno {self.id}: User {self.user_id}>'
 
@@ -93,11 +118,76 @@ class Devolucion(db.Model):
     total = db.Column(db.Float, nullable=False)
     motivo = db.Column(db.String(500), nullable=False)  # Motivo de la devolución
     fecha_devolucion = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de fecha_devolucion
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
     
     # Relaciones
     turno = db.relationship('Turno', backref='devoluciones')
     user = db.relationship('User', backref='user_devoluciones')
     article = db.relationship('Article', backref='article_devoluciones')
     
+    # Índices para la paginación keyset por (fecha, id)
+    __table_args__ = (
+        db.Index('ix_devoluciones_turno_fecha', 'turno_id', 'fecha_devolucion', 'id'),
+        db.Index('ix_devoluciones_fecha', 'fecha_devolucion', 'id'),
+        db.Index('ix_devoluciones_fecha_local', 'fecha_local', 'hora_local'),
+        db.Index('ix_devoluciones_article_fecha', 'article_id', 'fecha_devolucion'),
+    )
+    
+    def __repr__(self):
+        return f'<Devolucion {self.ticket_number}: {self.quantity}x {self.article_title}>'
+
+class TurnoResumen(db.Model):
+    __tablename__ = 'turno_resumenes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    turno_id = db.Column(db.Integer, db.ForeignKey('turnos.id'), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    fecha_inicio = db.Column(db.DateTime, nullable=False)  # Copia de Turno.fecha_inicio (hora Chile)
+    fecha_cierre = db.Column(db.DateTime, nullable=True)  # Copia de Turno.fecha_cierre
+    total_ventas = db.Column(db.Float, default=0.0, nullable=False)
+    total_efectivo = db.Column(db.Float, default=0.0, nullable=False)
+    total_tarjeta = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_ventas = db.Column(db.Integer, default=0, nullable=False)
+    total_devoluciones = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_devoluciones = db.Column(db.Integer, default=0, nullable=False)
+    total_descuentos = db.Column(db.Float, default=0.0, nullable=False)
+    cantidad_items = db.Column(db.Float, default=0, nullable=False)  # Unidades/kg vendidos
+    totales_por_metodo = db.Column(db.Text, nullable=True)  # JSON {metodo_pago: {total, cantidad}}
+    descuentos_por_tipo = db.Column(db.Text, nullable=True)  # JSON {tipo_descuento: {monto, cantidad}}
+    top_articulos = db.Column(db.Text, nullable=True)  # JSON [{article_id, article_title, cantidad, total}]
+    ventas_por_hora = db.Column(db.Text, nullable=True)  # JSON [{hora: 'YYYY-MM-DD HH:00' local, total, cantidad}]
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    
+    # Relaciones
+    # El resumen se escribe una sola vez al cerrar el turno y no se modifica después
+    turno = db.relationship('Turno', backref=db.backref('resumen', uselist=False))
+    user = db.relationship('User')
+    
     def __repr__(self):
-        return f'<Devolucion {self.ticket_number}: {self.quantity}x {self.article_title}>'
\ No newline at end of file
+        return f'<TurnoResumen Turno {self.turno_id}: ${self.total_ventas}>'
+    
+    def to_dict(self):
+        return {
+            'turno_id': self.turno_id,
+            'user_id': self.user_id,
+            'fecha_inicio': self.fecha_inicio.strftime('%Y-%m-%d %H:%M:%S'),
+            'fecha_cierre': self.fecha_cierre.strftime('%Y-%m-%d %H:%M:%S') if self.fecha_cierre else None,
+            'total_ventas': self.total_ventas,
+            'total_efectivo': self.total_efectivo,
+            'total_tarjeta': self.total_tarjeta,
+            'cantidad_ventas': self.cantidad_ventas,
+            'total_devoluciones': self.total_devoluciones,
+            'cantidad_devoluciones': self.cantidad_devoluciones,
+            'total_descuentos': self.total_descuentos,
+            'cantidad_items': self.cantidad_items,
+            'totales_por_metodo': json.loads(self.totales_por_metodo) if self.totales_por_metodo else {},
+            'descuentos_por_tipo': json.loads(self.descuentos_por_tipo) if self.descuentos_por_tipo else {},
+            'top_articulos': json.loads(self.top_articulos) if self.top_articulos else [],
+            'ventas_por_hora': json.loads(self.ventas_por_hora) if self.ventas_por_hora else []
+        }
+
+# fecha_local/hora_local se calculan al guardar (Turno guarda hora local; ventas y devoluciones, UTC)
+track_local_date(Sale, 'fecha_venta')
+track_local_date(Turno, 'fecha_inicio', stored_utc=False)
+track_local_date(Devolucion, 'fecha_devolucion')
\ No newline at end of file
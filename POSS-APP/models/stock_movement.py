@@ -0,0 +1,110 @@
+from models import db
+from datetime import datetime
+from models.local_time import track_local_date
+
+# Tipos de movimiento del ledger de stock
+TIPOS_MOVIMIENTO = ('alta', 'edicion', 'venta', 'devolucion', 'perdida', 'perdida_anulada', 'ajuste_conteo')
+
+class StockMovement(db.Model):
+    """Ledger de stock: solo se agregan filas, nunca se modifican ni eliminan.
+
+    Cada fila guarda el cambio (cantidad con signo) y el stock que quedó, así
+    el stock de un artículo en un momento es la última fila hasta ese momento.
+    """
+    __tablename__ = 'stock_movements'
+
+    id = db.Column(db.Integer, primary_key=True)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    tipo = db.Column(db.String(20), nullable=False)  # Uno de TIPOS_MOVIMIENTO
+    cantidad = db.Column(db.Float, nullable=False)  # Cambio de stock: negativo sale, positivo entra
+    stock_resultante = db.Column(db.Float, nullable=False)  # Stock del artículo después del movimiento
+    referencia = db.Column(db.String(64), nullable=True)  # Id de la venta, devolución, pérdida o sesión de conteo
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    fecha_local = db.Column(db.Date, nullable=True)  # Día local (America/Santiago) de fecha
+    hora_local = db.Column(db.Integer, nullable=True)  # Hora local 0-23
+
+    # (article_id, fecha, id) responde el stock en un momento y los movimientos de un artículo;
+    # (fecha, id) la paginación keyset de todos los movimientos
+    __table_args__ = (
+        db.Index('ix_stock_movements_article_fecha', 'article_id', 'fecha', 'id'),
+        db.Index('ix_stock_movements_fecha', 'fecha', 'id'),
+        db.Index('ix_stock_movements_fecha_local', 'fecha_local'),
+    )
+
+    def __repr__(self):
+        return f'<StockMovement {self.tipo} Article {self.article_id}: {self.cantidad:+g} -> {self.stock_resultante:g}>'
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'article_id': self.article_id,
+            'tipo': self.tipo,
+            'cantidad': self.cantidad,
+            'stock_resultante': self.stock_resultante,
+            'referencia': self.referencia,
+            'user_id': self.user_id,
+            'fecha': self.fecha.strftime('%Y-%m-%d %H:%M:%S') if self.fecha else None
+        }
+
+class StockSnapshot(db.Model):
+    """Foto periódica del stock de cada artículo y del último movimiento que incluye"""
+    __tablename__ = 'stock_snapshots'
+
+    id = db.Column(db.Integer, primary_key=True)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    stock = db.Column(db.Float, nullable=False)
+    movimiento_id = db.Column(db.Integer, nullable=True)  # Último StockMovement del artículo al tomar la foto
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_stock_snapshots_article_fecha', 'article_id', 'fecha'),
+        db.Index('ix_stock_snapshots_fecha', 'fecha'),
+    )
+
+    def to_dict(self):
+        return {
+            'article_id': self.article_id,
+            'stock': self.stock,
+            'movimiento_id': self.movimiento_id,
+            'fecha': self.fecha.strftime('%Y-%m-%d %H:%M:%S') if self.fecha else None
+        }
+
+# Cruces de umbral que generan una alerta
+TIPOS_ALERTA = ('bajo_minimo', 'sin_stock', 'repuesto')
+
+class StockAlert(db.Model):
+    """Alerta emitida cuando un movimiento cruza el stock mínimo (o llega a cero) de un artículo.
+
+    Los clientes leen solo las posteriores a su último id (cursor).
+    """
+    __tablename__ = 'stock_alerts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    article_id = db.Column(db.Integer, db.ForeignKey('articles.id'), nullable=False)
+    tipo = db.Column(db.String(20), nullable=False)  # Uno de TIPOS_ALERTA
+    stock_anterior = db.Column(db.Float, nullable=False)
+    stock = db.Column(db.Float, nullable=False)  # Stock después del movimiento que la generó
+    stock_minimo = db.Column(db.Integer, nullable=False)
+    movimiento_tipo = db.Column(db.String(20), nullable=False)  # Tipo del StockMovement que la generó
+    referencia = db.Column(db.String(64), nullable=True)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_stock_alerts_article_fecha', 'article_id', 'fecha'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'article_id': self.article_id,
+            'tipo': self.tipo,
+            'stock_anterior': self.stock_anterior,
+            'stock': self.stock,
+            'stock_minimo': self.stock_minimo,
+            'movimiento_tipo': self.movimiento_tipo,
+            'referencia': self.referencia,
+            'fecha': self.fecha.strftime('%Y-%m-%d %H:%M:%S') if self.fecha else None
+        }
+
+track_local_date(StockMovement, 'fecha')
\ No newline at end of file